@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# End-to-end benchmark of the extract server, with scripted Python clients in place of browsers.
+#
+# Starts webgazerExtractServer.py on a dataset (normally one made by makeSyntheticParticipants.py),
+# connects the given number of workers over the WebSocket protocol, and answers every frame with a
+# fixed WebGazer result, so that everything but WebGazer itself is measured. At the end it reports:
+#
+#   - frames/sec over the whole run, and bytes per frame on the wire
+#   - the server's per-stage latency histograms (metrics.py)
+#   - the time between frames as the clients see it
+#   - peak RSS of the server
+#
+# and writes the same numbers to benchmark.json next to the dataset, to compare runs.
+#
+# The dataset's ../FramesDataset is removed first, so that extraction is measured too. To be safe,
+# the dataset has to be marked synthetic.txt, and an existing ../FramesDataset is only removed if
+# the benchmark made it (it leaves benchmarkOutput.txt inside); anything else is left alone.
+#
+# Usage:
+# > python benchmarkExtraction.py <dataset directory> [workers] [window] [transport] [extract|stream]
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import asyncio
+import resource
+import subprocess
+
+import numpy as np
+import tornado.httpclient
+import tornado.websocket
+
+from makeSyntheticParticipants import syntheticMarker
+from frameExtraction import outputPrefix
+
+# Left in the output directory this benchmark makes, so that a later run knows it may delete it
+outputMarker = "benchmarkOutput.txt"
+
+# What a client sends back for every frame; sizes as webgazerExtractClient.js
+fmPosFeaturesSize = 468
+eyeFeaturesSize = 120
+
+
+##################################################################
+# Server side: run in a child process by the benchmark
+def runServer( port, optionsJSON, metricsFile ):
+    import atexit
+    import global_variables
+    import webgazerExtractServer
+    from metrics import serverMetrics
+
+    options = json.loads( optionsJSON )
+    init = global_variables.init
+    def initWithOptions():
+        init()
+        for k, v in options.items():
+            setattr( global_variables, k, v )
+    global_variables.init = initWithOptions
+
+    def writeMetrics():
+        # The server exits once every participant is done; leave the final numbers behind
+        snapshot = serverMetrics.snapshot()
+        snapshot['peakRSSKB'] = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+        with open( metricsFile, 'w' ) as f:
+            json.dump( snapshot, f )
+    atexit.register( writeMetrics )
+
+    sys.argv = ['webgazerExtractServer.py', str(port)]
+    webgazerExtractServer.main()
+
+
+##################################################################
+# Client side
+class BenchmarkClient:
+
+    def __init__(self, url):
+        self.url = url
+        self.framesDone = 0
+        self.bytesReceived = 0
+        self.frameIntervals = []        # ms between consecutive frames of a video arriving
+        self.frameInfo = []             # msgID 2 messages waiting for their image
+
+    async def run(self):
+        ws = await tornado.websocket.websocket_connect( self.url, compression_options={} if 'transport=deflate' in self.url else None )
+        lastFrameTime = None
+        while True:
+            msg = await ws.read_message()
+            if msg is None:
+                # Server is done (or went away)
+                return
+
+            if isinstance( msg, bytes ):
+                info = self.frameInfo.pop( 0 )
+                self.bytesReceived = self.bytesReceived + len(msg)
+                result = {'msgID': "3",
+                          'frameNum': int( info['frameNum'] ),
+                          'frameTimeEpoch': int( info['frameTimeEpoch'] ),
+                          'webGazerX': 0.5,
+                          'webGazerY': 0.5,
+                          'error': 0.1,
+                          'errorPix': 100.0,
+                          'fmPos': [[0, 0, 0]] * fmPosFeaturesSize,
+                          'eyeFeatures': [0] * eyeFeaturesSize}
+                await ws.write_message( json.dumps( result ) )
+                self.framesDone = self.framesDone + 1
+                continue
+
+            obj = json.loads( msg )
+            if obj['msgID'] == "2":
+                self.frameInfo.append( obj )
+                now = time.perf_counter()
+                if lastFrameTime is not None:
+                    self.frameIntervals.append( (now - lastFrameTime) * 1000 )
+                lastFrameTime = now
+            elif obj['msgID'] in ("0", "4"):
+                # New participant or end of a video; ask for the next video
+                lastFrameTime = None
+                await ws.write_message( json.dumps( {'msgID': "1"} ) )
+
+
+def freePort():
+    with socket.socket() as s:
+        s.bind( ('127.0.0.1', 0) )
+        return s.getsockname()[1]
+
+
+async def waitForServer( port, timeout ):
+    client = tornado.httpclient.AsyncHTTPClient()
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        try:
+            await client.fetch( "http://127.0.0.1:" + str(port) + "/metrics" )
+            return True
+        except Exception:
+            await asyncio.sleep( 0.2 )
+    return False
+
+
+async def runClients( port, workers, window, transport ):
+    url = "ws://127.0.0.1:" + str(port) + "/websocket?window=" + str(window) + "&transport=" + transport
+    clients = [BenchmarkClient( url ) for i in range(0, workers)]
+    await asyncio.gather( *[c.run() for c in clients] )
+    return clients
+
+
+def printStages( stages ):
+    print( "{:<12} {:>8} {:>10} {:>10} {:>10} {:>10}".format( "stage", "count", "mean ms", "p50 ms", "p90 ms", "p99 ms" ) )
+    for name, s in stages.items():
+        if s['count'] == 0:
+            continue
+        print( "{:<12} {:>8} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f}".format( name, s['count'], s['meanMS'], s['p50MS'], s['p90MS'], s['p99MS'] ) )
+
+
+def main():
+    if len(sys.argv) >= 2 and sys.argv[1] == '--server':
+        runServer( int(sys.argv[2]), sys.argv[3], sys.argv[4] )
+        return
+    if len(sys.argv) < 2:
+        print( "Usage: python benchmarkExtraction.py <dataset directory> [workers] [window] [transport] [extract|stream]" )
+        sys.exit( 1 )
+
+    datasetDir = os.path.abspath( sys.argv[1] )
+    workers = int(sys.argv[2]) if len(sys.argv) >= 3 else 1
+    window = int(sys.argv[3]) if len(sys.argv) >= 4 else 8
+    transport = sys.argv[4] if len(sys.argv) >= 5 else 'raw'
+    stream = len(sys.argv) >= 6 and sys.argv[5] == 'stream'
+
+    if not os.path.isfile( os.path.join( datasetDir, syntheticMarker ) ):
+        print( datasetDir + " has no " + syntheticMarker + "; benchmark a dataset made by makeSyntheticParticipants.py" )
+        sys.exit( 1 )
+    outDir = os.path.normpath( os.path.join( datasetDir, outputPrefix ) )
+    if os.path.isdir( outDir ) and len( os.listdir( outDir ) ) > 0:
+        if not os.path.isfile( os.path.join( outDir, outputMarker ) ):
+            print( outDir + " was not made by this benchmark (it has no " + outputMarker + "); move it out of the way first" )
+            sys.exit( 1 )
+        shutil.rmtree( outDir )
+    os.makedirs( outDir, exist_ok=True )
+    with open( os.path.join( outDir, outputMarker ), 'w' ) as f:
+        f.write( "Output of benchmarkExtraction.py on " + datasetDir + "; deleted at the start of each run\n" )
+
+    port = freePort()
+    metricsFile = os.path.join( outDir, "serverMetrics.json" )
+    options = {'streamFramesFromFfmpeg': stream}
+    here = os.path.dirname( os.path.abspath( __file__ ) )
+    env = dict( os.environ )
+    env['PYTHONPATH'] = here + os.pathsep + env.get( 'PYTHONPATH', '' )
+    server = subprocess.Popen( [sys.executable, os.path.join( here, 'benchmarkExtraction.py' ), '--server', str(port), json.dumps( options ), metricsFile],
+                               cwd=datasetDir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL )
+
+    print( "Benchmarking " + datasetDir + ": workers " + str(workers) + " window " + str(window) + " transport " + transport + \
+        (" streaming from ffmpeg" if stream else " extracting frames") )
+    loop = asyncio.new_event_loop()
+    try:
+        if not loop.run_until_complete( waitForServer( port, 30 ) ):
+            print( "Server did not start" )
+            sys.exit( 1 )
+        start = time.perf_counter()
+        clients = loop.run_until_complete( runClients( port, workers, window, transport ) )
+        seconds = time.perf_counter() - start
+    finally:
+        try:
+            server.wait( timeout=30 )
+        except subprocess.TimeoutExpired:
+            server.kill()
+        loop.close()
+
+    frames = sum( c.framesDone for c in clients )
+    bytesReceived = sum( c.bytesReceived for c in clients )
+    frameIntervals = np.array( [t for c in clients for t in c.frameIntervals] )
+    serverMetrics = {}
+    if os.path.isfile( metricsFile ):
+        with open( metricsFile ) as f:
+            serverMetrics = json.load( f )
+
+    report = {'dataset': datasetDir,
+              'workers': workers,
+              'window': window,
+              'transport': transport,
+              'stream': stream,
+              'frames': frames,
+              'seconds': round( seconds, 3 ),
+              'framesPerSecond': round( frames / seconds, 2 ) if seconds > 0 else 0.0,
+              'bytesPerFrame': round( bytesReceived / frames ) if frames > 0 else 0,
+              'clientFrameIntervalMS': {'p50': round( float( np.percentile( frameIntervals, 50 ) ), 3 ),
+                                        'p99': round( float( np.percentile( frameIntervals, 99 ) ), 3 )} if len(frameIntervals) > 0 else {},
+              'serverPeakRSSKB': serverMetrics.get( 'peakRSSKB' ),
+              'stages': serverMetrics.get( 'stages', {} )}
+
+    print( "Frames: {}  seconds: {:.2f}  frames/sec: {:.2f}  bytes/frame: {}".format( frames, seconds, report['framesPerSecond'], report['bytesPerFrame'] ) )
+    if len(frameIntervals) > 0:
+        print( "Client frame interval: p50 {p50:.3f} ms  p99 {p99:.3f} ms".format( **report['clientFrameIntervalMS'] ) )
+    print( "Server peak RSS: {} KB".format( report['serverPeakRSSKB'] ) )
+    printStages( report['stages'] )
+
+    with open( os.path.join( os.path.dirname( datasetDir ), "benchmark.json" ), 'w' ) as f:
+        json.dump( report, f, indent=1 )
+
+
+if __name__ == '__main__':
+    main()
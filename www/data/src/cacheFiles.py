@@ -0,0 +1,41 @@
+import os
+import json
+import numpy as np
+
+
+##################################################################
+# Cache files written next to the dataset
+#
+# Each is written under a temporary name and then renamed over the old one, so that a server
+# killed part way through leaves the previous file (or none), never a truncated one.
+
+def fileKey( filename ):
+    # What a cache is checked against: the source file's modification time and size, which
+    # have to match exactly (a file restored from a backup can be older than its cache)
+    st = os.stat( filename )
+    return [st.st_mtime_ns, st.st_size]
+
+def loadJSON( filename ):
+    # What saveJSON wrote, or None if there isn't a readable file
+    try:
+        with open( filename ) as f:
+            return json.load( f )
+    except (OSError, ValueError):
+        return None
+
+def saveJSON( filename, value ):
+    with open( filename + '.tmp', 'w' ) as f:
+        json.dump( value, f )
+    os.replace( filename + '.tmp', filename )
+
+def saveArray( filename, array ):
+    # np.save, in one step. Through a file object, as np.save would add .npy to filename + '.tmp'
+    with open( filename + '.tmp', 'wb' ) as f:
+        np.save( f, array )
+    os.replace( filename + '.tmp', filename )
+
+def saveArrays( filename, **arrays ):
+    # np.savez, in one step
+    with open( filename + '.tmp', 'wb' ) as f:
+        np.savez( f, **arrays )
+    os.replace( filename + '.tmp', filename )
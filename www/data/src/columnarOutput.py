@@ -0,0 +1,172 @@
+import os
+import glob
+import json
+import shutil
+import numpy as np
+
+
+##################################################################
+# Columnar binary output, alongside gazePredictions.csv
+#
+# One directory per video, holding one .npy file per column, so that training code can
+# memory-map a participant's data instead of parsing 600+ quoted text columns per frame:
+#
+#   frameNum.npy, frameTimeEpoch.npy                    int64 (N,)
+#   webGazerX.npy, webGazerY.npy, error.npy, errorPix.npy,
+#   tobiiLeftScreenGazeX.npy ... tobiiRightScreenGazeY.npy  float64 (N,)
+#   fmPos.npy                                           float32 (N, 468, 3); -1 where there is no face
+#   eyeFeatures.npy                                     float32 (N, 120)
+#   frameImageFile.npy                                  unicode (N,)
+#   interactions.json                                   per-frame mouse/keyboard lists, as in the CSV
+#   meta.json                                           participant, video, number of frames
+#
+# Like the CSV, the directory is written as ..._gazePredictions.cols while the video is in
+# progress and renamed to ..._gazePredictionsDone.cols once every frame is in it.
+columnsTempName = "gazePredictions.cols"
+columnsDoneName = "gazePredictionsDone.cols"
+
+fmPosPoints = 468
+eyeFeaturesSize = 120
+
+scalarColumns = [('frameNum', np.int64), ('frameTimeEpoch', np.int64),
+                 ('webGazerX', np.float64), ('webGazerY', np.float64), ('error', np.float64), ('errorPix', np.float64),
+                 ('tobiiLeftScreenGazeX', np.float64), ('tobiiLeftScreenGazeY', np.float64),
+                 ('tobiiRightScreenGazeX', np.float64), ('tobiiRightScreenGazeY', np.float64)]
+interactionColumns = ['mouseMoveX','mouseMoveY','mouseClickX','mouseClickY','keyPressed','keyPressedX','keyPressedY']
+
+# Room for the .npy header of any shape we write; see NpyAppendWriter
+npyHeaderBytes = 128
+
+
+# Rows are appended to a .npy file as they arrive, so nothing is held in memory. The header
+# is written with a placeholder row count, padded to a fixed size, and rewritten on close.
+class NpyAppendWriter:
+
+    def __init__(self, filename, dtype, rowShape):
+        self.filename = filename
+        self.dtype = np.dtype( dtype )
+        self.rowShape = tuple( rowShape )
+        self.rows = 0
+        self.f = open( filename, 'wb', buffering=1<<20 )
+        self.writeHeader()
+
+    def writeHeader(self):
+        header = {'descr': np.lib.format.dtype_to_descr( self.dtype ), 'fortran_order': False,
+                  'shape': (self.rows,) + self.rowShape}
+        header = repr( header ).encode( 'latin1' )
+        # Magic (6) + version (2) + header length (2) + header, space padded, ending in a newline
+        padding = npyHeaderBytes - 10 - len(header) - 1
+        self.f.write( np.lib.format.MAGIC_PREFIX + bytes([1, 0]) )
+        self.f.write( (npyHeaderBytes - 10).to_bytes( 2, 'little' ) )
+        self.f.write( header + b' ' * padding + b'\n' )
+
+    def append(self, row):
+        self.f.write( np.ascontiguousarray( row, dtype=self.dtype ).tobytes() )
+        self.rows = self.rows + 1
+
+    def close(self, sync=False):
+        self.f.flush()
+        self.f.seek( 0 )
+        self.writeHeader()
+        self.f.flush()
+        if sync:
+            os.fsync( self.f.fileno() )
+        self.f.close()
+
+
+def fmPosArray( fmPos ):
+    # Face mesh positions as (468, 3). The client sends 234 [-1,-1] pairs when there is no face.
+    try:
+        a = np.asarray( fmPos, dtype=np.float32 )
+        if a.shape == (fmPosPoints, 3):
+            return a
+    except ValueError:
+        pass
+    a = np.full( (fmPosPoints, 3), -1, dtype=np.float32 )
+    for j, point in enumerate( fmPos[0:fmPosPoints] ):
+        point = point[0:3]
+        a[j, 0:len(point)] = point
+    return a
+
+
+def eyeFeaturesArray( eyeFeatures ):
+    a = np.full( eyeFeaturesSize, -1, dtype=np.float32 )
+    eyeFeatures = np.asarray( eyeFeatures, dtype=np.float32 ).ravel()[0:eyeFeaturesSize]
+    a[0:len(eyeFeatures)] = eyeFeatures
+    return a
+
+
+# One per video, next to its BufferedCSVWriter
+class ColumnarVideoWriter:
+
+    def __init__(self, tempDir, doneDir, participant, videoFilename):
+        self.tempDir = tempDir
+        self.doneDir = doneDir
+        self.meta = {'participant': participant, 'video': videoFilename}
+
+        # A partial directory means an interrupted run; start the video again, as for the CSV
+        if os.path.isdir( tempDir ):
+            shutil.rmtree( tempDir )
+        os.makedirs( tempDir )
+
+        self.columns = {name: NpyAppendWriter( os.path.join( tempDir, name + '.npy' ), dtype, () ) for name, dtype in scalarColumns}
+        self.columns['fmPos'] = NpyAppendWriter( os.path.join( tempDir, 'fmPos.npy' ), np.float32, (fmPosPoints, 3) )
+        self.columns['eyeFeatures'] = NpyAppendWriter( os.path.join( tempDir, 'eyeFeatures.npy' ), np.float32, (eyeFeaturesSize,) )
+        self.frameImageFiles = []
+        self.interactions = {k: [] for k in interactionColumns}
+
+    def writeFrame(self, row):
+        # row = the CSV row for the frame, before fmPos and eyeFeatures are split into columns
+        for name, dtype in scalarColumns:
+            self.columns[name].append( dtype( row[name] ) )
+        self.columns['fmPos'].append( fmPosArray( row['fmPos'] ) )
+        self.columns['eyeFeatures'].append( eyeFeaturesArray( row['eyeFeatures'] ) )
+        self.frameImageFiles.append( row['frameImageFile'] )
+        for k in interactionColumns:
+            self.interactions[k].append( row.get( k, [] ) )
+
+    def close(self):
+        # Interrupted; leave the partial directory to be restarted
+        for c in self.columns.values():
+            c.close()
+
+    def finish(self):
+        # Every frame is in; make it durable and mark the video as done
+        for c in self.columns.values():
+            c.close( sync=True )
+        np.save( os.path.join( self.tempDir, 'frameImageFile.npy' ), np.array( self.frameImageFiles, dtype=str ) )
+        with open( os.path.join( self.tempDir, 'interactions.json' ), 'w' ) as f:
+            json.dump( self.interactions, f )
+        self.meta['frames'] = len(self.frameImageFiles)
+        with open( os.path.join( self.tempDir, 'meta.json' ), 'w' ) as f:
+            json.dump( self.meta, f )
+
+        if os.path.isdir( self.doneDir ):
+            shutil.rmtree( self.doneDir )
+        os.rename( self.tempDir, self.doneDir )
+
+
+##################################################################
+# Readers
+#
+def loadVideoColumns( doneDir ):
+    # dict of column name -> array, memory-mapped; plus 'interactions' and 'meta'
+    columns = {}
+    for fn in glob.glob( os.path.join( doneDir, '*.npy' ) ):
+        name = os.path.splitext( os.path.basename( fn ) )[0]
+        columns[name] = np.load( fn, mmap_mode='r' )
+    with open( os.path.join( doneDir, 'interactions.json' ) ) as f:
+        columns['interactions'] = json.load( f )
+    with open( os.path.join( doneDir, 'meta.json' ) ) as f:
+        columns['meta'] = json.load( f )
+    return columns
+
+
+def loadParticipantColumns( directory, outputPrefix="../FramesDataset/" ):
+    # Every completed video of participant directory (e.g., 'P_01'): video filename -> columns.
+    # outputPrefix as in frameExtraction.py; not imported from there, so reading doesn't need OpenCV
+    videos = {}
+    for doneDir in sorted( glob.glob( outputPrefix + directory + '_*_' + columnsDoneName ) ):
+        columns = loadVideoColumns( doneDir )
+        videos[columns['meta']['video']] = columns
+    return videos
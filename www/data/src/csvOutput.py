@@ -0,0 +1,74 @@
+import os
+import csv
+import time
+
+
+# CSV File names
+csvTempName = "gazePredictions.csv"
+csvDoneName = "gazePredictionsDone.csv"
+
+##################################################################
+# CSV header object field names
+fmPosKeys = ['fmPos_%04d' % i for i in range(0, 468)]
+eyeFeaturesKeys = ['eyeFeatures_%04d' % i for i in range(0, 120)]
+fieldnames = (['participant','frameImageFile','frameTimeEpoch','frameNum','mouseMoveX','mouseMoveY',
+               'mouseClickX','mouseClickY','keyPressed','keyPressedX','keyPressedY',
+               'tobiiLeftScreenGazeX','tobiiLeftScreenGazeY','tobiiRightScreenGazeX','tobiiRightScreenGazeY',
+               'webGazerX','webGazerY','error','errorPix'])
+fieldnames.extend( fmPosKeys )
+fieldnames.extend( eyeFeaturesKeys )
+
+
+##################################################################
+# Buffered CSV output for one video
+#
+# Rows are 600+ quoted columns, and there is one per video frame. Rather than reopening the
+# file and building a new csv.DictWriter for every row, keep both for the whole video and
+# hand rows to the OS in batches: every flushRows rows, or when a row arrives more than
+# flushMS milliseconds after the last flush. close( sync=True ) makes sure everything is on
+# disk before the caller renames the file to mark the video as done.
+#
+# The file is opened in append mode on the first row, as writing a row at a time did, so a
+# partial file left behind by an interrupted run is found and restarted in the same way.
+class BufferedCSVWriter:
+
+    def __init__(self, filename, fieldnames, flushRows, flushMS):
+        self.filename = filename
+        self.fieldnames = fieldnames
+        self.flushRows = flushRows
+        self.flushMS = flushMS
+
+        self.f = None
+        self.writer = None
+        self.rowsBuffered = 0
+        self.lastFlush = time.monotonic()
+
+    def __str__(self):
+        return "[BufferedCSVWriter] " + self.filename + " rows buffered: " + str(self.rowsBuffered)
+
+    def writerow(self, row):
+        if self.f is None:
+            # Big enough for a batch of rows, so that we decide when data goes to the OS
+            self.f = open( self.filename, 'a', newline='', buffering=1<<20 )
+            self.writer = csv.DictWriter( self.f, fieldnames=self.fieldnames, delimiter=',', quoting=csv.QUOTE_ALL )
+
+        self.writer.writerow( row )
+        self.rowsBuffered = self.rowsBuffered + 1
+        if self.rowsBuffered >= self.flushRows or (time.monotonic() - self.lastFlush) * 1000 >= self.flushMS:
+            self.flush()
+
+    def flush(self):
+        if self.f is not None:
+            self.f.flush()
+        self.rowsBuffered = 0
+        self.lastFlush = time.monotonic()
+
+    def close(self, sync=False):
+        if self.f is None:
+            return
+        self.flush()
+        if sync:
+            os.fsync( self.f.fileno() )
+        self.f.close()
+        self.f = None
+        self.writer = None
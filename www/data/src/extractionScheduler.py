@@ -0,0 +1,167 @@
+import time
+
+from participant import ParticipantData
+
+
+##################################################################
+# Per-connection extraction state
+#
+# One of these per connected browser worker, instead of module globals, so that any
+# number of workers can extract at once without trampling each other.
+class ExtractionSession:
+    wsh = None                  # The WebSocketHandler this session talks through
+    pipelineWindow = 1          # Frames in flight; see webgazerExtractServer.py
+    frameCache = None           # frameCache.FrameCache of frames read ahead for this worker
+    transport = None            # frameTransport.FrameTransport: how frames are sent to this worker
+
+    participant = None          # ParticipantData of the leased unit
+    videoIndex = -1             # Index into participant.videos of the leased unit
+    leaseTime = 0               # time.monotonic() when the lease was last renewed
+
+    # Current state of eye tracking for this worker
+    tobiiCurrentX = 0
+    tobiiCurrentY = 0
+    wgCurrentX = 0
+    wgCurrentY = 0
+
+    # Next event of participant.interactions to write out, as the client's logsCount was
+    interactionPos = 0
+
+    # Frame number -> time.perf_counter() when it was sent, until its result comes back
+    frameSentTimes = None
+
+    def __init__(self, wsh, pipelineWindow):
+        self.wsh = wsh
+        self.pipelineWindow = pipelineWindow
+        self.frameSentTimes = {}
+
+    def __str__(self):
+        return "[ExtractionSession] " + str(self.wsh.request.remote_ip) + " " + str(self.unitName())
+
+    def hasLease(self):
+        return self.participant is not None and self.videoIndex >= 0
+
+    def video(self):
+        return self.participant.videos[self.videoIndex]
+
+    def unitName(self):
+        if not self.hasLease():
+            return "(no lease)"
+        return self.participant.directory + '/' + self.video().filename
+
+
+##################################################################
+# Shared work queue
+#
+# Hands out (participant, video) units to sessions. A participant is held by one session at
+# a time and its videos are handed out in log order, because WebGazer's regression keeps
+# training across a participant's videos. Different participants go to different sessions.
+#
+# A unit is leased: the session renews it as results come in. If the socket drops, or the
+# lease isn't renewed within leaseTimeout seconds, the unit goes back to the front of its
+# participant's queue and the participant can be picked up by any other session.
+class ExtractionScheduler:
+
+    def __init__(self, participantDirList, leaseTimeout):
+        self.unloadedDirs = list( participantDirList )
+        self.leaseTimeout = leaseTimeout
+
+        self.participants = {}      # directory -> ParticipantData, loaded and not yet finished
+        self.pendingVideos = {}     # directory -> video indices not yet handed out, in order
+        self.holders = {}           # directory -> session currently holding that participant
+        self.leases = set()         # sessions with a unit leased
+        self.idleSessions = set()   # sessions that asked for work when there wasn't any
+
+    def acquire(self, session):
+        # Lease the next unit to session; False if there isn't one right now
+        self.idleSessions.discard( session )
+
+        p = session.participant
+        if p is not None and self.holders.get( p.directory ) is session and len(self.pendingVideos[p.directory]) > 0:
+            # Keep going with the participant we have
+            return self.lease( session, p, self.pendingVideos[p.directory].pop(0) )
+
+        # Done with that participant (or never had one); let go of it
+        self.releaseHold( session )
+
+        # Prefer participants that are already loaded but were let go of, e.g., after a dropped socket
+        for d, videos in self.pendingVideos.items():
+            if d not in self.holders and len(videos) > 0:
+                return self.lease( session, self.participants[d], videos.pop(0) )
+
+        # Otherwise load the next participant from disk
+        while len(self.unloadedDirs) > 0:
+            p = ParticipantData( self.unloadedDirs.pop(0) )
+            p.loadParticipantData()
+            if len(p.videos) == 0:
+                print( "    No videos to process for " + p.directory + "; skipping..." )
+                continue
+            self.participants[p.directory] = p
+            self.pendingVideos[p.directory] = list( range(1, len(p.videos)) )
+            return self.lease( session, p, 0 )
+
+        session.participant = None
+        session.videoIndex = -1
+        self.idleSessions.add( session )
+        return False
+
+    def lease(self, session, p, videoIndex):
+        self.holders[p.directory] = session
+        self.leases.add( session )
+        session.participant = p
+        session.videoIndex = videoIndex
+        p.videosPos = videoIndex
+        self.renew( session )
+        print( "Leased " + session.unitName() + " to " + str(session.wsh.request.remote_ip) )
+        return True
+
+    def renew(self, session):
+        session.leaseTime = time.monotonic()
+
+    def complete(self, session):
+        # The session has finished (or skipped) its unit
+        if session not in self.leases:
+            return
+        self.leases.discard( session )
+        session.videoIndex = -1
+        self.forgetIfFinished( session.participant )
+
+    def release(self, session):
+        # The session is going away: put its unit back and let go of its participant
+        self.idleSessions.discard( session )
+        if session in self.leases:
+            self.leases.discard( session )
+            d = session.participant.directory
+            print( "    Lease on " + session.unitName() + " released; it will be reassigned" )
+            self.pendingVideos[d].insert( 0, session.videoIndex )
+            session.videoIndex = -1
+        self.releaseHold( session )
+        session.participant = None
+        self.wakeIdleSessions()
+
+    def releaseHold(self, session):
+        p = session.participant
+        if p is not None and self.holders.get( p.directory ) is session:
+            del self.holders[p.directory]
+            self.forgetIfFinished( p )
+
+    def forgetIfFinished(self, p):
+        # Drop a participant's data once every one of its videos is done
+        d = p.directory
+        if d in self.pendingVideos and len(self.pendingVideos[d]) == 0 and not any( s.participant is p for s in self.leases ):
+            del self.pendingVideos[d]
+            del self.participants[d]
+            self.holders.pop( d, None )
+
+    def expireLeases(self):
+        # Sessions whose lease has not been renewed in time; the caller closes them
+        now = time.monotonic()
+        return [s for s in self.leases if now - s.leaseTime > self.leaseTimeout]
+
+    def wakeIdleSessions(self):
+        for s in list( self.idleSessions ):
+            s.wsh.startNextUnit()
+
+    def allDone(self):
+        return len(self.unloadedDirs) == 0 and len(self.leases) == 0 and \
+            all( len(v) == 0 for v in self.pendingVideos.values() )
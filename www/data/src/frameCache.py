@@ -0,0 +1,85 @@
+import asyncio
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from videoProcessing import readImageRGBA
+
+
+##################################################################
+# Read-ahead of extracted frames
+#
+# Reading and converting a frame .png takes a few milliseconds. Done in sendVideoFrame, that is
+# on the IOLoop thread, where it holds up every other connection and adds disk latency to each
+# round trip. Instead, the next few frames of a video are decoded on a thread pool into ready-to-send
+# RGBA bytes, so that by the time a frame is due the IOLoop only has to send it.
+
+# Shared by every connection; created on first use
+decodePool = None
+
+def getDecodePool( threads ):
+    global decodePool
+    if decodePool is None:
+        decodePool = ThreadPoolExecutor( max_workers=threads, thread_name_prefix='frameDecode' )
+    return decodePool
+
+
+def decodeFrame( filename ):
+    # Runs on a decode thread. readImageRGBA's buffer is per thread, so copy it out before returning.
+    return readImageRGBA( filename ).tobytes()
+
+
+# One per connection. Frames are keyed by file name; each entry is a Future for its RGBA bytes,
+# or whatever loadFrame makes of the file (see frameTransport.FrameTransport.loadFrame).
+# A frame is handed over (and dropped) when it is sent. If the cache fills up, e.g., with frames
+# left over from a video that was abandoned, the least recently used entries are evicted first.
+class FrameCache:
+
+    def __init__(self, readAhead, threads, loadFrame=decodeFrame):
+        self.readAhead = readAhead
+        self.loadFrame = loadFrame
+        self.pool = getDecodePool( threads )
+        self.frames = collections.OrderedDict()     # filename -> Future
+
+        self.hits = 0           # Frame was already decoded when it was needed
+        self.waits = 0          # Frame was being decoded when it was needed
+        self.misses = 0         # Frame had not been asked for; decoded on demand
+
+    def __str__(self):
+        return "[FrameCache] hits: " + str(self.hits) + " waits: " + str(self.waits) + " misses: " + str(self.misses) + \
+            " cached: " + str(len(self.frames))
+
+    def prefetch(self, frameFilesList, start):
+        # Queue up decoding of the readAhead frames from start on
+        for fn in frameFilesList[start:start+self.readAhead]:
+            if fn in self.frames:
+                self.frames.move_to_end( fn )
+                continue
+            self.frames[fn] = self.pool.submit( self.loadFrame, fn )
+            self.evict()
+
+    def evict(self):
+        while len(self.frames) > self.readAhead:
+            fn, future = self.frames.popitem( last=False )
+            future.cancel()
+
+    async def get(self, fn):
+        # Bytes of frame fn, from the cache if we can
+        future = self.frames.pop( fn, None )
+        if future is None or future.cancelled():
+            self.misses = self.misses + 1
+            future = self.pool.submit( self.loadFrame, fn )
+        elif future.done():
+            self.hits = self.hits + 1
+        else:
+            self.waits = self.waits + 1
+        return await asyncio.wrap_future( future )
+
+    def clear(self):
+        for future in self.frames.values():
+            future.cancel()
+        self.frames.clear()
+
+    def resetStats(self):
+        self.hits = 0
+        self.waits = 0
+        self.misses = 0
@@ -0,0 +1,218 @@
+import os
+import time
+import asyncio
+import subprocess
+import numpy as np
+
+import tornado.ioloop
+import tornado.iostream
+import tornado.process
+
+from ptsIndex import ptsIndexFile,loadPtsIndex,framePts
+from cacheFiles import saveArray
+
+# Where are we putting the output?
+outputPrefix = "../FramesDataset/"
+
+# Video frame extraction parameters
+frameExtractFormat = "frame_{:08d}.png"
+frameOutFormat = "frame_{:08d}_{:08d}.png"
+
+# Written into a video's frame directory once all of its frames are extracted and renamed
+framesDoneName = "framesExtracted.txt"
+
+# Frame number -> timestamp (ms into the video) of every frame in a video's frame directory,
+# written with it. The frame's file is outDir + frameOutFormat.format( frameNum, pts ).
+manifestName = "frameManifest.npy"
+manifestDtype = np.dtype([('frameNum', np.int64), ('pts', np.int64)])
+
+
+def videoFramesDir( directory, filename ):
+    # e.g., ../FramesDataset/P_01/1491423217564_1491423217564_writing.webm_frames/
+    return outputPrefix + directory + '/' + filename + "_frames" + '/'
+
+def framesExtracted( outDir ):
+    return os.path.isfile( outDir + '/' + framesDoneName )
+
+
+def videoPtsFile( directory, filename ):
+    return ptsIndexFile( outputPrefix, directory, filename )
+
+
+##################################################################
+# Frame manifests
+#
+def writeFrameManifest( outDir, framePts ):
+    manifest = np.empty( len(framePts), dtype=manifestDtype )
+    manifest['frameNum'] = np.arange( len(framePts) )
+    manifest['pts'] = framePts
+    saveArray( outDir + manifestName, manifest )
+    return manifest
+
+def manifestFromFrameFiles( outDir ):
+    # For frame directories extracted before there were manifests: one listing, parsing each
+    # "frame_{:08d}_{:08d}.png" name, sorted by frame number
+    frames = []
+    for entry in os.scandir( outDir ):
+        fn = entry.name
+        if fn.startswith( 'frame_' ) and fn.endswith( '.png' ) and len(fn) == len(frameOutFormat.format(0, 0)):
+            frames.append( (int(fn[6:14]), int(fn[15:23])) )
+    return np.array( sorted( frames ), dtype=manifestDtype )
+
+def loadFrameManifest( outDir ):
+    # The manifest of an extracted video, memory-mapped; made from the frame files if there isn't
+    # a readable one
+    manifestFile = outDir + manifestName
+    if os.path.isfile( manifestFile ):
+        try:
+            manifest = np.load( manifestFile, mmap_mode='r' )
+            if manifest.dtype == manifestDtype:
+                return manifest
+        except (OSError, ValueError) as e:
+            print( "    Could not read frame manifest " + manifestFile + " (" + str(e) + "); listing the frames again..." )
+
+    manifest = manifestFromFrameFiles( outDir )
+    try:
+        saveArray( manifestFile, manifest )
+    except OSError as e:
+        print( "    Could not write frame manifest " + manifestFile + ": " + str(e) )
+    return manifest
+
+
+# Frame file names of an extracted video, made from its manifest as they are needed
+# rather than listed up front. Indexes (and slices) like the list of names would.
+class FrameFiles:
+
+    def __init__(self, outDir, manifest):
+        self.outDir = outDir
+        self.manifest = manifest
+
+    def __len__(self):
+        return len(self.manifest)
+
+    def __getitem__(self, i):
+        if isinstance( i, slice ):
+            return [self.name( r ) for r in self.manifest[i]]
+        return self.name( self.manifest[i] )
+
+    def name(self, record):
+        return self.outDir + frameOutFormat.format( int(record['frameNum']), int(record['pts']) )
+
+
+def extractCommand( video, outDir, options=[] ):
+    # -vsync 0 (passthrough) so that every frame is written out exactly once, in the order of the index
+    return ['ffmpeg', '-nostdin', '-i', './' + video, '-vsync', '0'] + options + [outDir + 'frame_%08d.png']
+
+
+def finishExtraction( video, outDir, pts, framerate ):
+    # Once ffmpeg has written frame_%08d.png: name the frames by frame number and timestamp, and
+    # write the manifest and the done marker. Returns the number of frames; 0 if there are none.
+    nFrames = sum( 1 for fn in os.listdir( outDir ) if fn.endswith( '.png' ) )
+    if nFrames == 0:
+        return 0
+    if nFrames != len(pts):
+        print( "    " + video + ": " + str(nFrames) + " frames extracted, but " + str(len(pts)) + " in its PTS index" )
+
+    # Rename the files based on their frame number and timestamp
+    allPts = []
+    prev = 0
+    for i in range(0, nFrames):
+        prev = framePts( pts, framerate, i, prev )
+        allPts.append( prev )
+        inputFile = outDir + frameExtractFormat.format(i+1) # Catch that the output framenumbers from extraction start from 1 and not 0
+        outputFile = outDir + frameOutFormat.format(i, prev)
+        os.rename( inputFile, outputFile )
+
+    writeFrameManifest( outDir, allPts )
+
+    with open( outDir + '/' + framesDoneName, 'w' ) as f:
+        f.write( "Done." )
+
+    return nFrames
+
+
+# video = participant directory + '/' + video filename, relative to the dataset directory
+# Returns the number of frames extracted; 0 if something went wrong.
+# Plain function of its arguments, so it can run in a worker process (see preExtractFrames.py).
+def extractVideoFrames( video, outDir, indexFile ):
+
+    if not os.path.isdir( outDir ):
+        os.makedirs( outDir )
+
+    # Collect the timestamps of the video frames, from the video's PTS index
+    pts, framerate = loadPtsIndex( video, indexFile )
+
+    subprocess.run( extractCommand( video, outDir ), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL )
+
+    return finishExtraction( video, outDir, pts, framerate )
+
+
+##################################################################
+# Frame extraction on the server's IOLoop
+#
+# extractVideoFrames, without blocking: ffmpeg runs as a child process whose -progress output
+# is read as it comes, and the PTS probe and the renaming run on the default executor. Every
+# listener is called with (frames done, frames total, ETA in seconds) about twice a second, so
+# the server can keep clients informed. One extraction per frames directory; anyone else who
+# needs the same video waits on it rather than starting another ffmpeg over the same files.
+class FrameExtraction:
+
+    def __init__(self, video, outDir, indexFile):
+        self.video = video
+        self.outDir = outDir
+        self.indexFile = indexFile
+
+        self.listeners = []
+        self.framesDone = 0
+        self.framesTotal = -1       # Unknown until the PTS index is loaded
+        self.startTime = None
+        self.process = None
+        self.future = None
+
+    def __str__(self):
+        return "[FrameExtraction] " + self.video + " frames: " + str(self.framesDone) + "/" + str(self.framesTotal)
+
+    def start(self):
+        # Returns the future of the number of frames extracted
+        if self.future is None:
+            self.future = asyncio.ensure_future( self.run() )
+        return self.future
+
+    def eta(self):
+        # Seconds to go, going by the rate so far; -1 if we can't tell yet
+        if self.framesDone == 0 or self.framesTotal < 0 or self.startTime is None:
+            return -1
+        elapsed = time.monotonic() - self.startTime
+        return max( elapsed / self.framesDone * (self.framesTotal - self.framesDone), 0 )
+
+    def report(self):
+        for listener in list( self.listeners ):
+            listener( self.framesDone, self.framesTotal, self.eta() )
+
+    async def run(self):
+        ioloop = tornado.ioloop.IOLoop.current()
+        if not os.path.isdir( self.outDir ):
+            os.makedirs( self.outDir )
+
+        pts, framerate = await ioloop.run_in_executor( None, loadPtsIndex, self.video, self.indexFile )
+        self.framesTotal = len(pts)
+        self.startTime = time.monotonic()
+        self.report()
+
+        # -progress writes blocks of key=value lines, each ending with progress=continue (or end)
+        self.process = tornado.process.Subprocess( extractCommand( self.video, self.outDir, ['-progress', 'pipe:1', '-nostats'] ),
+            stdin=subprocess.DEVNULL, stdout=tornado.process.Subprocess.STREAM, stderr=subprocess.DEVNULL )
+        try:
+            while True:
+                l = await self.process.stdout.read_until( b'\n' )
+                key, _, value = l.decode( 'ascii', 'replace' ).strip().partition( '=' )
+                if key == "frame" and value.isdigit():
+                    self.framesDone = int(value)
+                elif key == "progress":
+                    self.report()
+        except tornado.iostream.StreamClosedError:
+            pass
+        await self.process.wait_for_exit( raise_error=False )
+        self.process = None
+
+        return await ioloop.run_in_executor( None, finishExtraction, self.video, self.outDir, pts, framerate )
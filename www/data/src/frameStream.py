@@ -0,0 +1,127 @@
+import re
+import queue
+import subprocess
+import threading
+
+from ptsIndex import framePts
+
+
+##################################################################
+# Decoded frames straight from ffmpeg
+#
+# Instead of ffmpeg -> PNG files on disk -> cv2.imread -> RGBA, ffmpeg writes raw RGBA frames
+# to a pipe, which we cut into frames and hand over through a bounded buffer. The frame
+# timestamps come from the video's PTS index (ptsIndex.py).
+#
+# Frame 0 is available as soon as it is decoded. When the buffer is full, ffmpeg blocks on the
+# pipe, so decoding never runs more than maxBufferedFrames ahead of the WebSocket.
+class FfmpegFrameStream:
+
+    def __init__(self, videoFile, maxBufferedFrames, pts, framerate):
+        self.videoFile = videoFile
+        self.frames = queue.Queue( maxsize=maxBufferedFrames )
+        self.pts = pts                  # ms into the video of each frame
+        self.framerate = framerate
+
+        # Filled in from stderr
+        self.width = -1
+        self.height = -1
+        self.stderrDone = False
+        self.info = threading.Condition()
+
+        self.prevPts = 0
+        self.closed = False
+
+        # -vsync 0 (passthrough) so that every decoded frame is written out exactly once,
+        # in the order of the PTS index
+        self.process = subprocess.Popen( ['ffmpeg', '-nostdin', '-i', './' + videoFile, '-vsync', '0',
+                                          '-f', 'rawvideo', '-pix_fmt', 'rgba', '-'],
+                                         stdout=subprocess.PIPE, stderr=subprocess.PIPE )
+
+        self.stderrThread = threading.Thread( target=self.readStderr, daemon=True )
+        self.stdoutThread = threading.Thread( target=self.readFrames, daemon=True )
+        self.stderrThread.start()
+        self.stdoutThread.start()
+
+    def readStderr(self):
+        # Only the frame size is needed, but keep reading so that ffmpeg never blocks on stderr
+        sizeRegex = re.compile( r'Video: .*?\b(\d{2,5})x(\d{2,5})\b' )
+        for line in self.process.stderr:
+            if self.width < 0:
+                m = sizeRegex.search( line.decode( 'utf-8', errors='replace' ) )
+                if m is not None:
+                    with self.info:
+                        self.width = int(m.group(1))
+                        self.height = int(m.group(2))
+                        self.info.notify_all()
+
+        with self.info:
+            self.stderrDone = True
+            self.info.notify_all()
+
+    def readFrames(self):
+        # Wait until ffmpeg has told us how big a frame is
+        with self.info:
+            while self.width < 0 and not self.stderrDone:
+                self.info.wait()
+        if self.width < 0:
+            print( "    Error: could not find the frame size of " + self.videoFile )
+            self.put( None )
+            return
+
+        frameBytes = self.width * self.height * 4
+        frameNum = 0
+        while not self.closed:
+            rgba = self.readExactly( frameBytes )
+            if rgba is None:
+                break
+            self.put( (frameNum, self.framePts( frameNum ), rgba) )
+            frameNum = frameNum + 1
+
+        self.put( None )
+
+    def readExactly(self, n):
+        chunks = []
+        remaining = n
+        while remaining > 0:
+            chunk = self.process.stdout.read( remaining )
+            if not chunk:
+                return None
+            chunks.append( chunk )
+            remaining = remaining - len(chunk)
+        return chunks[0] if len(chunks) == 1 else b''.join( chunks )
+
+    def framePts(self, frameNum):
+        self.prevPts = framePts( self.pts, self.framerate, frameNum, self.prevPts )
+        return self.prevPts
+
+    def put(self, item):
+        # Blocks while the buffer is full; gives up if the stream was closed in the meantime
+        while not self.closed:
+            try:
+                self.frames.put( item, timeout=0.5 )
+                return
+            except queue.Full:
+                pass
+
+    def nextFrame(self):
+        # Blocking. (frameNum, pts in ms, RGBA bytes), or None when the video has no more frames
+        while True:
+            try:
+                return self.frames.get( timeout=0.5 )
+            except queue.Empty:
+                if self.closed:
+                    return None
+
+    def close(self):
+        self.closed = True
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+
+        # Drop any frames still buffered
+        try:
+            while True:
+                self.frames.get_nowait()
+        except queue.Empty:
+            pass
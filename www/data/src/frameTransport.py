@@ -0,0 +1,141 @@
+import time
+import zlib
+
+import cv2
+import numpy as np
+
+from videoProcessing import readImageRGBA
+from metrics import serverMetrics
+
+
+##################################################################
+# How video frames go over the WebSocket
+#
+# A raw RGBA frame is width x height x 4 bytes (1.2 MB at 640x480), which is fine on localhost
+# but caps a browser worker on another machine at link speed. Each connection picks a transport
+# with ws://.../websocket?transport=<mode>:
+#
+#   raw      RGBA bytes, as always (the default)
+#   png      the extracted .png file, straight from disk; streamed frames are encoded to PNG.
+#            Lossless; the browser decodes it
+#   jpeg     JPEG at jpegQuality; lossy, so WebGazer sees slightly different frames
+#   webp     WebP at webpQuality; lossy, as jpeg
+#   deflate  RGBA bytes, compressed by the WebSocket itself (permessage-deflate)
+#   delta    each frame XORed with the one before it on this connection, then zlib compressed.
+#            Lossless; most of a webcam frame doesn't change from one frame to the next
+#
+# The msgID 2 message of every frame says how its binary message is encoded ('encoding'), and for
+# delta, whether the frame is a key frame (XORed with nothing) that the client restarts from.
+transportModes = ['raw', 'png', 'jpeg', 'webp', 'deflate', 'delta']
+defaultTransport = 'raw'
+
+jpegQuality = 90
+webpQuality = 90
+# zlib level for delta frames; speed matters more than the last few percent
+deltaCompressionLevel = 1
+# permessage-deflate level for the deflate transport
+deflateCompressionLevel = 6
+
+
+def readFileBytes( filename ):
+    with open( filename, 'rb' ) as f:
+        return f.read()
+
+
+# One per connection
+class FrameTransport:
+
+    def __init__(self, mode):
+        self.mode = mode
+        self.prevFrame = None           # delta: the last frame sent, as a uint8 array
+        self.pendingFrame = None        # delta: the frame last encoded, until it is sent
+
+        # Metrics, since the start of the current video
+        self.framesSent = 0
+        self.bytesSent = 0
+        self.startTime = time.monotonic()
+
+    def __str__(self):
+        elapsed = time.monotonic() - self.startTime
+        bytesPerFrame = self.bytesSent / self.framesSent if self.framesSent > 0 else 0
+        fps = self.framesSent / elapsed if elapsed > 0 else 0
+        # For deflate, bytes are counted before the WebSocket compresses them
+        return "[FrameTransport] " + self.mode + " frames: " + str(self.framesSent) + \
+            " bytes/frame: {:.0f} fps: {:.2f}".format( bytesPerFrame, fps )
+
+    def resetStats(self):
+        self.framesSent = 0
+        self.bytesSent = 0
+        self.startTime = time.monotonic()
+
+    def reset(self):
+        # New video; the next delta frame is a key frame
+        self.prevFrame = None
+        self.pendingFrame = None
+
+    def compressionOptions(self):
+        # For WebSocketHandler.get_compression_options; None turns compression off
+        if self.mode == 'deflate':
+            return {'compression_level': deflateCompressionLevel}
+        return None
+
+    def encoding(self):
+        # What the binary message holds, for the client
+        if self.mode in ('png', 'jpeg', 'webp', 'delta'):
+            return self.mode
+        return 'rgba'
+
+    ##############################################################
+    # Runs on the frame cache's decode threads (frameCache.py): ready-to-send bytes of an extracted frame.
+    # For delta, the RGBA bytes that deltaEncode works from.
+    def loadFrame(self, filename):
+        if self.mode == 'png':
+            with serverMetrics.timed( 'pngRead' ):
+                return readFileBytes( filename )
+        if self.mode in ('jpeg', 'webp'):
+            with serverMetrics.timed( 'pngRead' ):
+                bgr = cv2.imread( filename )
+            return self.encodeImage( bgr )
+        # readImageRGBA's buffer is per thread, so copy it out before returning
+        return readImageRGBA( filename ).tobytes()
+
+    # Also on a worker thread: the same, for an RGBA frame streamed from ffmpeg
+    def encodeRGBA(self, rgba, width, height):
+        if self.mode in ('png', 'jpeg', 'webp'):
+            with serverMetrics.timed( 'rgbaConvert' ):
+                bgr = cv2.cvtColor( np.frombuffer( rgba, dtype=np.uint8 ).reshape( height, width, 4 ), cv2.COLOR_RGBA2BGR )
+            return self.encodeImage( bgr )
+        return rgba
+
+    def encodeImage(self, bgr):
+        with serverMetrics.timed( 'encode' ):
+            if self.mode == 'jpeg':
+                _, data = cv2.imencode( '.jpg', bgr, [cv2.IMWRITE_JPEG_QUALITY, jpegQuality] )
+            elif self.mode == 'webp':
+                _, data = cv2.imencode( '.webp', bgr, [cv2.IMWRITE_WEBP_QUALITY, webpQuality] )
+            else:
+                _, data = cv2.imencode( '.png', bgr )
+            return data.tobytes()
+
+    ##############################################################
+    # Frames go out in order, so delta encoding happens as each one is sent (on a worker thread,
+    # one at a time). Returns (bytes to send, whether this is a key frame). The frame only becomes
+    # the one the next is XORed with once sent() says it went out; if the send is abandoned (the
+    # lease was lost, the socket closed), the client never had it.
+    def deltaEncode(self, rgba):
+        with serverMetrics.timed( 'encode' ):
+            frame = np.frombuffer( rgba, dtype=np.uint8 )
+            keyFrame = self.prevFrame is None or len(self.prevFrame) != len(frame)
+            if keyFrame:
+                delta = frame
+            else:
+                delta = np.bitwise_xor( frame, self.prevFrame )
+            self.pendingFrame = frame
+            return zlib.compress( delta, deltaCompressionLevel ), keyFrame
+
+    def sent(self, nBytes):
+        if self.pendingFrame is not None:
+            self.prevFrame = self.pendingFrame
+            self.pendingFrame = None
+        self.framesSent = self.framesSent + 1
+        self.bytesSent = self.bytesSent + nBytes
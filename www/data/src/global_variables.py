@@ -1,25 +1,29 @@
 def init():
-    global tobiiCurrentX, tobiiCurrentY
-    global participant
     global writeScreenCapVideo, useAaronCircles
-    global wgCurrentX, wgCurrentY
     global pctFile
-    global participantPos, participantDirList
+    global participantDirList
     global onlyWritingVideos
+    global leaseTimeoutSeconds, scheduler
+    global streamFramesFromFfmpeg, streamBufferFrames
+    global prefetchFrames, prefetchThreads
     # Options
     
     onlyWritingVideos = True    # Only process videos where the participant is asked to write into a text field
     writeScreenCapVideo = False
     useAaronCircles = False
 
-    # global_variables for current state of eye tracking
-    tobiiCurrentX = 0
-    tobiiCurrentY = 0
-    wgCurrentX = 0
-    wgCurrentY = 0
+    # Send frames to the client as ffmpeg decodes them, rather than extracting every frame to a .png first.
+    # No frame images are written; the frameImageFile column names the file extraction would have made.
+    streamFramesFromFfmpeg = False
+    streamBufferFrames = 32     # Decoded frames held in memory ahead of the client
 
+    # Extracted frames are read and converted to RGBA on a thread pool, this many frames ahead of the one being sent
+    prefetchFrames = 16
+    prefetchThreads = 4
 
-    # Which participant are we on?
+    # A browser worker that sends nothing back for this long loses its (participant, video) unit
+    leaseTimeoutSeconds = 300
+
+    # Which participants are there? Per-connection state lives in extractionScheduler.ExtractionSession
     participantDirList = []
-    participantPos = -1
-    participant = []
+    scheduler = None
@@ -0,0 +1,118 @@
+import json
+import numpy as np
+
+
+##################################################################
+# WebGazer input log, <startTimestamp>.json
+#
+# A JSON array of events: browser window parameters, 'recording start' for each video, and the
+# participant's mouse moves, clicks and text input. Long sessions have a lot of events, so the
+# array is read one event at a time rather than loaded whole; only the events we need are kept.
+def iterInputLog( inputLogFile, chunkSize=1<<16 ):
+    # Yields the events of the array in order
+    decoder = json.JSONDecoder()
+    with open( inputLogFile, 'r' ) as f:
+        buf = ''
+        pos = 0
+        eof = False
+        while True:
+            # Skip to the next event
+            while pos < len(buf) and buf[pos] in ' \t\r\n,[':
+                pos = pos + 1
+            if pos < len(buf) and buf[pos] == ']':
+                return
+
+            event = None
+            if pos < len(buf):
+                try:
+                    event, end = decoder.raw_decode( buf, pos )
+                except ValueError:
+                    # The event runs past what we have read so far (or the log is broken)
+                    if eof:
+                        raise
+            if event is not None:
+                pos = end
+                yield event
+                continue
+
+            if eof:
+                return
+            chunk = f.read( chunkSize )
+            eof = len(chunk) == 0
+            buf = buf[pos:] + chunk
+            pos = 0
+
+
+##################################################################
+# Interaction table
+#
+# Mouse moves, mouse clicks and key presses in log order (which is time order), one record per
+# event, with positions in client pixels. keysPressed holds the key for each key press, in order.
+interactionMouseMove = 0
+interactionMouseClick = 1
+interactionKeyPress = 2
+
+interactionDtype = np.dtype([('epoch', np.int64),           # Unix milliseconds
+                             ('kind', np.int8),             # interactionMouseMove, ...
+                             ('x', np.float64),             # clientX, or pos.left for text input
+                             ('y', np.float64)])            # clientY, or pos.top for text input
+
+
+# Thanks to http://jsfiddle.net/d4rcuxw9/1/, as in webgazerExtractClient.js
+def getStringDifference( a, b ):
+    i = 0
+    result = ""
+    for j in range(0, len(b)):
+        if i >= len(a) or a[i] != b[j]:
+            result += b[j]
+        else:
+            i = i + 1
+    return result
+
+
+def keyPressedBetween( text, nextText ):
+    # There is a bug in the data collection, where the value of .text is 'one event behind',
+    # so the key pressed is what the next textInput event's text adds to this one's.
+    if nextText is None:
+        # We've run out of events and not found a next textInput event.
+        return "Unknown"
+    if len(nextText) > len(text):
+        return getStringDifference( text, nextText )
+    # The new text is _shorter_ than the old text, which means the user must have pressed backspace
+    # at some point _after_ this. 'Backspace' as a key isn't logged, so it is 'Unknown'
+    return "Unknown"
+
+
+def parseInputLog( inputLogFile ):
+    # One pass over the log. Returns (window, videos, interactions, keysPressed):
+    # window = the first browser window parameters event, or None
+    # videos = (video filename, start epoch) of every 'recording start' event
+    window = None
+    videos = []
+    records = []
+    keysPressed = []
+    prevText = None             # Text of the last textInput event, waiting for the next one
+
+    for l in iterInputLog( inputLogFile ):
+        t = l.get("type")
+        if window is None and l.get('windowX') != None:
+            window = {k: int(l[k]) for k in ['windowX','windowY','windowInnerWidth','windowInnerHeight','windowOuterWidth','windowOuterHeight']}
+        if t == "recording start":
+            fn = l.get("sessionString")
+            fn = fn.replace('/', '-') + '.webm'
+            videos.append( (fn, l.get("epoch")) )
+        elif t == "mousemove":
+            records.append( (l['epoch'], interactionMouseMove, l['clientX'], l['clientY']) )
+        elif t == "mouseclick":
+            records.append( (l['epoch'], interactionMouseClick, l['clientX'], l['clientY']) )
+        elif t == "textInput":
+            if prevText is not None:
+                keysPressed.append( keyPressedBetween( prevText, l['text'] ) )
+            records.append( (l['epoch'], interactionKeyPress, l['pos']['left'], l['pos']['top']) )
+            prevText = l['text']
+
+    if prevText is not None:
+        keysPressed.append( keyPressedBetween( prevText, None ) )
+
+    interactions = np.array( records, dtype=interactionDtype )
+    return window, videos, interactions, keysPressed
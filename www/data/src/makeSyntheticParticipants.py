@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# Make a small synthetic dataset with the layout loadParticipantData expects, for benchmarks and
+# for trying the pipeline without the real ETRA2018 data.
+#
+# For each participant P_01, P_02, ...:
+#   participant_characteristics.csv   one row per participant (a Laptop, 1440x900)
+#   P_XX/<start>.json                 input log: window parameters, 'recording start' for each video,
+#                                     mouse moves, clicks and text input
+#   P_XX/P_XX.txt                     Tobii log, one JSON sample per line, at the given rate
+#   P_XX/<start>_N_-study-<name>.webm webcam videos (ffmpeg's testsrc2 pattern, VP8)
+#
+# Everything but the video content comes from a seeded random generator, so the same arguments
+# always make the same dataset. The dataset directory is marked with synthetic.txt, which
+# benchmarkExtraction.py looks for before it clears any outputs.
+#
+# Usage:
+# > python makeSyntheticParticipants.py <dataset directory> [participants] [seconds per video] [Tobii Hz] [webcam fps]
+import os
+import sys
+import csv
+import json
+import shutil
+import subprocess
+
+import numpy as np
+
+
+syntheticMarker = "synthetic.txt"
+
+# The study's pages, in order; the extract server only processes dot_test, dot_test_final and *_writing by default
+videoNames = ['dot_test_instructions', 'dot_test', 'fitts_law', 'benefits_of_running_writing', 'dot_test_final']
+
+pctHeader = ['Participant ID', 'Participant Log ID', 'Date', 'Setting', 'Display Width (pixels)', 'Display Height (pixels)',
+             'Screen Width (cm)', 'Screen Height (cm)', 'Distance From Screen (cm)', 'Screen Recording Start Time (Unix milliseconds)',
+             'Screen Recording Start Time (Wall Clock UTC)', 'Gender', 'Age', 'Self-Reported Race', 'Self-Reported Skin Color',
+             'Self-Reported Eye Color', 'Facial Hair', 'Self-Reported Vision', 'Touch Typer', 'Self-Reported Handedness', 'Weather',
+             'Pointing Device', 'Notes', 'Time of day', 'Duration']
+
+screenWidth = 1440
+screenHeight = 900
+windowInnerHeight = 800
+videoWidth = 640
+videoHeight = 480
+
+# Time between the end of one video and the start of the next, ms
+gapMS = 1000
+
+
+def makeVideo( filename, seconds, fps ):
+    # VP8 in WebM, like the browser recordings; fast settings, as the content doesn't matter
+    subprocess.run( ['ffmpeg', '-nostdin', '-v', 'error', '-y', '-f', 'lavfi',
+                     '-i', 'testsrc2=size={}x{}:rate={}:duration={}'.format( videoWidth, videoHeight, fps, seconds ),
+                     '-c:v', 'libvpx', '-b:v', '1M', '-deadline', 'realtime', '-cpu-used', '8', filename], check=True )
+
+
+def inputLogEvents( rng, startTimestamp, sessionPrefix, seconds ):
+    # Window parameters first, then each video's 'recording start' and the interactions during it
+    events = [{'windowX': 0, 'windowY': 0, 'windowInnerWidth': screenWidth, 'windowInnerHeight': windowInnerHeight,
+               'windowOuterWidth': screenWidth, 'windowOuterHeight': screenHeight, 'epoch': startTimestamp}]
+    videos = []
+    t = startTimestamp + gapMS
+    text = ""
+    for n, name in enumerate( videoNames ):
+        events.append( {'type': "recording start", 'sessionString': sessionPrefix + str(n + 1) + "_/study/" + name, 'epoch': t} )
+        videos.append( (sessionPrefix + str(n + 1) + "_-study-" + name + ".webm", t) )
+
+        # About 40 events a second: mostly mouse moves, some clicks, and typing on the writing pages
+        end = t + seconds * 1000
+        e = t + int( rng.integers( 5, 50 ) )
+        while e < end:
+            r = rng.random()
+            if name.endswith( '_writing' ) and r < 0.3:
+                text = text + chr( ord('a') + int( rng.integers( 0, 26 ) ) )
+                events.append( {'type': "textInput", 'text': text, 'pos': {'left': int( 200 + 8 * (len(text) % 100) ), 'top': 300}, 'epoch': e} )
+            elif r < 0.35:
+                events.append( {'type': "mouseclick", 'clientX': int( rng.integers( 0, screenWidth ) ),
+                                'clientY': int( rng.integers( 0, windowInnerHeight ) ), 'epoch': e} )
+            else:
+                events.append( {'type': "mousemove", 'clientX': int( rng.integers( 0, screenWidth ) ),
+                                'clientY': int( rng.integers( 0, windowInnerHeight ) ), 'epoch': e} )
+            e = e + int( rng.integers( 5, 50 ) )
+        events.append( {'type': "recording stop", 'sessionString': sessionPrefix + str(n + 1) + "_/study/" + name, 'epoch': end} )
+        t = end + gapMS
+    return events, videos, t
+
+
+def writeTobiiLog( filename, rng, startTimestamp, endTimestamp, hz ):
+    # A gaze point wandering smoothly over the screen, with a little noise and the odd invalid sample
+    with open( filename, 'w' ) as f:
+        n = int( (endTimestamp - startTimestamp) / 1000.0 * hz )
+        for i in range(0, n):
+            t = startTimestamp / 1000.0 + i / float(hz)
+            x = 0.5 + 0.4 * np.sin( 0.7 * t ) + rng.normal( 0, 0.01 )
+            y = 0.5 + 0.4 * np.sin( 1.1 * t ) + rng.normal( 0, 0.01 )
+            f.write( json.dumps( {'true_time': round( t, 6 ),
+                                  'right_gaze_point_on_display_area': [round( x + 0.01, 5 ), round( y, 5 )],
+                                  'left_gaze_point_on_display_area': [round( x - 0.01, 5 ), round( y, 5 )],
+                                  'right_pupil_validity': int( rng.random() > 0.02 ),
+                                  'left_pupil_validity': int( rng.random() > 0.02 )} ) + '\n' )
+
+
+def makeParticipant( datasetDir, i, rng, seconds, tobiiHz, templateVideo ):
+    directory = "P_{:02d}".format( i )
+    os.makedirs( os.path.join( datasetDir, directory ), exist_ok=True )
+    startTimestamp = 1491423217564 + i * 86400000
+    sessionPrefix = str(startTimestamp) + "_"
+
+    events, videos, endTimestamp = inputLogEvents( rng, startTimestamp, sessionPrefix, seconds )
+    with open( os.path.join( datasetDir, directory, str(startTimestamp) + ".json" ), 'w' ) as f:
+        json.dump( events, f, indent=1 )
+
+    for filename, _ in videos:
+        shutil.copyfile( templateVideo, os.path.join( datasetDir, directory, filename ) )
+
+    writeTobiiLog( os.path.join( datasetDir, directory, directory + ".txt" ), rng, startTimestamp, endTimestamp, tobiiHz )
+
+    return [directory, str(startTimestamp), '4/5/2017', 'Laptop', str(screenWidth), str(screenHeight), '33.17', '20.73', '60',
+            '', '', 'Female', '25', 'Other', '1', 'Dark Brown to Brown', 'None', 'Normal', 'Yes' if i % 2 == 0 else 'No',
+            'Right', 'Indoors', 'Trackpad', 'Synthetic', '12:00', '10:00:00']
+
+
+def main():
+    if len(sys.argv) < 2:
+        print( "Usage: python makeSyntheticParticipants.py <dataset directory> [participants] [seconds per video] [Tobii Hz] [webcam fps]" )
+        sys.exit( 1 )
+    datasetDir = sys.argv[1]
+    participants = int(sys.argv[2]) if len(sys.argv) >= 3 else 2
+    seconds = int(sys.argv[3]) if len(sys.argv) >= 4 else 5
+    tobiiHz = float(sys.argv[4]) if len(sys.argv) >= 5 else 60.0
+    fps = int(sys.argv[5]) if len(sys.argv) >= 6 else 30
+
+    os.makedirs( datasetDir, exist_ok=True )
+    rng = np.random.default_rng( 0 )
+
+    # Every video is a copy of the same one; the extractor treats each as its own
+    templateVideo = os.path.join( datasetDir, "synthetic.webm" )
+    makeVideo( templateVideo, seconds, fps )
+
+    rows = [makeParticipant( datasetDir, i, rng, seconds, tobiiHz, templateVideo ) for i in range(1, participants + 1)]
+    os.remove( templateVideo )
+
+    with open( os.path.join( datasetDir, "participant_characteristics.csv" ), 'w', newline='' ) as f:
+        writer = csv.writer( f )
+        writer.writerow( pctHeader )
+        writer.writerows( rows )
+
+    with open( os.path.join( datasetDir, syntheticMarker ), 'w' ) as f:
+        f.write( "participants: {} seconds per video: {} Tobii Hz: {} fps: {}\n".format( participants, seconds, tobiiHz, fps ) )
+
+    print( "Made " + str(participants) + " synthetic participants in " + datasetDir )
+
+
+if __name__ == '__main__':
+    main()
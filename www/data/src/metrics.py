@@ -0,0 +1,200 @@
+import time
+import threading
+import collections
+
+
+##################################################################
+# Server instrumentation
+#
+# Where does the time go: the browser, the disk or ffmpeg? Every stage of getting a frame to the
+# browser and its result onto disk is timed into a histogram, overall and per (participant, video)
+# unit where we know the unit:
+#
+#   extract      ffmpeg frame extraction of a whole video
+#   pngRead      reading a frame .png (cv2.imread)
+#   rgbaConvert  BGR -> RGBA for the raw, deflate and delta transports
+#   encode       compressing a frame for the png, jpeg, webp and delta transports
+#   send         handing a frame to the WebSocket
+#   roundTrip    from sending a frame to its result coming back from the browser
+#   tobiiAlign   matching a video's frames to Tobii samples
+#   csvWrite     writing a result row
+#
+# Some stages run on the decode threads, so everything here takes a lock.
+# Served as JSON on /metrics (webgazerExtractServer.py).
+#
+# A unit's own numbers are kept while it runs; when it finishes only its summary is kept, for the
+# last finishedUnitsKept of them, so that a server left running doesn't grow without bound. The
+# overall histograms and counters cover everything.
+stageNames = ['extract', 'pngRead', 'rgbaConvert', 'encode', 'send', 'roundTrip', 'tobiiAlign', 'csvWrite']
+
+finishedUnitsKept = 100
+# Units started but never finished (a worker went away and nobody picked the video up again);
+# past this many, the oldest are dropped
+unitsKept = 1000
+
+# Bucket upper bounds in ms: 0.05ms, 0.1ms, 0.2ms, ... doubling up to ~100s, then everything else
+bucketBoundsMS = [0.05 * 2**i for i in range(0, 22)]
+
+
+class StageHistogram:
+
+    def __init__(self):
+        self.counts = [0] * (len(bucketBoundsMS) + 1)
+        self.count = 0
+        self.totalMS = 0.0
+        self.maxMS = 0.0
+
+    def observe(self, ms):
+        b = 0
+        while b < len(bucketBoundsMS) and ms > bucketBoundsMS[b]:
+            b = b + 1
+        self.counts[b] = self.counts[b] + 1
+        self.count = self.count + 1
+        self.totalMS = self.totalMS + ms
+        self.maxMS = max( self.maxMS, ms )
+
+    def quantile(self, q):
+        # Estimate, interpolating within the bucket the q'th observation falls in
+        if self.count == 0:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for b, n in enumerate( self.counts ):
+            if n > 0 and seen + n >= target:
+                lower = bucketBoundsMS[b-1] if b > 0 else 0.0
+                upper = min( bucketBoundsMS[b], self.maxMS ) if b < len(bucketBoundsMS) else self.maxMS
+                return lower + (upper - lower) * max( target - seen, 0 ) / n
+            seen = seen + n
+        return self.maxMS
+
+    def summary(self):
+        return {'count': self.count,
+                'meanMS': round( self.totalMS / self.count, 3 ) if self.count > 0 else 0.0,
+                'p50MS': round( self.quantile( 0.5 ), 3 ),
+                'p90MS': round( self.quantile( 0.9 ), 3 ),
+                'p99MS': round( self.quantile( 0.99 ), 3 ),
+                'maxMS': round( self.maxMS, 3 ),
+                'buckets': {"{:g}".format( bound ): n for bound, n in zip( bucketBoundsMS + [float('inf')], self.counts ) if n > 0}}
+
+
+# Counters and stage timings of one (participant, video) unit
+class UnitMetrics:
+
+    def __init__(self, unit):
+        self.unit = unit
+        self.startTime = time.monotonic()
+        self.endTime = None
+        self.framesSent = 0
+        self.framesDone = 0
+        self.bytesSent = 0
+        self.stages = {}
+
+    def summary(self):
+        elapsed = (self.endTime or time.monotonic()) - self.startTime
+        return {'unit': self.unit,
+                'seconds': round( elapsed, 3 ),
+                'framesSent': self.framesSent,
+                'framesDone': self.framesDone,
+                'bytesSent': self.bytesSent,
+                'framesPerSecond': round( self.framesDone / elapsed, 2 ) if elapsed > 0 else 0.0,
+                'finished': self.endTime is not None,
+                'stages': {name: h.summary() for name, h in self.stages.items()}}
+
+
+class ServerMetrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.startTime = time.monotonic()
+        self.stages = {name: StageHistogram() for name in stageNames}
+        self.counters = {'framesSent': 0, 'framesDone': 0, 'bytesSent': 0, 'resultsIgnored': 0, 'videosFinished': 0}
+        self.units = {}             # unit name -> UnitMetrics of the units running, in the order they were started
+        self.finishedUnits = collections.deque( maxlen=finishedUnitsKept )  # Summaries of the last units to finish
+        self.gauges = None          # Function returning a dict of current queue depths etc., set by the server
+
+    def observe(self, stage, ms, unit=None):
+        with self.lock:
+            self.stages[stage].observe( ms )
+            if unit is not None and unit in self.units:
+                stages = self.units[unit].stages
+                if stage not in stages:
+                    stages[stage] = StageHistogram()
+                stages[stage].observe( ms )
+
+    def timed(self, stage, unit=None):
+        # with serverMetrics.timed( 'csvWrite', unit ): ...
+        return StageTimer( self, stage, unit )
+
+    def count(self, counter, n=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get( counter, 0 ) + n
+
+    ##############################################################
+    # Units
+    def unitStarted(self, unit):
+        # A video (re)starts from frame 0, so it starts its counts again
+        with self.lock:
+            self.units.pop( unit, None )
+            self.units[unit] = UnitMetrics( unit )
+            while len(self.units) > unitsKept:
+                del self.units[next( iter( self.units ) )]
+
+    def frameSent(self, unit, nBytes):
+        with self.lock:
+            self.counters['framesSent'] = self.counters['framesSent'] + 1
+            self.counters['bytesSent'] = self.counters['bytesSent'] + nBytes
+            u = self.units.get( unit )
+            if u is not None:
+                u.framesSent = u.framesSent + 1
+                u.bytesSent = u.bytesSent + nBytes
+
+    def frameDone(self, unit):
+        with self.lock:
+            self.counters['framesDone'] = self.counters['framesDone'] + 1
+            u = self.units.get( unit )
+            if u is not None:
+                u.framesDone = u.framesDone + 1
+
+    def unitFinished(self, unit):
+        # Returns the unit's summary
+        with self.lock:
+            self.counters['videosFinished'] = self.counters['videosFinished'] + 1
+            u = self.units.pop( unit, None )
+            if u is None:
+                return None
+            u.endTime = time.monotonic()
+            summary = u.summary()
+            self.finishedUnits.append( summary )
+            return dict( summary )
+
+    ##############################################################
+    def snapshot(self):
+        gauges = self.gauges() if self.gauges is not None else {}
+        with self.lock:
+            elapsed = time.monotonic() - self.startTime
+            return {'uptimeSeconds': round( elapsed, 3 ),
+                    'framesPerSecond': round( self.counters['framesDone'] / elapsed, 2 ) if elapsed > 0 else 0.0,
+                    'counters': dict( self.counters ),
+                    'gauges': gauges,
+                    'stages': {name: h.summary() for name, h in self.stages.items()},
+                    'units': list( self.finishedUnits ) + [u.summary() for u in self.units.values()]}
+
+
+class StageTimer:
+
+    def __init__(self, metrics, stage, unit):
+        self.metrics = metrics
+        self.stage = stage
+        self.unit = unit
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe( self.stage, (time.perf_counter() - self.start) * 1000, self.unit )
+        return False
+
+
+# The one the whole server shares
+serverMetrics = ServerMetrics()
@@ -1,12 +1,15 @@
 import csv
 import glob
-import math
 import os
+import re
 import json
-from decimal import Decimal
+import numpy as np
 import tornado.escape
 
 import global_variables
+from tobiiData import loadTobiiLog,nearestTobiiIndices,tobiiSamplesAt,tobiiGazePoints
+from inputLog import parseInputLog,interactionDtype,interactionMouseMove,interactionMouseClick,interactionKeyPress
+from cacheFiles import fileKey,saveJSON,saveArray
 
 pctFile = "participant_characteristics.csv"
 
@@ -33,41 +36,158 @@ laptopDocumentEndY = 775 # not including scroll bar
 chromeDownloadBarHeight = 52
 
 ##################################################################
-# Classes for data storage
+# Enumerate all P_ subdirectories of the dataset
 #
-class TobiiData:
-    timestamp = 0
-    rightEyeValid = False
-    leftEyeValid = False
-    rightScreenGazeX = -math.inf
-    rightScreenGazeY = -math.inf
-    leftScreenGazeX = -math.inf
-    leftScreenGazeY = -math.inf
-
-    def __init__(self, timestamp, rev, lev, rsgx, rsgy, lsgx, lsgy ):
-        self.timestamp = timestamp
-        self.rightEyeValid = rev
-        self.leftEyeValid = lev
-        self.rightScreenGazeX = rsgx
-        self.rightScreenGazeY = rsgy
-        self.leftScreenGazeX = lsgx
-        self.leftScreenGazeY = lsgy
+def findParticipantDirs():
+    regex = re.compile('P_[0-9][0-9]')
 
-    def __str__(self):
-        return "[TobiiData] Timestamp: " + str(self.timestamp) + "  RightEyeValid: " + str(self.rightEyeValid) + "  REX: " + str(self.rightScreenGazeX) + "  REY: " + str(self.rightScreenGazeY)
+    participantDirList = []
+    for root, dirs, files in os.walk('.'):
+        for d in dirs:
+            if regex.match(d):
+               participantDirList.append(d)
+
+    return sorted( participantDirList )
 
 
+##################################################################
+# Parsed participant metadata cache
+#
+# What loadParticipantData needs from participant_characteristics.csv, the participant's directory
+# and their input log, written next to their data as P_XX/P_XX.meta.json, with the interaction
+# table in P_XX/P_XX.interactions.npy. It is stored with the modification time and size of the
+# files it came from, and parsed again if any of them change.
+metaCacheSuffix = ".meta.json"
+metaCacheVersion = 2
+interactionsCacheSuffix = ".interactions.npy"
+
+# participant_characteristics.csv rows by participant, read once per process (and again if the file changes)
+characteristicsKey = None
+characteristicsRows = None
+
+def loadCharacteristics():
+    global characteristicsKey, characteristicsRows
+    key = fileKey( pctFile )
+    if key != characteristicsKey:
+        characteristicsRows = {}
+        with open( pctFile ) as f:
+            for row in csv.reader(f, delimiter=','):
+                # First row for a participant wins, as when scanning for it
+                characteristicsRows.setdefault( row[0], row )
+        characteristicsKey = key
+    return characteristicsRows
+
+def parseParticipantMeta( directory, webMFile, inputLogFile ):
+
+    meta = {'characteristics': loadCharacteristics().get( directory )}
+
+    # Find the first part of the video filename, which is the timestamp as a string
+    f = os.path.split( webMFile )[1]
+    meta['startTimestamp'] = int(f[0:f.find('_')])
+    meta['inputLogFile'] = inputLogFile
+
+    # One pass over the log, streamed: WebGazer browser window parameters, all video recordings
+    # with start times, and the mouse and keyboard interactions
+    meta['window'], meta['videos'], interactions, meta['keysPressed'] = parseInputLog( inputLogFile )
+    return meta, interactions
+
+def loadParticipantMeta( directory ):
+
+    # *dot_test_instructions.webm is the first video file; its name holds the input log's name
+    webMFile = glob.glob( directory + '/' + '*dot_test_instructions.webm' )
+    try:
+        webMFile = webMFile[0]
+    except IndexError:
+        raise OSError('Files are not in right location, see https://webgazer.cs.brown.edu/data/ for details'\
+        + 'on how to correct this')
+    f = os.path.split( webMFile )[1]
+    inputLogFile = directory + "/" + f[0:f.find('_')] + ".json"
+
+    key = {'version': metaCacheVersion,
+           'characteristics': fileKey( pctFile ),
+           'webMFile': webMFile,
+           'inputLog': fileKey( inputLogFile )}
+
+    cacheFile = directory + '/' + directory + metaCacheSuffix
+    interactionsFile = directory + '/' + directory + interactionsCacheSuffix
+    try:
+        with open( cacheFile ) as f:
+            cache = json.load( f )
+        if cache.get( 'key' ) == key:
+            interactions = np.load( interactionsFile )
+            if interactions.dtype == interactionDtype:
+                return cache['meta'], interactions
+    except (OSError, ValueError):
+        pass
+
+    meta, interactions = parseParticipantMeta( directory, webMFile, inputLogFile )
+    try:
+        # The interactions first, so that the metadata never refers to stale ones
+        saveArray( interactionsFile, interactions )
+        saveJSON( cacheFile, {'key': key, 'meta': meta} )
+    except OSError as e:
+        print( "    Could not write participant cache " + cacheFile + ": " + str(e) )
+    return meta, interactions
+
+
+##################################################################
+# Classes for data storage
+#
 class ParticipantVideo:
     filename = []
     startTimestamp = -1
     stopTimestamp = -1
 
-    frameFilesList = []
-    frameFilesPos = -1
+    frameFilesList = []         # Frame file names; a frameExtraction.FrameFiles for extracted videos
+    framePts = []               # Timestamp of each frame in frameFilesList, in ms into the video
+    frameFilesPos = -1          # Next frame to send
+    framesDonePos = -1          # Next frame whose result is written out; all before it are done
+    pendingResults = None       # frameNum -> msgID 3 result that arrived ahead of framesDonePos
+
+    # Per-frame Tobii alignment, filled in by alignTobiiToFrames before each frame is sent
+    frameTimesEpoch = None
+    tobiiIndices = None
+    tobiiSamples = None         # Matched Tobii records, one per frame (tobiiData.tobiiDtype)
+    tobiiGazeX = None
+    tobiiGazeY = None
+
+    # When streaming from ffmpeg instead of from extracted frames (frameStream.FfmpegFrameStream)
+    frameStream = None
+    streamedRGBA = None         # The most recently decoded frame, waiting to be sent
+
+    gazeWriter = None           # csvOutput.BufferedCSVWriter for this video's gaze predictions
+    columnWriter = None         # columnarOutput.ColumnarVideoWriter, if writing columns too
 
     def __init__(self, filename, startTimestamp):
         self.filename = filename
         self.startTimestamp = startTimestamp
+
+    def resetFrames(self):
+        # Start this video from its first frame
+        self.frameFilesList = []
+        self.framePts = []
+        self.frameFilesPos = 0
+        self.framesDonePos = 0
+        self.pendingResults = {}
+        self.frameTimesEpoch = []
+        self.tobiiIndices = []
+        self.tobiiSamples = []
+        self.tobiiGazeX = []
+        self.tobiiGazeY = []
+        self.closeOutputs()
+        self.streamedRGBA = None
+
+    def closeOutputs(self):
+        # Stop any ffmpeg stream and write out any buffered output rows
+        if self.frameStream is not None:
+            self.frameStream.close()
+        self.frameStream = None
+        if self.gazeWriter is not None:
+            self.gazeWriter.close()
+        self.gazeWriter = None
+        if self.columnWriter is not None:
+            self.columnWriter.close()
+        self.columnWriter = None
     
     def __str__(self):
         return "[ParticipantVideo] Timestamp: " + str(self.startTimestamp) + " Filename: " + str(self.filename)
@@ -94,8 +214,13 @@ class ParticipantData:
     pcOrLaptop = ""             # Equals either 'Laptop' or 'PC'
 
     tobiiLogFile = ""
-    tobiiList = []
-    tobiiListPos = 0
+    tobii = None                # Structured array of samples sorted by time (tobiiData.tobiiDtype)
+    tobiiTimestamps = None      # np.int64 view of tobii['timestamp']
+
+    # Mouse and keyboard input, in log order (inputLog.interactionDtype)
+    interactions = None
+    interactionKeyIndex = None
+    keysPressed = None
 
     screencapFile = ""
     screencap = None
@@ -114,64 +239,46 @@ class ParticipantData:
 
     def loadParticipantData(self):
 
+        ########################
+        # Characteristics, window geometry and video list; parsed once, then loaded from P_XX/P_XX.meta.json
+        meta, self.interactions = loadParticipantMeta( self.directory )
+        self.keysPressed = meta['keysPressed']
+        # Index into keysPressed of each key press in the interaction table
+        self.interactionKeyIndex = np.cumsum( self.interactions['kind'] == interactionKeyPress ) - 1
+
         ########################
         # Load participant characteristics as technical parts
-        with open( pctFile ) as f:
-            readCSV = csv.reader(f, delimiter=',')
-            for row in readCSV:
-                if row[0] == self.directory:
-                    self.screenWidthPixels = int(row[4])
-                    self.screenHeightPixels = int(row[5])
-                    self.pcOrLaptop = str(row[3])  # Equals either 'Laptop' or 'PC'
-                    self.touchTypist = str(row[18])  # Equals either 'Yes' or 'No'
-                    if row[9] != '':
-                        self.screencapStartTime = int(row[9])  # 20180316 JT Note: the value in the .csv is currently inaccurate or incomplete
-                    else:
-                        self.screencapStartTime = 0
-                    break
+        row = meta['characteristics']
+        if row is not None:
+            self.screenWidthPixels = int(row[4])
+            self.screenHeightPixels = int(row[5])
+            self.pcOrLaptop = str(row[3])  # Equals either 'Laptop' or 'PC'
+            self.touchTypist = str(row[18])  # Equals either 'Yes' or 'No'
+            if row[9] != '':
+                self.screencapStartTime = int(row[9])  # 20180316 JT Note: the value in the .csv is currently inaccurate or incomplete
+            else:
+                self.screencapStartTime = 0
 
         ########################
         # WebGazer event log
-        # *dot_test_instructions.webm is the first video file.
-        webMFile = glob.glob( self.directory + '/' + '*dot_test_instructions.webm' )
-        # Split the video name into its pieces
-        try:
-            f = os.path.split( webMFile[0] )[1]
-        except IndexError:
-            raise OSError('Files are not in right location, see https://webgazer.cs.brown.edu/data/ for details'\
-            + 'on how to correct this')
-
-        # Find the first part of the video filename, which is the timestamp as a string
-        self.startTimestamp = int(f[0:f.find('_')])
+        self.startTimestamp = meta['startTimestamp']
         print( self.directory )
-        self.inputLogFile = self.directory + "/" + str(self.startTimestamp) + ".json"
-
-        # Load WebGazer browser window parameters
-        with open( self.inputLogFile ) as f:
-            inputLog = json.load( f )
-
-        for l in inputLog:
-            if l.get('windowX') != None:
-                self.wgWindowX = int(l['windowX'])
-                self.wgWindowY = int(l['windowY'])
-                self.wgWindowInnerWidth = int(l['windowInnerWidth'])
-                self.wgWindowInnerHeight = int(l['windowInnerHeight'])
-                self.wgWindowOuterWidth = int(l['windowOuterWidth'])
-                self.wgWindowOuterHeight = int(l['windowOuterHeight'])
-                break
-
-        # Find all video recordings, with start times
-        self.videos = []
+        self.inputLogFile = meta['inputLogFile']
+
+        # WebGazer browser window parameters
+        window = meta['window']
+        if window is not None:
+            self.wgWindowX = window['windowX']
+            self.wgWindowY = window['windowY']
+            self.wgWindowInnerWidth = window['windowInnerWidth']
+            self.wgWindowInnerHeight = window['windowInnerHeight']
+            self.wgWindowOuterWidth = window['windowOuterWidth']
+            self.wgWindowOuterHeight = window['windowOuterHeight']
+
+        # All video recordings, with start times
+        self.videos = [ParticipantVideo( fn, starttime ) for fn, starttime in meta['videos']]
         self.videosPos = -1
 
-        for l in inputLog:
-            if l.get("type") == "recording start":
-                fn = l.get("sessionString")
-                fn = fn.replace('/', '-') + '.webm'
-                starttime = l.get("epoch")
-                pv = ParticipantVideo( fn, starttime )
-                self.videos.append( pv )
-
 
         ################################
         # Filter video names
@@ -186,22 +293,9 @@ class ParticipantData:
         ################################
         # Read in JSON output from Tobii
         self.tobiiLogFile = self.directory + '/' + self.directory + ".txt"
-        self.tobiiList = []
-        self.tobiiListPos = 0
-        # Each line is a JSON object, so let's read the file line by line
-        with open( self.tobiiLogFile, 'r' ) as f:
-            for line in f:
-                l = json.loads(line, parse_float=Decimal)
-                
-                rsgx = float(l['right_gaze_point_on_display_area'][0])
-                rsgy = float(l['right_gaze_point_on_display_area'][1])
-                lsgx = float(l['left_gaze_point_on_display_area'][0])
-                lsgy = float(l['left_gaze_point_on_display_area'][1])
-                timestamp = round( l['true_time'] * 1000 )
-                rpv = l['right_pupil_validity']
-                lpv = l['left_pupil_validity']
-                td = TobiiData( timestamp, rpv, lpv, rsgx, rsgy, lsgx, lsgy )
-                self.tobiiList.append( td )
+        # Columnar store; parsed once, then loaded from the binary sidecar next to the log
+        self.tobii = loadTobiiLog( self.tobiiLogFile )
+        self.tobiiTimestamps = self.tobii['timestamp']
 
 
         ################################
@@ -223,6 +317,72 @@ class ParticipantData:
 
 
 
+###########################################################################################################
+# Tobii <-> video frame alignment
+#
+# p = participant, pv = one of p.videos with frameFilesList populated
+def alignTobiiToFrames( p, pv ):
+    # Matches the frames in pv.frameFilesList that are not aligned yet, in one batch: all of them for
+    # extracted videos, before the first frame goes out, and the newly decoded ones for streamed videos
+    start = len(pv.frameTimesEpoch)
+    if start >= len(pv.frameFilesList):
+        return
+
+    frameTimesEpoch = np.array( pv.framePts[start:], dtype=np.int64 ) + pv.startTimestamp
+    tobiiIndices = nearestTobiiIndices( p.tobiiTimestamps, frameTimesEpoch )
+    tobiiSamples = tobiiSamplesAt( p.tobii, tobiiIndices )
+    tobiiGazeX, tobiiGazeY = tobiiGazePoints( tobiiSamples )
+
+    pv.frameTimesEpoch.extend( frameTimesEpoch.tolist() )
+    pv.tobiiIndices.extend( tobiiIndices.tolist() )
+    pv.tobiiSamples.extend( tobiiSamples )
+    pv.tobiiGazeX.extend( tobiiGazeX.tolist() )
+    pv.tobiiGazeY.extend( tobiiGazeY.tolist() )
+
+
+def documentStart( participant ):
+    # Screen position of the browser document's (0, 0)
+    if participant.pcOrLaptop == "PC":
+        return pcDocumentStartX, pcDocumentStartY
+    else:
+        return laptopDocumentStartX, laptopDocumentStartY
+
+
+def jsonNumber( v ):
+    # As the value would have come back from the browser: JavaScript writes whole numbers without a '.0'
+    return int(v) if v.is_integer() else v
+
+
+# p = participant, pos = index into p.interactions of the first interaction not yet given to a frame
+def interactionsBefore( p, pos, frameTimeEpoch ):
+
+    # The interactions from pos up to the frame time, as the CSV's interaction columns, in normalized
+    # screen coordinates; the same values the client used to send back with each frame.
+    # Returns (columns, index of the first interaction at or after the frame time)
+    docStartX, docStartY = documentStart( p )
+    columns = {'mouseMoveX': [], 'mouseMoveY': [], 'mouseClickX': [], 'mouseClickY': [],
+               'keyPressed': [], 'keyPressedX': [], 'keyPressedY': []}
+
+    interactions = p.interactions
+    while pos < len(interactions) and interactions['epoch'][pos] < frameTimeEpoch:
+        e = interactions[pos]
+        x = jsonNumber( (float(e['x']) + docStartX) / p.screenWidthPixels )
+        y = jsonNumber( (float(e['y']) + docStartY) / p.screenHeightPixels )
+        if e['kind'] == interactionMouseMove:
+            columns['mouseMoveX'].append( x )
+            columns['mouseMoveY'].append( y )
+        elif e['kind'] == interactionMouseClick:
+            columns['mouseClickX'].append( x )
+            columns['mouseClickY'].append( y )
+        else:
+            columns['keyPressed'].append( p.keysPressed[p.interactionKeyIndex[pos]] )
+            columns['keyPressedX'].append( x )
+            columns['keyPressedY'].append( y )
+        pos = pos + 1
+
+    return columns, pos
+
+
 ###########################################################################################################
 # Messages to send over WebSockets
 #
@@ -230,12 +390,7 @@ def sendParticipantInfo( wsh, participant ):
 
     # Tell the connecting socket about the participant
     # Screen coordinate data
-    if participant.pcOrLaptop == "PC":
-        docStartX = pcDocumentStartX
-        docStartY = pcDocumentStartY
-    else:
-        docStartX = laptopDocumentStartX
-        docStartY = laptopDocumentStartY
+    docStartX, docStartY = documentStart( participant )
 
     parcel = ({ 'msgID': "0",
                 'screenWidthPixels': str(participant.screenWidthPixels), 
@@ -248,16 +403,3 @@ def sendParticipantInfo( wsh, participant ):
                 'participantInputLogFile': str(participant.inputLogFile)})
 
     wsh.write_message( tornado.escape.json_encode( parcel ) )
-
-def newParticipant( wsh ):    
-    global_variables.participantPos = global_variables.participantPos + 1
-
-    # Check we're not at the last participant
-    if global_variables.participantPos >= len(global_variables.participantDirList):
-        print( "All participants completed." )
-        exit()
-    else:
-        # Load the participant data
-        global_variables.participant = ParticipantData( global_variables.participantDirList[global_variables.participantPos] )
-        global_variables.participant.loadParticipantData()
-        sendParticipantInfo( wsh, global_variables.participant )
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# Extract the video frames of every participant up front, several videos at a time.
+#
+# Walks the participant directories, finds each participant's videos in their input log (the same
+# list the extract server uses), and runs ffmpeg decode + timestamp parsing + renaming for each one
+# in a bounded process pool. Videos that already have a framesExtracted.txt marker are skipped, and
+# the server skips extraction for any video this has finished, so it only has to stream frames.
+#
+# Extraction also writes each video's PTS index (see ptsIndex.py).
+#
+# Usage (from the dataset directory, like webgazerExtractServer.py):
+# > python preExtractFrames.py [number of worker processes]
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import global_variables
+from participant import ParticipantData,findParticipantDirs
+from frameExtraction import videoFramesDir,videoPtsFile,framesExtracted,extractVideoFrames
+
+
+def findVideosToExtract( participantDirList ):
+    # (video, outDir, PTS index file) for every video the server would process that isn't extracted yet
+    todo = []
+    for d in participantDirList:
+        p = ParticipantData( d )
+        p.loadParticipantData()
+        for pv in p.videos:
+            outDir = videoFramesDir( p.directory, pv.filename )
+            if framesExtracted( outDir ):
+                continue
+            video = p.directory + '/' + pv.filename
+            if not os.path.isfile( video ):
+                print( "    Missing video file " + video + "; skipping..." )
+                continue
+            todo.append( (video, outDir, videoPtsFile( p.directory, pv.filename )) )
+    return todo
+
+
+def main():
+    global_variables.init()
+    # Only the video list is needed here
+    global_variables.writeScreenCapVideo = False
+
+    workers = os.cpu_count() or 1
+    if len(sys.argv) >= 2:
+        workers = max( int(sys.argv[1]), 1 )
+
+    participantDirList = findParticipantDirs()
+    print( "Finding videos for " + str(len(participantDirList)) + " participants..." )
+    todo = findVideosToExtract( participantDirList )
+    print( "Extracting " + str(len(todo)) + " videos with " + str(workers) + " worker processes..." )
+
+    start = time.time()
+    failed = []
+    with ProcessPoolExecutor( max_workers=workers ) as pool:
+        futures = {pool.submit( extractVideoFrames, *unit ): unit[0] for unit in todo}
+        for i, future in enumerate( as_completed( futures ) ):
+            video = futures[future]
+            try:
+                nFrames = future.result()
+            except Exception as e:
+                print( "    Error extracting " + video + ": " + str(e) )
+                nFrames = 0
+            if nFrames == 0:
+                failed.append( video )
+            print( "[" + str(i+1) + "/" + str(len(todo)) + "] " + video + ": " + str(nFrames) + " frames" )
+
+    print( "Done in {:.1f}s.".format( time.time() - start ) )
+    if len(failed) > 0:
+        print( "Could not extract frames from " + str(len(failed)) + " videos:" )
+        for video in failed:
+            print( "    " + video )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+import os
+import zipfile
+import subprocess
+import numpy as np
+
+from cacheFiles import fileKey,saveArrays
+
+
+##################################################################
+# Per-video frame timestamp (PTS) index
+#
+# The presentation time of every frame of a video, in ms into the video, plus its timebase and
+# framerate. Found with a demux-only pass (ffmpeg -c copy -f framecrc: one line per packet, no
+# decoding), and saved next to the video's frames as <video>_pts.npz, so that it is done once. The
+# index holds the video's modification time and size, and is made again if they change.
+#
+# Frame i of the extracted (or streamed) video has timestamp pts[i]: both decode with -vsync 0,
+# so every frame comes out exactly once, in presentation order.
+
+def ptsIndexFile( outputPrefix, directory, filename ):
+    # e.g., ../FramesDataset/P_01/1491423217564_1491423217564_writing.webm_pts.npz
+    return outputPrefix + directory + '/' + filename + "_pts.npz"
+
+
+def probeVideoPts( video ):
+    # video = path of the video file. Returns (pts in ms, timebase string, framerate); pts is empty if ffmpeg fails.
+    process = subprocess.Popen( ['ffmpeg', '-nostdin', '-v', 'error', '-i', './' + video, '-map', '0:v:0', '-c', 'copy', '-f', 'framecrc', '-'],
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True )
+    timebase = "1/1000"
+    pts = []
+    # Read the packet lines as they come; header lines start with '#'
+    # e.g., 0,         33,         33,       33,       47, 0x42220ead, F=0x0
+    for l in process.stdout:
+        if l.startswith( "#tb 0:" ):
+            timebase = l[6:].strip()
+        elif not l.startswith( "#" ):
+            fields = l.split( ',' )
+            if len(fields) >= 3:
+                pts.append( int(fields[2]) )
+    process.wait()
+
+    # Packets are in decode order; frames come out in presentation order
+    pts = np.sort( np.array( pts, dtype=np.int64 ) )
+
+    # To milliseconds
+    num, _, den = timebase.partition( '/' )
+    num = int(num)
+    den = int(den) if den else 1
+    if timebase != "1/1000":
+        pts = (pts * 1000 * num + den // 2) // den
+
+    # Estimate the framerate from the typical gap between frames
+    framerate = -1
+    if len(pts) >= 2:
+        gap = np.median( np.diff( pts ) )
+        if gap > 0:
+            framerate = 1000.0 / gap
+
+    return pts, timebase, framerate
+
+
+def loadPtsIndex( video, indexFile ):
+    # Load the saved index if it was made from this video; otherwise probe the video and save it.
+    # Returns (pts in ms, framerate)
+    key = np.array( fileKey( video ), dtype=np.int64 )
+    if os.path.isfile( indexFile ):
+        try:
+            with np.load( indexFile ) as index:
+                if 'key' in index and np.array_equal( index['key'], key ):
+                    return index['pts'], float(index['framerate'])
+        except (OSError, EOFError, ValueError, KeyError, zipfile.BadZipFile) as e:
+            print( "    Could not read PTS index " + indexFile + " (" + str(e) + "); probing the video again..." )
+
+    pts, timebase, framerate = probeVideoPts( video )
+    if len(pts) > 0:
+        try:
+            os.makedirs( os.path.dirname( indexFile ), exist_ok=True )
+            saveArrays( indexFile, pts=pts, timebase=timebase, framerate=framerate, key=key )
+        except OSError as e:
+            print( "    Could not write PTS index " + indexFile + ": " + str(e) )
+    return pts, framerate
+
+
+def framePts( pts, framerate, frameNum, prevPts ):
+    # Timestamp of frame frameNum. If the index is short of it, assume the framerate is good
+    # (yea right) and add on the frame time to the previous frame's
+    if frameNum < len(pts):
+        return int(pts[frameNum])
+    return prevPts + (int(1000/framerate) if framerate > 0 else 0)
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# Render the screen capture videos with the Tobii and WebGazer gaze points drawn over them,
+# offline, from the finished extraction outputs.
+#
+# For each webcam video with a gazePredictionsDone.csv (or .cols), the stretch of the
+# participant's screen recording that it covers is decoded once, front to back, and every
+# screen frame gets the markers of the webcam frame closest to it in time:
+# Tobii in green, WebGazer in red. Each webcam video is rendered by its own worker process.
+#
+# Output: P_XX/screenCapOut_<webcam video>.avi, at the screen recording's resolution and frame rate.
+#
+# Usage (from the dataset directory, like webgazerExtractServer.py):
+# > python renderScreenCapOverlay.py [number of worker processes] [P_XX ...]
+import os
+import sys
+import csv
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import cv2
+import numpy as np
+
+import global_variables
+from participant import ParticipantData,findParticipantDirs
+from tobiiData import nearestTobiiIndices,tobiiSamplesAt,tobiiGazePoints
+from frameExtraction import outputPrefix
+from csvOutput import csvDoneName,fieldnames
+from columnarOutput import columnsDoneName,loadVideoColumns
+
+
+def loadPredictions( p, pv ):
+    # (frameTimeEpoch, webGazerX, webGazerY) for every frame of a finished video; None if it isn't finished
+    colsDone = outputPrefix + p.directory + '_' + pv.filename + '_' + columnsDoneName
+    if os.path.isdir( colsDone ):
+        c = loadVideoColumns( colsDone )
+        return np.array( c['frameTimeEpoch'] ), np.array( c['webGazerX'] ), np.array( c['webGazerY'] )
+
+    gpCSVDone = outputPrefix + p.directory + '_' + pv.filename + '_' + csvDoneName
+    if not os.path.isfile( gpCSVDone ):
+        return None
+
+    iTime = fieldnames.index( 'frameTimeEpoch' )
+    iX = fieldnames.index( 'webGazerX' )
+    iY = fieldnames.index( 'webGazerY' )
+    frameTimesEpoch = []
+    wgX = []
+    wgY = []
+    with open( gpCSVDone, newline='' ) as f:
+        for row in csv.reader( f ):
+            if row[0] == 'participant':
+                # Header; only written when a video was restarted
+                continue
+            frameTimesEpoch.append( int(row[iTime]) )
+            wgX.append( float(row[iX]) )
+            wgY.append( float(row[iY]) )
+    return np.array( frameTimesEpoch, dtype=np.int64 ), np.array( wgX ), np.array( wgY )
+
+
+# Runs in a worker process. msecIntoVid = time of each webcam frame into the screen recording, in order;
+# radius = marker size in pixels of the recording.
+# Returns the number of screen frames written.
+def renderOverlay( screencapFile, outFile, msecIntoVid, tobiiX, tobiiY, wgX, wgY, radius ):
+
+    screencap = cv2.VideoCapture( screencapFile )
+    if not screencap.isOpened():
+        return 0
+    frameRate = screencap.get( cv2.CAP_PROP_FPS )
+    width = int( screencap.get( cv2.CAP_PROP_FRAME_WIDTH ) )
+    height = int( screencap.get( cv2.CAP_PROP_FRAME_HEIGHT ) )
+    frameMS = 1000.0 / frameRate if frameRate > 0 else 0
+
+    # cv2.VideoWriter_fourcc('H','2','6','4') - if you can build opencv correctly
+    out = cv2.VideoWriter( outFile, cv2.VideoWriter_fourcc('M','J','P','G'), int( frameRate ), (width, height) )
+
+    # One seek, to the start of this video's stretch of the recording; from there on, decode in order
+    start = msecIntoVid[0] - frameMS / 2
+    end = msecIntoVid[-1] + frameMS / 2
+    screencap.set( cv2.CAP_PROP_POS_MSEC, max( start, 0 ) )
+
+    i = 0
+    nWritten = 0
+    while True:
+        ret, image = screencap.read()
+        if not ret:
+            break
+        # Time of the frame just decoded
+        t = screencap.get( cv2.CAP_PROP_POS_MSEC )
+        if t < start:
+            continue
+        if t > end:
+            break
+
+        # Closest webcam frame in time; both are in order, so only ever move forwards
+        while i+1 < len(msecIntoVid) and abs( msecIntoVid[i+1] - t ) <= abs( msecIntoVid[i] - t ):
+            i = i + 1
+
+        center = ( int(width * tobiiX[i]), int(height * tobiiY[i]) )
+        cv2.circle( image, center, radius, (0,255,0), -1 )
+        center = ( int(width * wgX[i]), int(height * wgY[i]) )
+        cv2.circle( image, center, radius, (0,0,255), -1 )
+        out.write( image )
+        nWritten = nWritten + 1
+
+    out.release()
+    screencap.release()
+    return nWritten
+
+
+def findSegments( participantDirList ):
+    # Arguments to renderOverlay for every finished webcam video
+    segments = []
+    for d in participantDirList:
+        p = ParticipantData( d )
+        p.loadParticipantData()
+        if p.screencapFile == "" or not os.path.isfile( p.screencapFile ):
+            print( "    No screen capture video for " + d + "; skipping..." )
+            continue
+        if p.screencapStartTime == 0:
+            print( "    No screen capture start time for " + d + "; skipping..." )
+            continue
+
+        for pv in p.videos:
+            predictions = loadPredictions( p, pv )
+            if predictions is None or len(predictions[0]) == 0:
+                continue
+            frameTimesEpoch, wgX, wgY = predictions
+
+            # The same Tobii sample the extractor compared against for each frame
+            tobiiX, tobiiY = tobiiGazePoints( tobiiSamplesAt( p.tobii, nearestTobiiIndices( p.tobiiTimestamps, frameTimesEpoch ) ) )
+
+            # Drawn on the recording as it is, rather than resizing every frame: the 'Laptop' screen
+            # recordings are twice as large in each dimension as the screen, so are the markers
+            radius = 20 if p.pcOrLaptop == "Laptop" else 10
+
+            outFile = p.directory + "/" + "screenCapOut_" + pv.filename + ".avi"
+            segments.append( (p.screencapFile, outFile, frameTimesEpoch - p.screencapStartTime, tobiiX, tobiiY, wgX, wgY, radius) )
+    return segments
+
+
+def main():
+    global_variables.init()
+    # We render here, not during extraction
+    global_variables.writeScreenCapVideo = False
+
+    workers = os.cpu_count() or 1
+    if len(sys.argv) >= 2:
+        workers = max( int(sys.argv[1]), 1 )
+    participantDirList = sys.argv[2:] if len(sys.argv) >= 3 else findParticipantDirs()
+
+    segments = findSegments( participantDirList )
+    print( "Rendering " + str(len(segments)) + " videos with " + str(workers) + " worker processes..." )
+
+    start = time.time()
+    with ProcessPoolExecutor( max_workers=workers ) as pool:
+        futures = {pool.submit( renderOverlay, *segment ): segment[1] for segment in segments}
+        for i, future in enumerate( as_completed( futures ) ):
+            outFile = futures[future]
+            try:
+                nFrames = future.result()
+            except Exception as e:
+                print( "    Error rendering " + outFile + ": " + str(e) )
+                nFrames = 0
+            print( "[" + str(i+1) + "/" + str(len(segments)) + "] " + outFile + ": " + str(nFrames) + " frames" )
+
+    print( "Done in {:.1f}s.".format( time.time() - start ) )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+# Offline WebGazer ridge regression: replays each participant's clicks and mouse moves against the
+# eyeFeatures the extract server wrote (the .cols directories, see columnarOutput.py), as
+# src/ridgeReg.mjs and src/ridgeWeightedReg.mjs would have trained on them in the browser, and
+# scores every frame's prediction against Tobii. Many ridge parameters are evaluated in one pass.
+#
+# What the browser does, and how it is done here:
+#
+#   - Interactions before a frame are added with the eye features of the frame before it
+#     (webgazer's latestEyeFeatures), clicks to a window of the last 50, moves to a trail of the
+#     last 10; nothing is added during dot_test_final.
+#   - Each frame is predicted from the clicks plus the trail moves of the last second. predict()
+#     reads 20 trail slots from a window of 10, so once 10 moves have been seen each trail move is
+#     in the regression twice; that is kept.
+#   - ridge: the 120x120 X'X and X'y of the click window are kept up to date with a rank-1 update
+#     per click (and a downdate when one leaves the window), as clicks arrive. ridgeWeighted
+#     weights the i'th oldest of n clicks by 1/(n-i) (sqrt of it on both X and y), so its sums are
+#     made again for each click. (The browser pairs weighted features and targets in different
+#     orders once its click window has wrapped around; here they are kept together.)
+#   - Frames that share the same clicks and trail share a model. Each distinct model is one
+#     eigendecomposition of X'X, batched with the others, after which every ridge parameter is a
+#     cheap rescale: (X'X + kI)^-1 = Q diag(1/(e+k)) Q'. So no retry with k*10 is needed when X'X
+#     is singular, as the browser's solve sometimes does.
+#   - Predictions are floored to whole pixels and, as params.applyKalmanFilter is on by default,
+#     smoothed by the same Kalman filter as util_regression.mjs, unless 'raw' is given.
+#
+# Only frames WebGazer made a prediction for have eyeFeatures in the output, so the clicks that
+# started the model in the browser (the frame before them had no prediction yet) take the features
+# of their own frame instead.
+#
+# Participants are run in a process pool; each writes rows of
+# participant, model, ridge parameter, video, frames, mean error, mean/median error in pixels
+# to ../FramesDataset/ridgeRegression.csv (video 'all' for all of a participant's videos), and
+# the mean over participants is printed.
+#
+# Usage (from the dataset directory, like webgazerExtractServer.py):
+# > python ridgeRegression.py [worker processes] [ridge parameters, e.g. 1e-5,1e-3,1e-1] [kalman|raw]
+import os
+import sys
+import csv
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from participant import findParticipantDirs,loadParticipantMeta,pcDocumentStartX,pcDocumentStartY,laptopDocumentStartX,laptopDocumentStartY
+from columnarOutput import loadParticipantColumns,eyeFeaturesSize
+
+# As frameExtraction.py; not imported from there, so this doesn't need OpenCV
+outputPrefix = "../FramesDataset/"
+resultsName = "ridgeRegression.csv"
+
+# As util_regression.InitRegression
+clickWindow = 50
+trailWindow = 10
+trailTimeMS = 1000
+defaultRidgeParameter = 1e-5
+
+models = ['ridge', 'ridgeWeighted']
+
+# Interactions during this video are not given to WebGazer (webgazerExtractClient.js)
+noTrainingVideo = 'dot_test_final.'
+
+# Distinct models decomposed at once
+stateChunk = 64
+
+resultFields = ['participant', 'model', 'ridgeParameter', 'video', 'frames', 'meanError', 'meanErrorPix', 'medianErrorPix']
+
+
+##################################################################
+# A participant's frames and interactions, in time order across their videos
+class ParticipantReplay:
+
+    def __init__(self, directory):
+        self.directory = directory
+
+        meta, _ = loadParticipantMeta( directory )
+        row = meta['characteristics']
+        self.screenWidthPixels = int(row[4])
+        self.screenHeightPixels = int(row[5])
+        if str(row[3]) == "PC":
+            self.docStartX, self.docStartY = pcDocumentStartX, pcDocumentStartY
+        else:
+            self.docStartX, self.docStartY = laptopDocumentStartX, laptopDocumentStartY
+
+        videos = [v for v in loadParticipantColumns( directory, outputPrefix ).values() if len(v['frameNum']) > 0]
+        if len(videos) == 0:
+            raise ValueError( "no frames in " + outputPrefix + " for " + directory )
+        videos.sort( key=lambda v: v['frameTimeEpoch'][0] )
+        column = lambda name: np.concatenate( [v[name] for v in videos] )
+
+        self.videoNames = [v['meta']['video'] for v in videos]
+        self.videoIndex = np.concatenate( [np.full( len(v['frameNum']), i ) for i, v in enumerate( videos )] )
+        self.times = column( 'frameTimeEpoch' )
+        self.features = column( 'eyeFeatures' ).astype( np.float64 )
+        # The client sends -1s when WebGazer made no prediction
+        self.hasFeatures = ~np.all( self.features == -1, axis=1 )
+
+        # Tobii gaze, normalized: the average of the eyes that have a position
+        eyes = np.stack( [np.stack( [column( 'tobiiLeftScreenGazeX' ), column( 'tobiiLeftScreenGazeY' )], axis=1 ),
+                          np.stack( [column( 'tobiiRightScreenGazeX' ), column( 'tobiiRightScreenGazeY' )], axis=1 )] )
+        valid = np.isfinite( eyes )
+        count = np.sum( valid, axis=0 )
+        self.gaze = np.sum( np.where( valid, eyes, 0.0 ), axis=0 ) / np.maximum( count, 1 )
+        self.hasGaze = np.all( count > 0, axis=1 )
+
+        self.makeEvents( videos )
+
+    def makeEvents(self, videos):
+        # Each click and move as (frame it is added before, frame whose features it gets, target in
+        # browser client pixels), in order
+        clicks = []
+        moves = []
+        frame = 0
+        for v, name in zip( videos, self.videoNames ):
+            interactions = v['interactions']
+            for i in range(0, len(v['frameNum'])):
+                if name.find( noTrainingVideo ) < 0:
+                    featureFrame = frame - 1
+                    if featureFrame < 0 or not self.hasFeatures[featureFrame]:
+                        featureFrame = frame
+                    if self.hasFeatures[featureFrame]:
+                        for x, y in zip( interactions['mouseClickX'][i], interactions['mouseClickY'][i] ):
+                            clicks.append( (frame, featureFrame) + self.clientPixels( x, y ) )
+                        for x, y in zip( interactions['mouseMoveX'][i], interactions['mouseMoveY'][i] ):
+                            moves.append( (frame, featureFrame) + self.clientPixels( x, y ) )
+                frame = frame + 1
+        self.clicks = np.array( clicks, dtype=np.float64 ).reshape( -1, 4 )
+        self.moves = np.array( moves, dtype=np.float64 ).reshape( -1, 4 )
+
+    def clientPixels(self, x, y):
+        # Normalized screen position -> what the browser's clientX, clientY were
+        return (x * self.screenWidthPixels - self.docStartX, y * self.screenHeightPixels - self.docStartY)
+
+    def normalized(self, pixels):
+        # Predicted client pixels -> normalized screen position, as webgazerExtractClient.js
+        return np.stack( [(pixels[..., 0] + self.docStartX) / self.screenWidthPixels,
+                          (pixels[..., 1] + self.docStartY) / self.screenHeightPixels], axis=-1 )
+
+
+##################################################################
+# Click-window sums, one per number of clicks seen (state 0 is no clicks)
+def clickSums( replay, model ):
+    n = len(replay.clicks)
+    X = replay.features[replay.clicks[:, 1].astype( int )]
+    Y = replay.clicks[:, 2:4]
+    XtX = np.zeros( (n + 1, eyeFeaturesSize, eyeFeaturesSize) )
+    XtY = np.zeros( (n + 1, eyeFeaturesSize, 2) )
+
+    if model == 'ridge':
+        # Rank-1 update per click, downdate per click leaving the window
+        G = np.zeros( (eyeFeaturesSize, eyeFeaturesSize) )
+        B = np.zeros( (eyeFeaturesSize, 2) )
+        for k in range(0, n):
+            G += np.outer( X[k], X[k] )
+            B += np.outer( X[k], Y[k] )
+            if k >= clickWindow:
+                old = k - clickWindow
+                G -= np.outer( X[old], X[old] )
+                B -= np.outer( X[old], Y[old] )
+            XtX[k + 1] = G
+            XtY[k + 1] = B
+    else:
+        # Every weight changes with each click
+        for k in range(0, n):
+            first = max( k + 1 - clickWindow, 0 )
+            count = k + 1 - first
+            w = 1.0 / (count - np.arange( 0, count ))
+            Xw = X[first:k + 1] * w[:, None]
+            XtX[k + 1] = Xw.T @ X[first:k + 1]
+            XtY[k + 1] = Xw.T @ Y[first:k + 1]
+    return XtX, XtY
+
+
+def frameStates( replay ):
+    # For every frame: clicks seen, and the range of moves in its trail and their weight
+    nFrames = len(replay.times)
+    clicksSeen = np.searchsorted( replay.clicks[:, 0], np.arange( 0, nFrames ), side='right' )
+    movesSeen = np.searchsorted( replay.moves[:, 0], np.arange( 0, nFrames ), side='right' )
+    moveTimes = replay.times[replay.moves[:, 0].astype( int )] if len(replay.moves) > 0 else np.zeros( 0 )
+    # Moves are added in time order, so the ones still in the last second are the newest ones
+    recent = np.searchsorted( moveTimes, replay.times - trailTimeMS, side='right' )
+    trailStart = np.maximum( np.maximum( movesSeen - trailWindow, 0 ), recent )
+    trailEnd = np.maximum( movesSeen, trailStart )
+    trailWeight = np.where( movesSeen >= trailWindow, 2.0, 1.0 )
+    return clicksSeen, trailStart, trailEnd, trailWeight
+
+
+##################################################################
+def predictFrames( replay, model, ridgeParameters ):
+    # Predictions in client pixels, (ridge parameters, frames, 2), NaN where WebGazer made none
+    ridgeParameters = np.asarray( ridgeParameters, dtype=np.float64 )
+    nFrames = len(replay.times)
+    predictions = np.full( (len(ridgeParameters), nFrames, 2), np.nan )
+
+    XtX, XtY = clickSums( replay, model )
+    clicksSeen, trailStart, trailEnd, trailWeight = frameStates( replay )
+    moveX = replay.features[replay.moves[:, 1].astype( int )] if len(replay.moves) > 0 else np.zeros( (0, eyeFeaturesSize) )
+    moveY = replay.moves[:, 2:4]
+
+    frames = np.nonzero( replay.hasFeatures & (clicksSeen > 0) )[0]
+    if len(frames) == 0:
+        return predictions
+    keys = np.stack( [clicksSeen[frames], trailStart[frames], trailEnd[frames], trailWeight[frames]], axis=1 )
+    states, stateOfFrame = np.unique( keys, axis=0, return_inverse=True )
+    stateOfFrame = stateOfFrame.ravel()
+    order = np.argsort( stateOfFrame, kind='stable' )
+    bounds = np.searchsorted( stateOfFrame[order], np.arange( 0, len(states) + 1 ) )
+
+    for s0 in range(0, len(states), stateChunk):
+        chunk = states[s0:s0 + stateChunk]
+        A = XtX[chunk[:, 0].astype( int )].copy()
+        B = XtY[chunk[:, 0].astype( int )].copy()
+        for j, (_, start, end, weight) in enumerate( chunk ):
+            start, end = int(start), int(end)
+            if end > start:
+                A[j] += weight * (moveX[start:end].T @ moveX[start:end])
+                B[j] += weight * (moveX[start:end].T @ moveY[start:end])
+        e, Q = np.linalg.eigh( A )
+        V = Q.transpose( 0, 2, 1 ) @ B
+
+        chunkFrames = order[bounds[s0]:bounds[min( s0 + stateChunk, len(states) )]]
+        f = frames[chunkFrames]
+        local = stateOfFrame[chunkFrames] - s0
+        U = np.einsum( 'fij,fi->fj', Q[local], replay.features[f] )
+        scale = 1.0 / (e[local][None, :, :] + ridgeParameters[:, None, None])
+        predictions[:, f, :] = np.einsum( 'lfj,fj,fjc->lfc', scale, U, V[local] )
+
+    return np.floor( predictions )
+
+
+def kalmanFilter( predictions ):
+    # util_regression.KalmanFilter over each row of predictions in frame order, skipping NaNs. Its
+    # covariance and gain don't depend on the measurements, so one gain sequence serves every row.
+    F = np.array( [[1, 0, 1, 0], [0, 1, 0, 1], [0, 0, 1, 0], [0, 0, 0, 1]], dtype=np.float64 )
+    Q = np.array( [[1/4, 0, 1/2, 0], [0, 1/4, 0, 1/2], [1/2, 0, 1, 0], [0, 1/2, 0, 1]] ) * (1/10)
+    H = np.array( [[1, 0, 0, 0], [0, 1, 0, 0]], dtype=np.float64 )
+    R = np.identity( 2 ) * 47
+    P = np.identity( 4 ) * 0.0001
+    X = np.tile( np.array( [500.0, 500.0, 0.0, 0.0] ), (predictions.shape[0], 1) )
+
+    smoothed = np.full( predictions.shape, np.nan )
+    for i in np.nonzero( np.all( np.isfinite( predictions[0] ), axis=1 ) )[0]:
+        Pp = F @ P @ F.T + Q
+        K = Pp @ H.T @ np.linalg.inv( H @ Pp @ H.T + R )
+        Xp = X @ F.T
+        X = Xp + (predictions[:, i, :] - Xp @ H.T) @ K.T
+        P = (np.identity( 4 ) - K @ H) @ Pp
+        smoothed[:, i, :] = X @ H.T
+    return smoothed
+
+
+##################################################################
+def evaluateParticipant( directory, ridgeParameters, kalman ):
+    # Result rows for every model and ridge parameter
+    replay = ParticipantReplay( directory )
+    rows = []
+    for model in models:
+        pixels = predictFrames( replay, model, ridgeParameters )
+        if kalman:
+            pixels = kalmanFilter( pixels )
+        diff = replay.normalized( pixels ) - replay.gaze[None, :, :]
+        error = np.sqrt( np.sum( diff**2, axis=2 ) )
+        errorPix = np.sqrt( (diff[:, :, 0] * replay.screenWidthPixels)**2 + (diff[:, :, 1] * replay.screenHeightPixels)**2 )
+        scored = np.isfinite( error[0] ) & replay.hasGaze
+
+        for v, video in [(-1, 'all')] + list( enumerate( replay.videoNames ) ):
+            mask = scored if v < 0 else scored & (replay.videoIndex == v)
+            for l, k in enumerate( ridgeParameters ):
+                n = int( np.count_nonzero( mask ) )
+                rows.append( {'participant': directory, 'model': model, 'ridgeParameter': k, 'video': video, 'frames': n,
+                              'meanError': float( np.mean( error[l, mask] ) ) if n > 0 else '',
+                              'meanErrorPix': float( np.mean( errorPix[l, mask] ) ) if n > 0 else '',
+                              'medianErrorPix': float( np.median( errorPix[l, mask] ) ) if n > 0 else ''} )
+    return rows
+
+
+def main():
+    workers = os.cpu_count() or 1
+    if len(sys.argv) >= 2:
+        workers = max( int(sys.argv[1]), 1 )
+    ridgeParameters = [defaultRidgeParameter]
+    if len(sys.argv) >= 3:
+        ridgeParameters = [float(k) for k in sys.argv[2].split( ',' )]
+    kalman = not (len(sys.argv) >= 4 and sys.argv[3] == 'raw')
+
+    participantDirList = [d for d in findParticipantDirs() if len(loadParticipantColumns( d, outputPrefix )) > 0]
+    print( "Evaluating " + ", ".join( models ) + " at " + str(len(ridgeParameters)) + " ridge parameters for " + str(len(participantDirList)) + \
+        " participants with " + str(workers) + " worker processes" + ("" if kalman else ", without the Kalman filter") + "..." )
+
+    start = time.time()
+    rows = []
+    with ProcessPoolExecutor( max_workers=workers ) as pool:
+        futures = {pool.submit( evaluateParticipant, d, ridgeParameters, kalman ): d for d in participantDirList}
+        for i, future in enumerate( as_completed( futures ) ):
+            try:
+                rows.extend( future.result() )
+            except Exception as e:
+                print( "    Error evaluating " + futures[future] + ": " + str(e) )
+                continue
+            print( "[" + str(i+1) + "/" + str(len(participantDirList)) + "] " + futures[future] )
+    rows.sort( key=lambda r: (r['participant'], r['model'], r['ridgeParameter']) )
+
+    with open( outputPrefix + resultsName, 'w', newline='' ) as f:
+        writer = csv.DictWriter( f, fieldnames=resultFields )
+        writer.writeheader()
+        writer.writerows( rows )
+
+    print( "Done in {:.1f}s; results in {}".format( time.time() - start, outputPrefix + resultsName ) )
+    print( "{:<14} {:>14} {:>14} {:>16}".format( "model", "ridge param", "participants", "mean error pix" ) )
+    for model in models:
+        for k in ridgeParameters:
+            errors = [r['meanErrorPix'] for r in rows if r['model'] == model and r['ridgeParameter'] == k and r['video'] == 'all' and r['frames'] > 0]
+            if len(errors) > 0:
+                print( "{:<14} {:>14g} {:>14} {:>16.1f}".format( model, k, len(errors), np.mean( errors ) ) )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+import os
+import json
+import numpy as np
+
+from cacheFiles import fileKey,loadJSON,saveJSON,saveArray
+
+
+##################################################################
+# Columnar Tobii log store
+#
+# One structured NumPy record per Tobii sample, sorted by timestamp, instead of one
+# Python object per sample. At 60-120 Hz a session is hundreds of thousands of samples.
+tobiiDtype = np.dtype([('timestamp', np.int64),             # Unix milliseconds
+                       ('rightEyeValid', np.int8),
+                       ('leftEyeValid', np.int8),
+                       ('rightScreenGazeX', np.float64),
+                       ('rightScreenGazeY', np.float64),
+                       ('leftScreenGazeX', np.float64),
+                       ('leftScreenGazeY', np.float64)])
+
+# Binary sidecar written next to the Tobii .txt log, e.g., P_01/P_01.tobii.npy, with the modification
+# time and size of the log it came from in P_01/P_01.tobii.key.json
+tobiiCacheSuffix = ".tobii.npy"
+tobiiKeySuffix = ".tobii.key.json"
+
+
+def msFromSecondsString( s ):
+    # Exact round( Decimal(s) * 1000 ) without going through Decimal or binary floating point.
+    # 'true_time' is in seconds with sub-millisecond digits, e.g., "1491423217.5645"
+    s = s.strip()
+    neg = s.startswith('-')
+    if neg:
+        s = s[1:]
+    if 'e' in s or 'E' in s:
+        # Not written by our logger, but be correct anyway
+        from decimal import Decimal
+        ms = round( Decimal(s) * 1000 )
+        return -ms if neg else ms
+
+    whole, _, frac = s.partition('.')
+    frac = frac.ljust(3, '0')
+    ms = int(whole or '0') * 1000 + int(frac[0:3])
+    rest = frac[3:].rstrip('0')
+    if rest:
+        # Round half to even, as round() on a Decimal does
+        half = '5'
+        if rest > half or (rest == half and ms % 2 == 1):
+            ms = ms + 1
+    return -ms if neg else ms
+
+
+def parseTobiiLog( tobiiLogFile ):
+    # Each line is a JSON object. Floats are kept as strings by the JSON parser: the gaze points
+    # are converted to float64 in one go, and the timestamps are rounded exactly from the text.
+    timestamps = []
+    rightValid = []
+    leftValid = []
+    gaze = []
+
+    with open( tobiiLogFile, 'r' ) as f:
+        for line in f:
+            try:
+                l = json.loads(line, parse_float=str)
+            except ValueError:
+                # Some logs have a broken last line
+                print( "    Skipping malformed Tobii log line in " + tobiiLogFile )
+                continue
+
+            timestamps.append( msFromSecondsString( str(l['true_time']) ) )
+            rightValid.append( l['right_pupil_validity'] )
+            leftValid.append( l['left_pupil_validity'] )
+            gaze.append( (l['right_gaze_point_on_display_area'][0], l['right_gaze_point_on_display_area'][1],
+                          l['left_gaze_point_on_display_area'][0], l['left_gaze_point_on_display_area'][1]) )
+
+    tobii = np.empty( len(timestamps), dtype=tobiiDtype )
+    tobii['timestamp'] = timestamps
+    tobii['rightEyeValid'] = rightValid
+    tobii['leftEyeValid'] = leftValid
+    if len(gaze) > 0:
+        gaze = np.array( gaze, dtype=object ).astype( np.float64 )
+        tobii['rightScreenGazeX'] = gaze[:,0]
+        tobii['rightScreenGazeY'] = gaze[:,1]
+        tobii['leftScreenGazeX'] = gaze[:,2]
+        tobii['leftScreenGazeY'] = gaze[:,3]
+
+    # Keep the store sorted by time so it can be searched directly
+    order = np.argsort( tobii['timestamp'], kind='stable' )
+    return tobii[order]
+
+
+def loadTobiiLog( tobiiLogFile ):
+    # Load from the binary sidecar if it was made from this log; otherwise parse and write it
+    cacheFile = os.path.splitext( tobiiLogFile )[0] + tobiiCacheSuffix
+    keyFile = os.path.splitext( tobiiLogFile )[0] + tobiiKeySuffix
+    key = {'log': fileKey( tobiiLogFile )}
+    if os.path.isfile( cacheFile ) and loadJSON( keyFile ) == key:
+        try:
+            tobii = np.load( cacheFile, mmap_mode='r' )
+            if tobii.dtype == tobiiDtype:
+                return tobii
+            print( "    Tobii cache " + cacheFile + " has an old layout; re-parsing..." )
+        except (OSError, ValueError) as e:
+            print( "    Could not read Tobii cache " + cacheFile + " (" + str(e) + "); re-parsing..." )
+
+    tobii = parseTobiiLog( tobiiLogFile )
+    try:
+        # No key while the arrays are replaced, so that it never vouches for other ones
+        if os.path.isfile( keyFile ):
+            os.remove( keyFile )
+        saveArray( cacheFile, tobii )
+        saveJSON( keyFile, key )
+    except OSError as e:
+        print( "    Could not write Tobii cache " + cacheFile + ": " + str(e) )
+    return tobii
+
+
+##################################################################
+# Tobii <-> video frame alignment
+#
+def nearestTobiiIndices( tobiiTimestamps, frameTimesEpoch ):
+    # For each frame time, the index of the closest Tobii sample in time (-1 if there are no samples).
+    # One batched binary search over the sorted timestamp index, so the order the videos arrive in doesn't matter.
+    frameTimesEpoch = np.asarray( frameTimesEpoch, dtype=np.int64 )
+    if tobiiTimestamps is None or len(tobiiTimestamps) == 0:
+        return np.full( len(frameTimesEpoch), -1, dtype=np.int64 )
+
+    after = np.searchsorted( tobiiTimestamps, frameTimesEpoch, side='left' )
+    after = np.minimum( after, len(tobiiTimestamps)-1 )
+    before = np.maximum( after-1, 0 )
+
+    # Pick the one which is closest in time
+    diffBefore = np.abs( frameTimesEpoch - tobiiTimestamps[before] )
+    diffAfter = np.abs( frameTimesEpoch - tobiiTimestamps[after] )
+    return np.where( diffBefore < diffAfter, before, after ).astype( np.int64 )
+
+
+def tobiiSamplesAt( tobii, indices ):
+    # Copy out the matched records; frames without a match get invalid samples at -1
+    samples = np.full( len(indices), -1, dtype=tobiiDtype )
+    samples['rightEyeValid'] = 0
+    samples['leftEyeValid'] = 0
+    found = indices >= 0
+    samples[found] = tobii[ indices[found] ]
+    return samples
+
+
+def tobiiGazePoints( samples ):
+    # Screen gaze for each sample, depending on which eyes are valid:
+    # both -> average, one -> that eye, neither -> -1
+    rightValid = samples['rightEyeValid'] == 1
+    leftValid = samples['leftEyeValid'] == 1
+
+    x = np.full( len(samples), -1.0 )
+    y = np.full( len(samples), -1.0 )
+
+    both = rightValid & leftValid
+    x[both] = (samples['leftScreenGazeX'][both] + samples['rightScreenGazeX'][both]) / 2.0
+    y[both] = (samples['leftScreenGazeY'][both] + samples['rightScreenGazeY'][both]) / 2.0
+
+    rightOnly = rightValid & ~leftValid
+    x[rightOnly] = samples['rightScreenGazeX'][rightOnly]
+    y[rightOnly] = samples['rightScreenGazeY'][rightOnly]
+
+    leftOnly = leftValid & ~rightValid
+    x[leftOnly] = samples['leftScreenGazeX'][leftOnly]
+    y[leftOnly] = samples['leftScreenGazeY'][leftOnly]
+
+    return x, y
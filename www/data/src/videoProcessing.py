@@ -1,25 +1,44 @@
 import os
+import time
 import datetime
 import pytz
 import tornado.escape
 import csv
+import threading
 import cv2
 import numpy as np
 
-from participant import newParticipant
 import global_variables
+from metrics import serverMetrics
 
 
 ##################################################################
 # Image/video operations
 #
-def readImageRGBA( filename ):
-    # Add an alpha channel, because JavaScript ImageData object requires rgba, and I think it'll be quicker to do it in numpy
-    b_channel, g_channel, r_channel = cv2.split( cv2.imread( filename ) )
-    a_channel = np.ones(b_channel.shape, dtype=b_channel.dtype) * 255
-    return cv2.merge((r_channel, g_channel, b_channel, a_channel))
+# Reusable RGBA buffers, one per frame resolution, per thread
+rgbaBuffers = threading.local()
+
+def rgbaBuffer( height, width ):
+    buffers = getattr( rgbaBuffers, 'byShape', None )
+    if buffers is None:
+        buffers = rgbaBuffers.byShape = {}
+    buf = buffers.get( (height, width) )
+    if buf is None:
+        buf = buffers[(height, width)] = np.empty( (height, width, 4), dtype=np.uint8 )
+    return buf
 
-# p = global_variables.participant
+def readImageRGBA( filename ):
+    # JavaScript ImageData objects require rgba. Swap the channels and add the alpha channel in
+    # one cvtColor, straight into a preallocated buffer for this resolution.
+    # NOTE: the buffer is reused by the next call on this thread; copy it out (e.g., .tobytes()) before then.
+    with serverMetrics.timed( 'pngRead' ):
+        bgr = cv2.imread( filename )
+    with serverMetrics.timed( 'rgbaConvert' ):
+        rgba = rgbaBuffer( bgr.shape[0], bgr.shape[1] )
+        cv2.cvtColor( bgr, cv2.COLOR_BGR2RGBA, dst=rgba )
+    return rgba
+
+# p = participant
 def loadScreenCapVideo( p ):
 
     ##########################################################################
@@ -79,8 +98,10 @@ def loadScreenCapVideo( p ):
     ##########################################################################
 
 
-# p = global_variables.participant
-def writeScreenCapOutputFrames( p, frameTimeEpoch ):
+# session = extractionScheduler.ExtractionSession
+def writeScreenCapOutputFrames( session, frameTimeEpoch ):
+
+    p = session.participant
 
     ###########################################################################################################
     # Display the corresponding video frame
@@ -95,29 +116,30 @@ def writeScreenCapOutputFrames( p, frameTimeEpoch ):
         # For some reason, the 'Laptop' screen recording is twice as large as it needs to be
         if p.pcOrLaptop == "Laptop":
             image = cv2.resize( image, (int(p.screencapFrameWidth),int(p.screencapFrameHeight) ) )
-        prevMSECIntoVideo = msecIntoVid
+        p.prevMSECIntoVideo = msecIntoVid
 
         # Write the frame
         if ret:
-            center = ( int(p.screencapFrameWidth * float(global_variables.tobiiCurrentX)), int(p.screencapFrameHeight * float(global_variables.tobiiCurrentY)) )
+            center = ( int(p.screencapFrameWidth * float(session.tobiiCurrentX)), int(p.screencapFrameHeight * float(session.tobiiCurrentY)) )
             image = cv2.circle(image, center, 10, (0,255,0), -1)
-            center = ( int(p.screencapFrameWidth * float(wgCurrentX)), int(p.screencapFrameHeight * float(wgCurrentY)) )
+            center = ( int(p.screencapFrameWidth * float(session.wgCurrentX)), int(p.screencapFrameHeight * float(session.wgCurrentY)) )
             image = cv2.circle(image, center, 10, (0,0,255), -1)
             p.screencapOut.write(image)
     
     # Or, we just play the video until we hit the right time (cheap)
     else:
         # Decode frames until we're at the right place
-        while msecIntoVid > p.screencap.get(cv2.CAP_PROP_POS_MSEC) + int(1000/p.screencap.get(cv2.CAP_PROP_FPS)):
-            print( "    Writing catchup frames..." + str(msecIntoVid) + " " + str(p.screencap.get(cv2.CAP_PROP_POS_MSEC)) )
+        # (renderScreenCapOverlay.py does this offline, in one pass per video)
+        frameMS = int(1000/p.screencapFrameRate)
+        while msecIntoVid > p.screencap.get(cv2.CAP_PROP_POS_MSEC) + frameMS:
             ret, image = p.screencap.read()
             if p.pcOrLaptop == "Laptop":
                 image = cv2.resize( image, (int(p.screencapFrameWidth),int(p.screencapFrameHeight) ) )
 
             if ret:
-                center = ( int(p.screencapFrameWidth * float(global_variables.tobiiCurrentX)), int(p.screencapFrameHeight * float(global_variables.tobiiCurrentY)) )
+                center = ( int(p.screencapFrameWidth * float(session.tobiiCurrentX)), int(p.screencapFrameHeight * float(session.tobiiCurrentY)) )
                 image = cv2.circle(image, center, 10, (0,255,0), -1)
-                center = ( int(p.screencapFrameWidth * float(wgCurrentX)), int(p.screencapFrameHeight * float(wgCurrentY)) )
+                center = ( int(p.screencapFrameWidth * float(session.wgCurrentX)), int(p.screencapFrameHeight * float(session.wgCurrentY)) )
                 image = cv2.circle(image, center, 10, (0,0,255), -1)
                 p.screencapOut.write(image)
 
@@ -141,35 +163,58 @@ def closeScreenCapOutVideo( p ):
     if p.screencapOut != None:
         p.screencapOut.release()
 
-def sendVideoFrame( wsh, fn, pv ):
+# i = index of the frame in pv.frameFilesList, data = its bytes as encoded by session.transport (read ahead,
+# or streamed from ffmpeg); RGBA read here if None. keyFrame: see frameTransport.py
+def sendVideoFrame( session, pv, i, data=None, keyFrame=False ):
 
     # Send the video frame, with the timestamp first
-    # Reminder: "frame_{:08d}_{:08d}.png"
-    frameNum = fn[len(fn)-21:len(fn)-13]
-    timestamp = fn[len(fn)-12:len(fn)-4]
+    # Formatted as in the frame file names, "frame_{:08d}_{:08d}.png"
+    fn = pv.frameFilesList[i]
+    frameNum = "{:08d}".format( i )
+    timestamp = "{:08d}".format( pv.framePts[i] )
+
+    # Tobii sample aligned to this frame, so the client compares against the right ground truth
+    session.tobiiCurrentX = pv.tobiiGazeX[i]
+    session.tobiiCurrentY = pv.tobiiGazeY[i]
+
+    # We don't know how many frames there are until a streamed video has been fully decoded
+    frameNumTotal = len(pv.frameFilesList) if pv.frameStream is None else -1
 
     parcel = ({'msgID': "2",
                'videoFilename': pv.filename,
                'frameNum': str(frameNum),
-               'frameNumTotal': str(len(pv.frameFilesList)),
+               'frameNumTotal': str(frameNumTotal),
                'frameTimeEpoch': str(int(timestamp) + pv.startTimestamp),
                'frameTimeIntoVideoMS': str(timestamp), 
-               'tobiiX': "{:+.4f}".format(global_variables.tobiiCurrentX),
-               'tobiiY': "{:+.4f}".format(global_variables.tobiiCurrentY)})
-    wsh.write_message( tornado.escape.json_encode(parcel) )
-    wsh.write_message( readImageRGBA( fn ).tobytes(), binary=True )
+               'tobiiX': "{:+.4f}".format(session.tobiiCurrentX),
+               'tobiiY': "{:+.4f}".format(session.tobiiCurrentY),
+               'encoding': session.transport.encoding() if data is not None else 'rgba',
+               'keyFrame': '1' if keyFrame else '0'})
+    if data is None:
+        # One copy out of the reusable buffer; Tornado only takes bytes for binary messages
+        data = readImageRGBA( fn ).tobytes()
+    unit = session.unitName()
+    with serverMetrics.timed( 'send', unit ):
+        session.wsh.write_message( tornado.escape.json_encode(parcel) )
+        session.wsh.write_message( data, binary=True )
+    session.frameSentTimes[i] = time.perf_counter()
+    session.transport.sent( len(data) )
+    serverMetrics.frameSent( unit, len(data) )
     #can delete images here for convenience - causes errors on rereading
     #os.remove(fn)
 
-def sendVideoEnd( wsh ):
+def sendVideoEnd( session ):
 
-    # Progress video if not at end of video list for global_variables.participant
-    if global_variables.participant.videosPos+1 >= len(global_variables.participant.videos):
-        # New global_variables.participant!
-        newParticipant( wsh )
+    # Regular 'video end' message; will trigger return of {'msgID': "1"}
+    parcel = {'msgID': "4"}
+    session.wsh.write_message( tornado.escape.json_encode(parcel) )
 
-    else:
-        # Regular 'video end' message; will trigger return of {'msgID': "1"}
-        parcel = {'msgID': "4"}
-        wsh.write_message( tornado.escape.json_encode(parcel) )
+def sendExtractionProgress( session, pv, framesDone, framesTotal, eta ):
 
+    # While the server extracts a video's frames; eta in seconds, framesTotal/eta -1 if not known yet
+    parcel = ({'msgID': "5",
+               'videoFilename': pv.filename,
+               'framesDone': str(framesDone),
+               'framesTotal': str(framesTotal),
+               'etaSeconds': "{:.1f}".format(eta)})
+    session.wsh.write_message( tornado.escape.json_encode(parcel) )
@@ -25,6 +25,16 @@ var processTimePrev = 0;
 
 // WebSocket for sending image data
 var ws;
+// Frames the server may stream ahead of our results, e.g., webgazerExtractClient.html?window=8
+// 1 is the original lock-step protocol: one frame, one result, next frame.
+var pipelineWindow = parseInt( new URLSearchParams( window.location.search ).get( 'window' ) ) || 1;
+// How the server sends frames: raw, png, jpeg, webp, deflate or delta, e.g., webgazerExtractClient.html?transport=jpeg
+var transport = new URLSearchParams( window.location.search ).get( 'transport' ) || "raw";
+// delta transport: the last frame decoded, which the next one is XORed with
+var prevFrameRGBA = null;
+// Frames received but not yet run through WebGazer, oldest first: { info: msgID 2 object, blob: image }
+var frameQueue = [];
+var processingFrames = false;
 // CLM tracker
 var fm;
 // TODO magic numbers
@@ -94,29 +104,19 @@ function onLoad()
     document.body.appendChild(overlay);
 
     fm = webgazer.getTracker();
-    // Start WebSocket
-    ws = new WebSocket("ws://localhost:8000/websocket");
+    // Start WebSocket; connect back to whichever extract server served this page, so workers can run on other machines
+    ws = new WebSocket("ws://" + window.location.host + "/websocket?window=" + pipelineWindow + "&transport=" + transport);
     ws.binaryType = "blob"
     ws.onopen = function(e) 
     {};
 
     ws.onmessage = async function(e) 
     {
-        // Received image data
+        // Received image data; it belongs to the frame info that arrived just before it
         if( e.data instanceof Blob )
         {
-            var c = document.getElementById('wsCanvas')
-            ctx = c.getContext('2d')
-
-            var fr = new FileReader();
-            fr.onload = async function (e) {
-                var buffer = new Uint8ClampedArray(e.target.result);
-                var imageData = new ImageData(buffer, width, height);
-                ctx.putImageData( imageData, 0, 0 )
-
-                runWebGazerSendResult();
-            };
-            fr.readAsArrayBuffer(e.data);
+            frameQueue[frameQueue.length-1].blob = e.data;
+            processFrameQueue();
         }
         else
         {
@@ -164,22 +164,18 @@ function onLoad()
                 var send = { msgID: "1" };
                 sendMsg( JSON.stringify(send) );
             }
-            // Receiving frame info
+            // Receiving frame info; queue it until its image arrives
             else if( obj.msgID == "2" )
             {
-                videoFilename = obj.videoFilename;
-                frameNum = parseInt( obj.frameNum );
-                frameNumTotal = parseInt( obj.frameNumTotal );
-
-                tobiiX = parseFloat( obj.tobiiX );
-                tobiiY = parseFloat( obj.tobiiY );
-
-                frameTimeEpoch = parseInt( obj.frameTimeEpoch )
-                frameTimeIntoVideoMS = parseInt( obj.frameTimeIntoVideoMS );
-                // Update screen cap video
-                seekTimeMS = frameTimeEpoch - screencapStartTime + screencapTimeOffsetMS;
-                if( showScreenCap )
-                    screencapVideo.currentTime = seekTimeMS / 1000.0
+                frameQueue.push( { info: obj, blob: null } );
+            }
+            // Server is extracting the next video's frames; show how far along it is
+            else if( obj.msgID == "5" )
+            {
+                var framesTotal = parseInt( obj.framesTotal );
+                var eta = parseFloat( obj.etaSeconds );
+                var pDiag = document.getElementById("partvidframe")
+                pDiag.innerHTML  = "Video: " + obj.videoFilename + "<br> Extracting frames: " + obj.framesDone + "/" + (framesTotal >= 0 ? framesTotal : "?") + (eta >= 0 ? " (about " + eta.toFixed(0) + "s to go)" : "");
             }
             else if( obj.msgID == "4" )
             {
@@ -196,6 +192,76 @@ async function sendMsg(msg) {
     ws.send(msg);
 }
 
+function setCurrentFrame( obj )
+{
+    videoFilename = obj.videoFilename;
+    frameNum = parseInt( obj.frameNum );
+    frameNumTotal = parseInt( obj.frameNumTotal );
+
+    tobiiX = parseFloat( obj.tobiiX );
+    tobiiY = parseFloat( obj.tobiiY );
+
+    frameTimeEpoch = parseInt( obj.frameTimeEpoch )
+    frameTimeIntoVideoMS = parseInt( obj.frameTimeIntoVideoMS );
+    // Update screen cap video
+    seekTimeMS = frameTimeEpoch - screencapStartTime + screencapTimeOffsetMS;
+    if( showScreenCap )
+        screencapVideo.currentTime = seekTimeMS / 1000.0
+}
+
+// Run WebGazer over queued frames one at a time, in the order they were sent.
+// With a pipeline window > 1 the next frames are already here while this one is processed.
+async function processFrameQueue()
+{
+    if( processingFrames )
+        return;
+    processingFrames = true;
+
+    while( frameQueue.length > 0 && frameQueue[0].blob !== null )
+    {
+        var f = frameQueue.shift();
+        setCurrentFrame( f.info );
+
+        await drawFrame( f.info, f.blob );
+
+        await runWebGazerSendResult();
+    }
+
+    processingFrames = false;
+}
+
+// Put a received frame on the canvas WebGazer reads from, decoding it as the server says it is encoded
+async function drawFrame( info, blob )
+{
+    var c = document.getElementById('wsCanvas')
+    ctx = c.getContext('2d')
+    if( info.encoding == "png" || info.encoding == "jpeg" || info.encoding == "webp" )
+    {
+        var bitmap = await createImageBitmap( blob );
+        ctx.drawImage( bitmap, 0, 0 );
+        bitmap.close();
+        return;
+    }
+
+    var buffer;
+    if( info.encoding == "delta" )
+    {
+        // zlib stream of this frame XORed with the previous one (or with nothing, for a key frame)
+        var inflated = blob.stream().pipeThrough( new DecompressionStream( "deflate" ) );
+        buffer = new Uint8ClampedArray( await new Response( inflated ).arrayBuffer() );
+        if( info.keyFrame != "1" && prevFrameRGBA !== null )
+        {
+            for( var i = 0; i < buffer.length; i++ )
+                buffer[i] ^= prevFrameRGBA[i];
+        }
+        prevFrameRGBA = buffer.slice();
+    }
+    else
+        buffer = new Uint8ClampedArray( await blob.arrayBuffer() );
+    var imageData = new ImageData(buffer, width, height);
+    ctx.putImageData( imageData, 0, 0 )
+}
+
 // Thanks to http://jsfiddle.net/d4rcuxw9/1/
 // https://stackoverflow.com/questions/29573700/finding-the-difference-between-two-string-in-javascript-with-regex
 function getStringDifference(a, b)
@@ -222,13 +288,15 @@ async function runWebGazerSendResult()
 
     /////////////////////////////////////////////////////////
     // Interaction inputs (default values)
-    s.mouseMoveX = [];
-    s.mouseMoveY = [];
-    s.mouseClickX = [];
-    s.mouseClickY = [];
-    s.keyPressed = [];
-    s.keyPressedX = [];
-    s.keyPressedY = [];
+    // These are only for display; the server takes them from the input log itself
+    var interactions = {};
+    interactions.mouseMoveX = [];
+    interactions.mouseMoveY = [];
+    interactions.mouseClickX = [];
+    interactions.mouseClickY = [];
+    interactions.keyPressed = [];
+    interactions.keyPressedX = [];
+    interactions.keyPressedY = [];
 
     //////////////////////////////////////////////////////////
     // Push mouse clicks and keyboard input from logs to WebGazer
@@ -243,26 +311,26 @@ async function runWebGazerSendResult()
                 if( !videoFilename.includes("dot_test_final.") )
                     webgazer.recordScreenPosition(logs[logsCount].clientX, logs[logsCount].clientY, "click");
                 
-                s.mouseClickX.push( (logs[logsCount].clientX + docStartX) / screenWidthPixels );
-                s.mouseClickY.push( (logs[logsCount].clientY + docStartY) / screenHeightPixels );
+                interactions.mouseClickX.push( (logs[logsCount].clientX + docStartX) / screenWidthPixels );
+                interactions.mouseClickY.push( (logs[logsCount].clientY + docStartY) / screenHeightPixels );
                 
                 mouseImg.style.height = '20px';
                 mouseImg.style.width = '20px';
-                mouseImg.style.top = (s.mouseClickY * screencapVideo.height) -10 + 'px';
-                mouseImg.style.left = width + (s.mouseClickX * screencapVideo.width) -10 + 'px';
+                mouseImg.style.top = (interactions.mouseClickY * screencapVideo.height) -10 + 'px';
+                mouseImg.style.left = width + (interactions.mouseClickX * screencapVideo.width) -10 + 'px';
                 break;
             case "mousemove":
                 // Ignore all interactions for the 'dot_test_final.' video
                 if( !videoFilename.includes("dot_test_final.") )
                     webgazer.recordScreenPosition(logs[logsCount].clientX, logs[logsCount].clientY, "move");
 
-                s.mouseMoveX.push( (logs[logsCount].clientX + docStartX) / screenWidthPixels );
-                s.mouseMoveY.push( (logs[logsCount].clientY + docStartY) / screenHeightPixels );
+                interactions.mouseMoveX.push( (logs[logsCount].clientX + docStartX) / screenWidthPixels );
+                interactions.mouseMoveY.push( (logs[logsCount].clientY + docStartY) / screenHeightPixels );
 
                 mouseImg.style.height = '10px';
                 mouseImg.style.width = '10px';
-                mouseImg.style.top = (s.mouseMoveY * screencapVideo.height) -5 + 'px';
-                mouseImg.style.left = width + (s.mouseMoveX * screencapVideo.width) -5 + 'px';
+                mouseImg.style.top = (interactions.mouseMoveY * screencapVideo.height) -5 + 'px';
+                mouseImg.style.left = width + (interactions.mouseMoveX * screencapVideo.width) -5 + 'px';
                 break;
             case "textInput":
                 //IMPORTANT: CHANGE WEBGAZER.js CODE IF YOU WANT TO INCLUDE TYPING
@@ -316,14 +384,14 @@ async function runWebGazerSendResult()
                 //     keyPressed = 'equals';
 
                 console.log( "Key pressed: " + keyPressed );
-                s.keyPressed.push( keyPressed );
-                s.keyPressedX.push( (logs[logsCount].pos.left + docStartX) / screenWidthPixels );
-                s.keyPressedY.push( (logs[logsCount].pos.top  + docStartY) / screenHeightPixels );
+                interactions.keyPressed.push( keyPressed );
+                interactions.keyPressedX.push( (logs[logsCount].pos.left + docStartX) / screenWidthPixels );
+                interactions.keyPressedY.push( (logs[logsCount].pos.top  + docStartY) / screenHeightPixels );
 
                 mouseImg.style.height = '10px';
                 mouseImg.style.width = '3px';
-                mouseImg.style.top = (s.keyPressedY * screencapVideo.height) + 'px';
-                mouseImg.style.left = width + (s.keyPressedX * screencapVideo.width) + 'px';
+                mouseImg.style.top = (interactions.keyPressedY * screencapVideo.height) + 'px';
+                mouseImg.style.left = width + (interactions.keyPressedX * screencapVideo.width) + 'px';
                 
                 break;
         }
@@ -380,7 +448,8 @@ async function runWebGazerSendResult()
 
     // Update display
     var pDiag = document.getElementById("partvidframe")
-    pDiag.innerHTML  = "Video: " + videoFilename + "<br> Frame num: " + frameNum + "/" + frameNumTotal + " Video current time (MS): " + frameTimeIntoVideoMS;
+    // frameNumTotal is -1 while the server is still decoding a streamed video
+    pDiag.innerHTML  = "Video: " + videoFilename + "<br> Frame num: " + frameNum + "/" + (frameNumTotal >= 0 ? frameNumTotal : "?") + " Video current time (MS): " + frameTimeIntoVideoMS;
     //console.log( "Frame num: " + frameNum + "    Video current time: " + frameTimeIntoVideoMS );
 
     var eDiag = document.getElementById("wgError")
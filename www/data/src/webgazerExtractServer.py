@@ -4,6 +4,7 @@ import os
 import subprocess
 import sys
 import glob
+import asyncio
 import re
 
 import time
@@ -25,43 +26,46 @@ import json, csv, urllib
 import numpy as np
 
 from videoProcessing import readImageRGBA,loadScreenCapVideo,writeScreenCapOutputFrames,openScreenCapOutVideo,\
-    closeScreenCapOutVideo,sendVideoFrame,sendVideoEnd
+    closeScreenCapOutVideo,sendVideoFrame,sendVideoEnd,sendExtractionProgress
 import global_variables
-from participant import ParticipantData,TobiiData,sendParticipantInfo,ParticipantVideo,newParticipant
+from participant import ParticipantData,sendParticipantInfo,ParticipantVideo,alignTobiiToFrames,findParticipantDirs,interactionsBefore
+from extractionScheduler import ExtractionSession,ExtractionScheduler
+from frameStream import FfmpegFrameStream
+from frameCache import FrameCache
+from frameTransport import FrameTransport,transportModes,defaultTransport
+from csvOutput import BufferedCSVWriter,csvTempName,csvDoneName,fieldnames,fmPosKeys,eyeFeaturesKeys
+from columnarOutput import ColumnarVideoWriter,columnsTempName,columnsDoneName
+from frameExtraction import outputPrefix,frameOutFormat,videoFramesDir,videoPtsFile,framesExtracted,FrameExtraction,\
+    loadFrameManifest,FrameFiles
+from ptsIndex import loadPtsIndex
+from metrics import serverMetrics
 
 # TODO
 # - Check Aaron's timestamps
 # - Fix screen cap write out
 
-# Where are we putting the output?
-outputPrefix = "../FramesDataset/"
-
-# Video frame extraction parameters
-frameExtractFormat = "frame_{:08d}.png"
-frameOutFormat = "frame_{:08d}_{:08d}.png"
-
-# CSV File names
-csvTempName = "gazePredictions.csv"
-csvDoneName = "gazePredictionsDone.csv"
-
 # Participant characteristics file
 writeCSV = True
 
+# Also write typed, memory-mappable columns for each video (see columnarOutput.py)
+writeColumns = False
 
+# Gaze prediction rows are handed to the OS every csvFlushRows rows, or csvFlushMS after the last time
+csvFlushRows = 64
+csvFlushMS = 1000
 
+# Frames in flight per connection. 1 is the original lock-step protocol (send a frame, wait for
+# its msgID 3 result, send the next). Clients can ask for more with ws://.../websocket?window=N.
+defaultPipelineWindow = 1
+maxPipelineWindow = 64
 
+# Also write the timings and counters of each video to ../FramesDataset/P_XX_video_metrics.json when
+# it is done. The server's totals are always on http://localhost:8000/metrics (see metrics.py)
+writeMetricsSummary = False
 
+# Frame extractions running on the IOLoop, by frames directory (see frameExtraction.FrameExtraction)
+framesBeingExtracted = {}
 
-##################################################################
-# CSV header object field names
-fmPosKeys = ['fmPos_%04d' % i for i in range(0, 468)]
-eyeFeaturesKeys = ['eyeFeatures_%04d' % i for i in range(0, 120)]
-fieldnames = (['participant','frameImageFile','frameTimeEpoch','frameNum','mouseMoveX','mouseMoveY',
-               'mouseClickX','mouseClickY','keyPressed','keyPressedX','keyPressedY',
-               'tobiiLeftScreenGazeX','tobiiLeftScreenGazeY','tobiiRightScreenGazeX','tobiiRightScreenGazeY',
-               'webGazerX','webGazerY','error','errorPix'])
-fieldnames.extend( fmPosKeys )
-fieldnames.extend( eyeFeaturesKeys )
 
 
 
@@ -70,142 +74,272 @@ fieldnames.extend( eyeFeaturesKeys )
 ######################################################################################
 # Processors for messages
 
-# p = participant
-def writeDataToCSV( p, msg ):
+# session = extractionScheduler.ExtractionSession, i = index of the frame in the leased video that msg is the result for
+def writeDataToCSV( session, i, msg ):
 
     ###########################################################################################################
     # Store current WebGazer prediction from browser
-    global_variables.wgCurrentX = float( msg["webGazerX"] )
-    global_variables.wgCurrentY = float( msg["webGazerY"] )
+    p = session.participant
+    session.wgCurrentX = float( msg["webGazerX"] )
+    session.wgCurrentY = float( msg["webGazerY"] )
     wgError = float( msg["error"] )
     wgErrorPix = float( msg["errorPix"] )
 
 
     ###########################################################################################################
-    # Find the closest Tobii timestamp to our current video timestamp
+    # Look up the Tobii sample closest in time to this frame
     #
-    # As time only goes forwards, tobiiListPos is a counter which persists over GET requests.
-    # The videos arrive in non-chronological order, however, so we have to reset tobiiListPos on each new video
+    # Every frame of the video was matched against the participant's Tobii timestamp index
+    # by alignTobiiToFrames before the first frame was sent, so this is just an array lookup.
     frameTimeEpoch = int( msg["frameTimeEpoch"] )
-    while p.tobiiListPos < len(p.tobiiList)-2 and frameTimeEpoch - p.tobiiList[p.tobiiListPos].timestamp > 0:
-        p.tobiiListPos = p.tobiiListPos + 1
-
-    if p.tobiiListPos == len(p.tobiiList):
-        # We've come to the end of the list and there are no more events...
-        print( "Error: at end of Tobii event list; no matching timestamp" )
-        global_variables.tobiiCurrentX = -1
-        global_variables.tobiiCurrentY = -1
-    else:
-        # TobiiList
-        diffCurr = frameTimeEpoch - p.tobiiList[p.tobiiListPos].timestamp
-        diffNext = frameTimeEpoch - p.tobiiList[p.tobiiListPos+1].timestamp
-
-        # Pick the one which is closest in time
-        if abs(diffCurr) < abs(diffNext):
-            td = p.tobiiList[p.tobiiListPos]
-        else:
-            td = p.tobiiList[p.tobiiListPos+1]
-
-        # Check validity for return value
-        if td.rightEyeValid == 1 and td.leftEyeValid == 1:
-            global_variables.tobiiCurrentX = (td.leftScreenGazeX + td.rightScreenGazeX) / 2.0
-            global_variables.tobiiCurrentY = (td.leftScreenGazeY + td.rightScreenGazeY) / 2.0
-        elif td.rightEyeValid == 1 and td.leftEyeValid == 0:
-            global_variables.tobiiCurrentX = td.rightScreenGazeX
-            global_variables.tobiiCurrentY = td.rightScreenGazeY
-        elif td.rightEyeValid == 0 and td.leftEyeValid == 1:
-            global_variables.tobiiCurrentX = td.leftScreenGazeX
-            global_variables.tobiiCurrentY = td.leftScreenGazeY
-        else:
-            # Neither is valid, so we could either leave it as the previous case,
-            # which involves doing nothing, or set it to -1.
-            global_variables.tobiiCurrentX = -1
-            global_variables.tobiiCurrentY = -1
+    pv = session.video()
+    if pv.tobiiIndices[i] < 0:
+        print( "Error: no Tobii events for this participant; no matching timestamp" )
+    td = pv.tobiiSamples[i]
+
+    session.tobiiCurrentX = pv.tobiiGazeX[i]
+    session.tobiiCurrentY = pv.tobiiGazeY[i]
 
     ###################################################
     # Work out what to write out to CSV
     out = msg
     del out['msgID']
     out['participant'] = p.directory
-    pv = p.videos[p.videosPos]
-    out['frameImageFile'] = pv.frameFilesList[ pv.frameFilesPos ]
+    out['frameImageFile'] = pv.frameFilesList[i]
+
+    # Mouse and keyboard input since the previous frame, from the participant's input log
+    interactions, session.interactionPos = interactionsBefore( p, session.interactionPos, frameTimeEpoch )
+    out.update( interactions )
     
-    out["tobiiLeftScreenGazeX"] = td.leftScreenGazeX
-    out["tobiiLeftScreenGazeY"] = td.leftScreenGazeY
-    out["tobiiRightScreenGazeX"] = td.rightScreenGazeX
-    out["tobiiRightScreenGazeY"] = td.rightScreenGazeY
+    out["tobiiLeftScreenGazeX"] = float( td['leftScreenGazeX'] )
+    out["tobiiLeftScreenGazeY"] = float( td['leftScreenGazeY'] )
+    out["tobiiRightScreenGazeX"] = float( td['rightScreenGazeX'] )
+    out["tobiiRightScreenGazeY"] = float( td['rightScreenGazeY'] )
 
     out['error'] = wgError
     out['errorPix'] = wgErrorPix
 
-    # Turn fmPos and eyeFeatures into per-column values
-    fmPosDict = dict(zip( fmPosKeys, list(chain.from_iterable( out["fmPos"] )) ) )
-    eyeFeaturesDict = dict(zip( eyeFeaturesKeys, out["eyeFeatures"] ))
-    out.update( fmPosDict )
-    out.update( eyeFeaturesDict )
-    del out['fmPos']
-    del out['eyeFeatures']
-
-    if writeCSV:
-
-        # A reminder of what the desired field name outputs are.
-        # fieldnames = (['participant','frameImageFile','frameTimeEpoch','frameNum','mouseMoveX','mouseMoveY','mouseClickX','mouseClickY','keyPressed','keyPressedX','keyPressedY',
-        #                'tobiiLeftScreenGazeX','tobiiLeftScreenGazeY','tobiiRightScreenGazeX','tobiiRightScreenGazeY','webGazerX','webGazerY','fmPos','eyeFeatures','wgError','wgErrorPix'])
-
-        # Target dir for output
-        outDir = outputPrefix + global_variables.participant.directory + '/' + \
-            global_variables.participant.videos[global_variables.participant.videosPos].filename \
-            + "_frames" + '/'
-        # Target gaze predictions csv
-        gpCSV = outputPrefix + global_variables.participant.directory + '_'  + pv.filename + '_' + csvTempName 
-
-        with open( gpCSV, 'a', newline='' ) as f:
-            # Note no quotes between fmTracker and eyeFeatures
-            # f.write( "\"" + participant.directory + "\",\"" + fname + "\",\"" + str(frameTimeEpoch) + "\",\"" + str(frameNum) + "\",\"" + str(mouseMoveX) + "\",\"" + str(mouseMoveY) + "\",\"" + str(mouseClickX) + "\",\"" + str(mouseClickY) + "\",\"" + keyPressed + "\",\"" + str(keyPressedX) + "\",\"" + str(keyPressedY) + "\",\"" + str(td.leftScreenGazeX) + "\",\"" + str(td.leftScreenGazeY) + "\",\"" + str(td.rightScreenGazeX) + "\",\"" + str(td.rightScreenGazeY) + "\",\"" + str(wgCurrentX) + "\",\"" + str(wgCurrentY) + "\"," + str(fmPos) + "," + str(eyeFeatures) + "\n")
-            writer = csv.DictWriter(f, fieldnames=fieldnames,delimiter=',',quoting=csv.QUOTE_ALL)
-            writer.writerow( out )
+    with serverMetrics.timed( 'csvWrite', session.unitName() ):
+        if pv.columnWriter is not None:
+            pv.columnWriter.writeFrame( out )
+
+        # Turn fmPos and eyeFeatures into per-column values
+        fmPosDict = dict(zip( fmPosKeys, list(chain.from_iterable( out["fmPos"] )) ) )
+        eyeFeaturesDict = dict(zip( eyeFeaturesKeys, out["eyeFeatures"] ))
+        out.update( fmPosDict )
+        out.update( eyeFeaturesDict )
+        del out['fmPos']
+        del out['eyeFeatures']
+
+        if writeCSV:
+
+            # A reminder of what the desired field name outputs are.
+            # fieldnames = (['participant','frameImageFile','frameTimeEpoch','frameNum','mouseMoveX','mouseMoveY','mouseClickX','mouseClickY','keyPressed','keyPressedX','keyPressedY',
+            #                'tobiiLeftScreenGazeX','tobiiLeftScreenGazeY','tobiiRightScreenGazeX','tobiiRightScreenGazeY','webGazerX','webGazerY','fmPos','eyeFeatures','wgError','wgErrorPix'])
+
+            # Target gaze predictions csv, kept open for the whole video
+            pv.gazeWriter.writerow( out )
 
     return frameTimeEpoch
 ################################################################################################
 
 class WebSocketHandler(tornado.websocket.WebSocketHandler):
 
+    def transportMode(self):
+
+        # How frames are sent to this client; ws://.../websocket?transport=jpeg (see frameTransport.py)
+        mode = self.get_argument( 'transport', defaultTransport )
+        return mode if mode in transportModes else defaultTransport
+
+
+    def get_compression_options(self):
+
+        # Asked during the handshake, before open()
+        return FrameTransport( self.transportMode() ).compressionOptions()
+
+
     def open(self):
 
-        global_variables.participantPos = -1
-        newParticipant( self )
+        # How many frames we may stream ahead of the results coming back
+        try:
+            pipelineWindow = int( self.get_argument( 'window', str(defaultPipelineWindow) ) )
+        except ValueError:
+            pipelineWindow = defaultPipelineWindow
+        pipelineWindow = min( max( pipelineWindow, 1 ), maxPipelineWindow )
+        print( "Client connected from " + str(self.request.remote_ip) + "; pipeline window: " + str(pipelineWindow) + \
+            "; transport: " + self.transportMode() )
+
+        # Everything about this worker's progress lives in its own session
+        self.session = ExtractionSession( self, pipelineWindow )
+        self.session.transport = FrameTransport( self.transportMode() )
+        self.session.frameCache = FrameCache( global_variables.prefetchFrames, global_variables.prefetchThreads, self.session.transport.loadFrame )
+        self.startNextUnit()
+
+
+    def startNextUnit(self):
+
+        # Ask the shared scheduler for the next (participant, video) unit for this worker
+        prevParticipant = self.session.participant
+        if not global_variables.scheduler.acquire( self.session ):
+            if global_variables.scheduler.allDone():
+                print( "All participants completed." )
+                exit()
+            print( "    No work available for " + str(self.request.remote_ip) + " yet; waiting for a lease to be released..." )
+            return
+
+        if self.session.participant is prevParticipant:
+            # Same participant; the client asks for the next video
+            sendVideoEnd( self.session )
+        else:
+            # New participant for this client; it resets and then asks for the video
+            self.session.interactionPos = 0
+            sendParticipantInfo( self, self.session.participant )
+
+
+    def finishUnit(self):
+
+        global_variables.scheduler.complete( self.session )
+        self.startNextUnit()
+
+
+    async def sendFramesAhead(self, pv):
+
+        # Send frames until pipelineWindow of them are waiting on a result.
+        # pv.frameFilesPos is the next frame to send; pv.framesDonePos the next result to write.
+        transport = self.session.transport
+        while pv.frameFilesPos - pv.framesDonePos < self.session.pipelineWindow:
+            if pv.frameFilesPos >= len(pv.frameFilesList):
+                data = await self.nextStreamedFrame( pv )
+                if data is None:
+                    break
+                if transport.encoding() in ('png', 'jpeg', 'webp'):
+                    data = await tornado.ioloop.IOLoop.current().run_in_executor( None, transport.encodeRGBA, data,
+                        pv.frameStream.width, pv.frameStream.height )
+            else:
+                # Decoded (and encoded for the transport) on the read-ahead threads, along with the next few frames
+                frameCache = self.session.frameCache
+                frameCache.prefetch( pv.frameFilesList, pv.frameFilesPos )
+                data = await frameCache.get( pv.frameFilesList[pv.frameFilesPos] )
+            keyFrame = False
+            if transport.mode == 'delta':
+                data, keyFrame = await tornado.ioloop.IOLoop.current().run_in_executor( None, transport.deltaEncode, data )
+            if not self.session.hasLease() or self.session.video() is not pv:
+                # We lost the video while waiting
+                return
+            try:
+                sendVideoFrame( self.session, pv, pv.frameFilesPos, data, keyFrame )
+            except tornado.websocket.WebSocketClosedError:
+                # on_close hands the unit back to the scheduler
+                return
+            pv.frameFilesPos = pv.frameFilesPos + 1
+        global_variables.scheduler.renew( self.session )
+
+
+    async def nextStreamedFrame(self, pv):
+
+        # Wait for ffmpeg to decode the next frame of a streamed video without blocking the IOLoop.
+        # Returns its RGBA bytes, or None if there isn't one.
+        if pv.frameStream is None:
+            return None
+        frame = await tornado.ioloop.IOLoop.current().run_in_executor( None, pv.frameStream.nextFrame )
+        if not self.session.hasLease() or self.session.video() is not pv:
+            # We lost the video while waiting
+            return None
+        if frame is None:
+            pv.frameStream.close()
+            pv.frameStream = None
+            return None
+
+        # Name the frame as extraction would have, which also carries its timestamp
+        frameNum, pts, rgba = frame
+        outDir = videoFramesDir( self.session.participant.directory, pv.filename )
+        pv.frameFilesList.append( outDir + frameOutFormat.format(frameNum, pts) )
+        pv.framePts.append( pts )
+        with serverMetrics.timed( 'tobiiAlign', self.session.unitName() ):
+            alignTobiiToFrames( self.session.participant, pv )
+        return rgba
 
  
-    def on_message(self, message):
-        
+    async def extractFrames(self, pv, video, outDir):
+
+        # Extract the video's frames without holding up the IOLoop, telling the client how far along
+        # we are. If another connection is already extracting this video, wait for that instead.
+        # Returns the number of frames extracted; 0 if something went wrong.
+        extraction = framesBeingExtracted.get( outDir )
+        if extraction is None:
+            print( "    Extracting video frames (might take a few minutes)... " + str(video) )
+            extraction = FrameExtraction( video, outDir, videoPtsFile( self.session.participant.directory, pv.filename ) )
+            framesBeingExtracted[outDir] = extraction
+            unit = self.session.unitName()
+            startTime = time.perf_counter()
+            def extracted( f ):
+                framesBeingExtracted.pop( outDir, None )
+                serverMetrics.observe( 'extract', (time.perf_counter() - startTime) * 1000, unit )
+            extraction.start().add_done_callback( extracted )
+        else:
+            print( "    Waiting for video frames being extracted for another worker... " + str(video) )
+
+        session = self.session
+        def progress( framesDone, framesTotal, eta ):
+            if not session.hasLease() or session.video() is not pv:
+                return
+            # Still busy; don't let the lease expire under us
+            global_variables.scheduler.renew( session )
+            try:
+                sendExtractionProgress( session, pv, framesDone, framesTotal, eta )
+            except tornado.websocket.WebSocketClosedError:
+                pass
+
+        extraction.listeners.append( progress )
+        try:
+            return await asyncio.shield( extraction.future )
+        except Exception as e:
+            print( "    Error extracting video frames from " + video + ": " + str(e) )
+            return 0
+        finally:
+            extraction.listeners.remove( progress )
+
+
+    async def on_message(self, message):
+
+        msg = tornado.escape.json_decode( message )
+        if msg['msgID'] in ('1', '3') and not self.session.hasLease():
+            # Our lease expired or there is no work right now; nothing to do with this
+            return
+
         #######################################################################################
         # Video requested from client
         #
-        msg = tornado.escape.json_decode( message )
         if msg['msgID'] == '1':
             
             #######################################
             # Extract video frames and find timestamps
             # TODO: Refactor, but be careful. Prickly code
             #
-            global_variables.participant.videosPos = global_variables.participant.videosPos + 1
-            pv = global_variables.participant.videos[global_variables.participant.videosPos]
-            video = global_variables.participant.directory + '/' + pv.filename
+            p = self.session.participant
+            pv = self.session.video()
+            global_variables.scheduler.renew( self.session )
+            video = p.directory + '/' + pv.filename
             print( "Processing video: " + video )
+            pv.resetFrames()
+            self.session.frameCache.clear()
+            self.session.transport.reset()
+            self.session.transport.resetStats()
+            self.session.frameSentTimes.clear()
+            serverMetrics.unitStarted( self.session.unitName() )
 
-            #
-            # Make dir for output video frames
-            outDir = outputPrefix +  video + "_frames" + '/'
-            if not os.path.isdir( outDir ):
-                os.makedirs( outDir )
+            # Dir for output video frames
+            outDir = videoFramesDir( p.directory, pv.filename )
 
 
             # We may have already processed this video...
-            gpCSVDone = outputPrefix + global_variables.participant.directory + '_' + pv.filename + '_' + csvDoneName
-            gpCSV = outputPrefix + global_variables.participant.directory + '_'  + pv.filename + '_' + csvTempName
-            if os.path.isfile(gpCSVDone ):
+            gpCSVDone = outputPrefix + p.directory + '_' + pv.filename + '_' + csvDoneName
+            gpCSV = outputPrefix + p.directory + '_'  + pv.filename + '_' + csvTempName
+            gpCols = outputPrefix + p.directory + '_'  + pv.filename + '_' + columnsTempName
+            gpColsDone = outputPrefix + p.directory + '_'  + pv.filename + '_' + columnsDoneName
+            if os.path.isfile(gpCSVDone ) and (not writeColumns or os.path.isdir( gpColsDone )):
                 print( "    " + gpCSVDone + " already exists and completed; moving on to next video...")
-                sendVideoEnd( self )
+                self.finishUnit()
                 return
             elif os.path.isfile( gpCSV ):
                 print( "    " + gpCSV + " exists but does not have an entry for each file; deleting csv and starting this video again...")
@@ -217,84 +351,58 @@ class WebSocketHandler(tornado.websocket.WebSocketHandler):
                         writer = csv.DictWriter(csvfile, fieldnames=fieldnames,delimiter=',',quoting=csv.QUOTE_ALL)
                         writer.writeheader()            
 
+            if writeCSV:
+                pv.gazeWriter = BufferedCSVWriter( gpCSV, fieldnames, csvFlushRows, csvFlushMS )
+            if writeColumns:
+                pv.columnWriter = ColumnarVideoWriter( gpCols, gpColsDone, p.directory, pv.filename )
+
+            # Streaming mode: no frame images; send frames as ffmpeg decodes them
+            if global_variables.streamFramesFromFfmpeg:
+                print( "    Streaming video frames from ffmpeg... " + str(video) )
+                pts, framerate = await tornado.ioloop.IOLoop.current().run_in_executor( None, loadPtsIndex, video, videoPtsFile( p.directory, pv.filename ) )
+                if not self.session.hasLease() or self.session.video() is not pv:
+                    return
+                pv.frameStream = FfmpegFrameStream( video, global_variables.streamBufferFrames, pts, framerate )
+                await self.sendFramesAhead( pv )
+                if self.session.hasLease() and self.session.video() is pv and len(pv.frameFilesList) == 0:
+                    print( "    Error decoding video frames! Moving on to next video..." )
+                    self.finishUnit()
+                return
+
             # If we're not done, we need to extract the video frames (using ffmpeg).
             # If this is already done, we write 'framesExtracted.txt'
+            # (preExtractFrames.py does this for every video up front)
             #
-            framesDoneFile = outDir + '/' + "framesExtracted.txt"
-            if not os.path.isfile( framesDoneFile ):
-                print( "    Extracting video frames (might take a few minutes)... " + str(video) )
-                completedProcess = subprocess.run('ffmpeg -i "./' + video + '" -vf showinfo "' + outDir + 'frame_%08d.png"'\
-                    , stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, shell=True)
-
-                nFrames = len(glob.glob( outDir + '*.png' ))
+            if not framesExtracted( outDir ):
+                nFrames = await self.extractFrames( pv, video, outDir )
+                if not self.session.hasLease() or self.session.video() is not pv:
+                    # We lost the video while waiting
+                    return
                 if nFrames == 0:
                     print( "    Error extracting video frames! Moving on to next video..." )
-                    sendVideoEnd( self )
+                    self.finishUnit()
                     return
 
-                # Collect the timestamps of the video frames
-                allPts = np.ones(nFrames, dtype=np.int) * -1
-                ptsTimebase = -1
-                framerate = -1
-                lines = completedProcess.stderr.splitlines()
-                for l in lines:
-                    if l.startswith( "[Parsed_showinfo_0 @" ):
-                        timebase = l.find( "config in time_base:" )
-                        fr = l.find( ", frame_rate:" )
-                        nStart = l.find( "n:" )
-                        ptsStart = l.find( "pts:" )
-                        pts_timeStart = l.find( "pts_time:" )
-                        if nStart >= 0 and ptsStart >= 0:
-                            frameNum = int(l[nStart+2:ptsStart-1].strip())
-                            pts = int(l[ptsStart+4:pts_timeStart].strip())
-                            allPts[frameNum] = pts
-                        elif timebase >= 0:
-                            ptsTimebase = l[timebase+20:fr].strip()
-                            framerate = l[fr+13:].strip()
-                            sl = framerate.find("/")
-                            if sl > 0:
-                                frPre = framerate[0:sl]
-                                frPost = framerate[sl+1:]
-                                framerate = float(frPre) / float(frPost)
-                            else:
-                                framerate = float(framerate)
-
-                            if ptsTimebase != "1/1000":
-                                print( "ERROR ERROR Timebase in webm is not in milliseconds" )
-                    # if l.startswith( "frame=" ):
-                        # This is written out at the end of the file, and looks like this:
-                        # frame=  454 fps= 51 q=24.8 Lsize=N/A time=00:00:15.13 bitrate=N/A dup=3 drop=1 speed=1.71x -  refers to decoding 
-
-                # Some of the presentation times (pts) will not have been filled in, and will be -1s
-                # Let's just assume the framerate is good (yea right) and add on the frame time to the last good
-                prev = 0
-                for i in range(0, nFrames):
-                    if allPts[i] == -1:
-                        allPts[i] = prev + int(1000/framerate)
-                    prev = allPts[i]
-                
-                # TODO Write out this data to a pts file?
-
-                # Rename the files based on their frame number and timestamp
-                for i in range(0, nFrames):
-                    inputFile = outDir + frameExtractFormat.format(i+1) # Catch that the output framenumbers from extraction start from 1 and not 0
-                    outputFile = outDir + frameOutFormat.format(i, allPts[i])
-                    os.rename( inputFile, outputFile )
-                    
-                
-                with open( framesDoneFile, 'w' ) as f:
-                    f.write( "Done." )
-
-
-            # Populate list with video frames
-            pv.frameFilesList = sorted(glob.glob( outDir + '*.png' ))
-            pv.frameFilesPos = 0
-            
+
+            # Video frames and their timestamps, from the manifest written at extraction
+            manifest = await tornado.ioloop.IOLoop.current().run_in_executor( None, loadFrameManifest, outDir )
+            if not self.session.hasLease() or self.session.video() is not pv:
+                return
+            if len(manifest) == 0:
+                print( "    No video frames found in " + outDir + "; moving on to next video..." )
+                self.finishUnit()
+                return
+            pv.frameFilesList = FrameFiles( outDir, manifest )
+            pv.framePts = manifest['pts']
+
+            # Match every frame to its closest Tobii sample up front
+            with serverMetrics.timed( 'tobiiAlign', self.session.unitName() ):
+                alignTobiiToFrames( p, pv )
 
             ########################################
-            # Send the first video frame + timestamp
+            # Send the first video frames + timestamps
             #
-            sendVideoFrame( self, pv.frameFilesList[pv.frameFilesPos], pv )
+            await self.sendFramesAhead( pv )
         # 
         # End NEW VIDEO
         #######################################################################################
@@ -304,43 +412,131 @@ class WebSocketHandler(tornado.websocket.WebSocketHandler):
         # Feedback from CLIENT which contains the webgazer + interaction metadata we need...
         # 
         elif msg['msgID'] == '3':
-            # Parse, manipulate the data and write to CSV
-            frameTimeEpoch = writeDataToCSV( global_variables.participant, msg )
+            p = self.session.participant
+            pv = self.session.video()
+            global_variables.scheduler.renew( self.session )
+
+            # Results may arrive out of order when more than one frame is in flight; key them by frame
+            frameNum = int( msg['frameNum'] )
+            if frameNum < pv.framesDonePos or frameNum >= pv.frameFilesPos or frameNum in pv.pendingResults:
+                print( "    Ignoring result for frame " + str(frameNum) + ", which is not in flight" )
+                serverMetrics.count( 'resultsIgnored' )
+                return
+            pv.pendingResults[frameNum] = msg
+            sentTime = self.session.frameSentTimes.pop( frameNum, None )
+            if sentTime is not None:
+                serverMetrics.observe( 'roundTrip', (time.perf_counter() - sentTime) * 1000, self.session.unitName() )
+
+            # Parse, manipulate the data and write to CSV, in frame order
+            while pv.framesDonePos in pv.pendingResults:
+                frameTimeEpoch = writeDataToCSV( self.session, pv.framesDonePos, pv.pendingResults.pop( pv.framesDonePos ) )
+
+                if global_variables.writeScreenCapVideo:
+                    writeScreenCapOutputFrames( self.session, frameTimeEpoch )
 
-            if global_variables.writeScreenCapVideo:
-                writeScreenCapOutputFrames( global_variables.participant, frameTimeEpoch )
+                pv.framesDonePos = pv.framesDonePos + 1
+                serverMetrics.frameDone( self.session.unitName() )
 
             ##################################
-            # Send the next frame of the video
-            pv = global_variables.participant.videos[global_variables.participant.videosPos]
-            pv.frameFilesPos = pv.frameFilesPos + 1
-            
-            # If the video frame is the last available video frame, send a message to this effect
-            if pv.frameFilesPos >= len(pv.frameFilesList):
+            # Top up the frames in flight
+            await self.sendFramesAhead( pv )
+            if not self.session.hasLease() or self.session.video() is not pv:
+                return
 
-                if global_variables.writeScreenCapVideo:
-                    closeScreenCapOutVideo( global_variables.participant )
+            # If we have the result for the last video frame, send a message to this effect
+            if pv.framesDonePos >= len(pv.frameFilesList) and pv.frameStream is None:
 
-                outDir = outputPrefix + global_variables.participant.directory + '/' + pv.filename + "_frames" + '/'
-                gpCSV = outputPrefix + global_variables.participant.directory + '_' + pv.filename +'_' + csvTempName 
-                gpCSVDone = outputPrefix + global_variables.participant.directory + '_'  + pv.filename + '_' + csvDoneName
+                if global_variables.writeScreenCapVideo:
+                    closeScreenCapOutVideo( p )
+
+                gpCSV = outputPrefix + p.directory + '_' + pv.filename +'_' + csvTempName
+                gpCSVDone = outputPrefix + p.directory + '_'  + pv.filename + '_' + csvDoneName
+                if pv.gazeWriter is not None:
+                    # All rows on disk before the file is marked as done
+                    pv.gazeWriter.close( sync=True )
+                    pv.gazeWriter = None
                 if os.path.isfile( gpCSV ):
                     os.rename( gpCSV, gpCSVDone )
+                if pv.columnWriter is not None:
+                    pv.columnWriter.finish()
+                    pv.columnWriter = None
+
+                print( "    " + str(self.session.frameCache) )
+                print( "    " + str(self.session.transport) )
+                summary = serverMetrics.unitFinished( self.session.unitName() )
+                if writeMetricsSummary and summary is not None:
+                    summary['transport'] = self.session.transport.mode
+                    summary['pipelineWindow'] = self.session.pipelineWindow
+                    with open( outputPrefix + p.directory + '_' + pv.filename + '_metrics.json', 'w' ) as f:
+                        json.dump( summary, f, indent=1 )
+                self.session.frameCache.resetStats()
+                self.finishUnit()
 
-                sendVideoEnd( self )
 
-            else:
-                sendVideoFrame( self, pv.frameFilesList[pv.frameFilesPos], pv )
+    def on_close(self):
 
+        # Hand this worker's unit to someone else
+        print( "Client " + str(self.request.remote_ip) + " disconnected" )
+        stopVideo( self.session )
+        global_variables.scheduler.release( self.session )
 
-    def on_close(self):
-        pass
+
+def stopVideo( session ):
+
+    # Stop ffmpeg if the session was part way through streaming a video, and write out
+    # the rows we have; the partial CSV is restarted when the video is handed out again
+    if session.hasLease():
+        session.video().closeOutputs()
+
+
+def expireLeases():
+
+    # Workers that have gone quiet lose their unit, and are disconnected
+    for session in global_variables.scheduler.expireLeases():
+        print( "    Lease on " + session.unitName() + " expired" )
+        stopVideo( session )
+        global_variables.scheduler.release( session )
+        session.wsh.close()
+
+
+def currentGauges():
+
+    # Queue depths right now, for /metrics
+    scheduler = global_variables.scheduler
+    gauges = {'leasedWorkers': len(scheduler.leases),
+              'idleWorkers': len(scheduler.idleSessions),
+              'participantsLoaded': len(scheduler.participants),
+              'extractionsRunning': len(framesBeingExtracted),
+              'framesInFlight': 0,
+              'resultsWaiting': 0,
+              'framesReadAhead': 0,
+              'streamBufferedFrames': 0}
+    for session in scheduler.leases:
+        pv = session.video()
+        if pv.pendingResults is None:
+            # Hasn't been asked for yet
+            continue
+        gauges['framesInFlight'] = gauges['framesInFlight'] + pv.frameFilesPos - pv.framesDonePos
+        gauges['resultsWaiting'] = gauges['resultsWaiting'] + len(pv.pendingResults)
+        gauges['framesReadAhead'] = gauges['framesReadAhead'] + len(session.frameCache.frames)
+        if pv.frameStream is not None:
+            gauges['streamBufferedFrames'] = gauges['streamBufferedFrames'] + pv.frameStream.frames.qsize()
+    return gauges
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+
+    def get(self):
+        # Stage timings, counters, per-video throughput and queue depths, as JSON
+        self.set_header( 'Cache-Control', 'no-cache' )
+        self.write( serverMetrics.snapshot() )
 
 
 class Application(tornado.web.Application):
     def __init__(self):
         handlers = [
             (r'/websocket', WebSocketHandler),
+            (r'/metrics', MetricsHandler),
             (r'/(.*)', tornado.web.StaticFileHandler, {'path': '.', 'default_filename': ''}),
         ]
  
@@ -355,18 +551,14 @@ def main():
 
     ###########################################################################################################
     # Enumerate all P_ subdirectories if not yet done
-    regex = re.compile('P_[0-9][0-9]')
-
-    global_variables.participantDirList = []
-    for root, dirs, files in os.walk('.'):
-        for d in dirs:
-            if regex.match(d):
-               global_variables.participantDirList.append(d)
-
-    global_variables.participantDirList = sorted( global_variables.participantDirList )
+    global_variables.participantDirList = findParticipantDirs()
 
     # NOTE: This would be the point to filter any participants from the processing
 
+    # Any number of browser workers take (participant, video) units from here
+    global_variables.scheduler = ExtractionScheduler( global_variables.participantDirList, global_variables.leaseTimeoutSeconds )
+    serverMetrics.gauges = currentGauges
+
     ###########################################################################################################
     # Setup webserver
     #
@@ -404,6 +596,7 @@ def main():
 
     #################################
     # Start webserver
+    tornado.ioloop.PeriodicCallback( expireLeases, 10 * 1000 ).start()
     tornado.ioloop.IOLoop.instance().start()
 
 if __name__ == '__main__':
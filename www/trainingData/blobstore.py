@@ -0,0 +1,177 @@
+import os
+import sys
+import struct
+import hashlib
+import sqlite3
+
+# The collected examples' images, packed into append-only shard files and addressed by the
+# sha256 of their content, so the same image is stored once and nothing is ever overwritten.
+#
+#   blobs/000000.pack, 000001.pack, ...   records of [32-byte sha256][8-byte length][bytes]
+#   blobs table (next to examples)        hash -> shard, offset, length
+#
+# examples.img holds 'sha256:<hex>'. Rows from before the store hold the integer id of an
+# img<id>.png file, which get() and getMany() still read; run this file to pack those.
+#
+# Each record carries its own digest and length, so the index can be rebuilt from the shards
+# alone (rebuildIndex); anything at the end of a shard that isn't indexed, e.g. after a crash
+# between the write and the commit, is ignored.
+#
+# Usage:
+# > python blobstore.py <trainingData directory>
+
+SHARD_BYTES = 256 * 1024 * 1024
+
+recordHeader = struct.Struct('<32sQ')
+refPrefix = 'sha256:'
+
+
+def contentRef(data):
+    return refPrefix + hashlib.sha256(data).hexdigest()
+
+
+class BlobStore:
+
+    def __init__(self, directory, conn):
+        # directory is the blobs directory; legacy img<id>.png files are in the one above it
+        self.directory = directory
+        self.legacyDirectory = os.path.dirname(os.path.abspath(directory))
+        self.conn = conn
+        self.shard = None
+        self.file = None
+        os.makedirs(directory, exist_ok=True)
+        conn.execute('CREATE TABLE IF NOT EXISTS blobs (hash TEXT PRIMARY KEY, shard INTEGER, offset INTEGER, length INTEGER)')
+        conn.commit()
+
+    def shardPath(self, shard):
+        return os.path.join(self.directory, '%06d.pack' % shard)
+
+    def shards(self):
+        return sorted(int(f[:-len('.pack')]) for f in os.listdir(self.directory) if f.endswith('.pack'))
+
+    ##############################################################
+    # Writing: put() then sync(), then commit the connection
+    def put(self, ref, data):
+        # Append data unless it is already stored; the index row is part of the caller's transaction
+        if self.conn.execute('SELECT 1 FROM blobs WHERE hash = ?', (ref,)).fetchone() is not None:
+            return
+        if self.file is None:
+            shards = self.shards()
+            self.shard = shards[-1] if len(shards) > 0 else 0
+            self.file = open(self.shardPath(self.shard), 'ab')
+        if self.file.tell() > 0 and self.file.tell() + recordHeader.size + len(data) > SHARD_BYTES:
+            self.sync()
+            self.file.close()
+            self.shard += 1
+            self.file = open(self.shardPath(self.shard), 'ab')
+        offset = self.file.tell() + recordHeader.size
+        self.file.write(recordHeader.pack(bytes.fromhex(ref[len(refPrefix):]), len(data)))
+        self.file.write(data)
+        self.conn.execute('INSERT INTO blobs VALUES (?,?,?,?)', (ref, self.shard, offset, len(data)))
+
+    def sync(self):
+        # The bytes have to be on disk before the index rows pointing at them are committed
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    ##############################################################
+    # Reading
+    def legacyPath(self, ref):
+        return os.path.join(self.legacyDirectory, 'img' + str(ref) + '.png')
+
+    def get(self, ref):
+        for _, data in self.getMany([ref]):
+            return data
+        raise KeyError(ref)
+
+    def getMany(self, refs):
+        # Yields (ref, bytes) for the refs that can be found, in the order they are stored rather
+        # than the order given, reading each shard front to back through one open file
+        located = []
+        legacy = []
+        refs = list(set(refs))
+        for i in range(0, len(refs), 500):
+            chunk = refs[i:i+500]
+            hashes = [r for r in chunk if isinstance(r, str) and r.startswith(refPrefix)]
+            legacy += [r for r in chunk if not (isinstance(r, str) and r.startswith(refPrefix))]
+            if len(hashes) > 0:
+                located += self.conn.execute('SELECT shard, offset, length, hash FROM blobs WHERE hash IN (%s)' % ','.join('?' * len(hashes)), hashes).fetchall()
+        located.sort()
+
+        f = None
+        shard = None
+        for s, offset, length, ref in located:
+            if s != shard:
+                if f is not None:
+                    f.close()
+                f = open(self.shardPath(s), 'rb')
+                shard = s
+            f.seek(offset)
+            yield ref, f.read(length)
+        if f is not None:
+            f.close()
+
+        for ref in legacy:
+            try:
+                with open(self.legacyPath(ref), 'rb') as f:
+                    yield ref, f.read()
+            except FileNotFoundError:
+                continue
+
+    def scan(self, shard):
+        # Yields (ref, offset, length) of each whole record in a shard
+        with open(self.shardPath(shard), 'rb') as f:
+            while True:
+                header = f.read(recordHeader.size)
+                if len(header) < recordHeader.size:
+                    return
+                digest, length = recordHeader.unpack(header)
+                offset = f.tell()
+                if f.seek(length, os.SEEK_CUR) > os.fstat(f.fileno()).st_size:
+                    return
+                yield refPrefix + digest.hex(), offset, length
+
+    def rebuildIndex(self):
+        with self.conn:
+            self.conn.execute('DELETE FROM blobs')
+            for shard in self.shards():
+                for ref, offset, length in self.scan(shard):
+                    self.conn.execute('INSERT OR IGNORE INTO blobs VALUES (?,?,?,?)', (ref, shard, offset, length))
+
+
+def packLegacyImages(trainingDir):
+    # Move the images of rows that still refer to img<id>.png files into the store. The files are
+    # left in place; delete them once the new database is backed up.
+    conn = sqlite3.connect(os.path.join(trainingDir, 'training.db'))
+    store = BlobStore(os.path.join(trainingDir, 'blobs'), conn)
+    rows = conn.execute("SELECT exampleid, img FROM examples WHERE img NOT LIKE 'sha256:%'").fetchall()
+    packed = 0
+    with conn:
+        for exampleid, img in rows:
+            try:
+                with open(store.legacyPath(img), 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                print ('No image for example', exampleid, ':', store.legacyPath(img))
+                continue
+            ref = contentRef(data)
+            store.put(ref, data)
+            conn.execute('UPDATE examples SET img = ? WHERE exampleid = ?', (ref, exampleid))
+            packed += 1
+        store.sync()
+    store.close()
+    conn.close()
+    print ('Packed', packed, 'of', len(rows), 'images')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print ('Usage: python blobstore.py <trainingData directory>')
+        sys.exit(1)
+    packLegacyImages(sys.argv[1])
@@ -1,30 +1,111 @@
 import sqlite3
+import json
+from collections import namedtuple
+
+# positions is the parsed JSON list; img is a blob store ref (or a legacy image id)
+Example = namedtuple('Example', ['id', 'positions', 'width', 'x', 'y', 'type', 'img', 'timestamp'])
+
+tableSQL = '''CREATE TABLE IF NOT EXISTS examples
+                    (exampleid INTEGER PRIMARY KEY, positions TEXT, width INTEGER, x REAL, y REAL, type TEXT, img INTEGER, timestamp INTEGER)'''
+# Examples are ordered by timestamp, with the (older) rows that have none first. A NULL can't be
+# compared, so queries sort and page on this instead of the column itself.
+timestampKey = 'COALESCE(timestamp, -1)'
+# (type, timestamp) serves lookups by type as well as time ranges within a type
+indexSQL = ['DROP INDEX IF EXISTS examples_type_timestamp',
+            'DROP INDEX IF EXISTS examples_timestamp',
+            'CREATE INDEX IF NOT EXISTS examples_type_timestampkey ON examples (type, ' + timestampKey + ')',
+            'CREATE INDEX IF NOT EXISTS examples_timestampkey ON examples (' + timestampKey + ')']
+
+BATCH_SIZE = 1000
+
+
+def createTables(conn):
+    conn.execute(tableSQL)
+    for sql in indexSQL:
+        conn.execute(sql)
+    conn.commit()
+
+
+def decode(row):
+    return Example(row[0], json.loads(row[1]), *row[2:])
+
 
 class Examples:
 
-    def __init__(self):
+    def __init__(self, filename='training.db'):
+        self.filename = filename
         self.connect()
 
     def connect(self):
-        self.conn = sqlite3.connect('training.db')
+        self.conn = sqlite3.connect(self.filename)
         self.c = self.conn.cursor()
+        createTables(self.conn)
 
     schema = ['id', 'positions', 'width', 'x', 'y', 'type', 'img id', 'timestamp']
 
     def remake(self):
-        c.execute('''CREATE TABLE examples
-                    (exampleid INTEGER PRIMARY KEY, positions TEXT, width INTEGER, x REAL, y REAL, type TEXT, img INTEGER, timestamp INTEGER)''')
-        conn.commit()
+        createTables(self.conn)
 
-    def pretty_print(cursor):
-        for row in cursor:
+    def pretty_print(self, rows):
+        for row in rows:
             pr = ''
             for i, col in enumerate(row):
-                pr += ' ' + schema[i] + ': ' + str(col)
+                pr += ' ' + self.schema[i] + ': ' + str(col)
             print (pr)
 
     def close(self):
         self.conn.close()
 
     def lookup_by_type(self, t):
-        return self.c.execute('SELECT * FROM examples WHERE type = ?', (t))
+        return self.c.execute('SELECT * FROM examples WHERE type = ?', (t,))
+
+    def where(self, type=None, start=None, end=None):
+        # SQL and parameters for the optional filters; start is inclusive, end exclusive (ms)
+        clauses = []
+        params = []
+        if type is not None:
+            clauses.append('type = ?')
+            params.append(type)
+        if start is not None:
+            clauses.append(timestampKey + ' >= ?')
+            params.append(start)
+        if end is not None:
+            clauses.append(timestampKey + ' < ?')
+            params.append(end)
+        return clauses, params
+
+    def count(self, type=None, start=None, end=None):
+        clauses, params = self.where(type, start, end)
+        sql = 'SELECT COUNT(*) FROM examples' + (' WHERE ' + ' AND '.join(clauses) if len(clauses) > 0 else '')
+        return self.conn.execute(sql, params).fetchone()[0]
+
+    def page(self, type=None, start=None, end=None, after=None, limit=BATCH_SIZE):
+        # Up to limit examples in (timestamp, id) order, following the example 'after' (the last
+        # one of the previous page, or None for the first page)
+        clauses, params = self.where(type, start, end)
+        if after is not None:
+            # (key, id) > (after's key, after's id), spelled out so that sqlite seeks on the index
+            key = -1 if after.timestamp is None else after.timestamp
+            clauses.append(timestampKey + ' >= ? AND (' + timestampKey + ' > ? OR exampleid > ?)')
+            params += [key, key, after.id]
+        sql = 'SELECT * FROM examples' + (' WHERE ' + ' AND '.join(clauses) if len(clauses) > 0 else '') + \
+            ' ORDER BY ' + timestampKey + ', exampleid LIMIT ?'
+        return [decode(row) for row in self.conn.execute(sql, params + [limit])]
+
+    def batches(self, type=None, start=None, end=None, batchSize=BATCH_SIZE):
+        # Yields lists of up to batchSize examples until the range is exhausted. Each batch is its
+        # own short query, so memory stays at one batch and no read transaction is held open
+        # across the scan (which would stop the server's WAL from being checkpointed).
+        after = None
+        while True:
+            batch = self.page(type, start, end, after, batchSize)
+            if len(batch) == 0:
+                return
+            yield batch
+            after = batch[-1]
+
+    def scan(self, type=None, start=None, end=None, batchSize=BATCH_SIZE):
+        # Every example in the range, one at a time
+        for batch in self.batches(type, start, end, batchSize):
+            for example in batch:
+                yield example
@@ -0,0 +1,242 @@
+import os
+import sys
+import json
+import collections
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from db import Examples
+from blobstore import BlobStore
+
+# Exports the collected examples as arrays a training job can memory-map, rather than decoding
+# PNGs every epoch. The output directory holds, one row per example, in (timestamp, id) order:
+#
+#   images.u8         uint8   [n, height, width, 3]  RGB, resized
+#   positions.f32     float32 [n, positionsLength]   the face tracker's positions, flattened
+#   targets.f32       float32 [n, 2]                  x, y
+#   types.i32         int32   [n]                     index into manifest 'types'
+#   ids.i64           int64   [n, 2]                  exampleid, timestamp (-1 if it has none)
+#   manifest.json     shapes, types, and where the export got to
+#
+# positionsLength is given, or else taken from the first example exported.
+#
+# Running it again appends only the examples after the last one exported (by timestamp, then id;
+# an example whose timestamp is older than that when it arrives is not picked up). The arrays are
+# written before the manifest, which is replaced in one step, so an interrupted export is redone
+# from the last manifest. Examples whose image is missing or won't decode, or whose positions or
+# x, y aren't numbers, are skipped and counted in the manifest.
+#
+# Usage:
+# > python export.py <trainingData directory> <output directory> [width] [height] [workers] [positionsLength]
+
+manifestName = 'manifest.json'
+# Bumped when the files change; exports from before 2 have types.u8, and have to be redone
+exportVersion = 2
+arrayFiles = [('images', 'images.u8', np.uint8),
+              ('positions', 'positions.f32', np.float32),
+              ('targets', 'targets.f32', np.float32),
+              ('types', 'types.i32', np.int32),
+              ('ids', 'ids.i64', np.int64)]
+
+# Examples per task sent to a worker
+CHUNK_SIZE = 64
+# Save the manifest this often, so a long export that is interrupted picks up from there
+CHECKPOINT_ROWS = 10000
+
+# Where an export got to, as db.Examples.page() wants it
+ExportPosition = collections.namedtuple('ExportPosition', ['timestamp', 'id'])
+
+
+def rowShapes(manifest):
+    return {'images': (manifest['height'], manifest['width'], 3),
+            'positions': (manifest['positionsLength'],),
+            'targets': (2,),
+            'types': (),
+            'ids': (2,)}
+
+
+def readManifest(outDir):
+    with open(os.path.join(outDir, manifestName)) as f:
+        manifest = json.load(f)
+    if manifest.get('version', 1) != exportVersion:
+        raise ValueError('%s is an older export (version %d); export again into a new directory' % (outDir, manifest.get('version', 1)))
+    return manifest
+
+
+def loadExport(outDir):
+    # The exported arrays, memory-mapped read-only, and the manifest
+    manifest = readManifest(outDir)
+    shapes = rowShapes(manifest)
+    arrays = {}
+    for name, filename, dtype in arrayFiles:
+        if manifest['count'] == 0:
+            arrays[name] = np.zeros((0,) + shapes[name], dtype=dtype)
+        else:
+            arrays[name] = np.memmap(os.path.join(outDir, filename), dtype=dtype, mode='r', shape=(manifest['count'],) + shapes[name])
+    return arrays, manifest
+
+
+def decodeImages(pngs, width, height):
+    # On a worker: PNG bytes -> [n, height, width, 3] RGB, and which of them decoded
+    images = np.zeros((len(pngs), height, width, 3), dtype=np.uint8)
+    ok = np.zeros(len(pngs), dtype=bool)
+    for i, png in enumerate(pngs):
+        if png is None:
+            continue
+        img = cv2.imdecode(np.frombuffer(png, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            continue
+        if img.shape[1] != width or img.shape[0] != height:
+            img = cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA)
+        images[i] = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        ok[i] = True
+    return images, ok
+
+
+def flattenPositions(flat, length):
+    # Always length values; a tracker result of another size is truncated or NaN-padded
+    values = np.full(length, np.nan, dtype=np.float32)
+    flat = flat[:length]
+    values[:len(flat)] = flat
+    return values
+
+
+class Exporter:
+
+    def __init__(self, trainingDir, outDir, width, height, workers, positionsLength=None):
+        self.examples = Examples(os.path.join(trainingDir, 'training.db'))
+        self.store = BlobStore(os.path.join(trainingDir, 'blobs'), self.examples.conn)
+        self.outDir = outDir
+        self.workers = workers
+        os.makedirs(outDir, exist_ok=True)
+
+        manifestFile = os.path.join(outDir, manifestName)
+        if os.path.isfile(manifestFile):
+            self.manifest = readManifest(outDir)
+            if self.manifest['width'] != width or self.manifest['height'] != height:
+                raise ValueError('%s was exported at %dx%d, not %dx%d' % (outDir, self.manifest['width'], self.manifest['height'], width, height))
+            if positionsLength is not None and self.manifest['positionsLength'] not in (None, positionsLength):
+                raise ValueError('%s was exported with %d positions, not %d' % (outDir, self.manifest['positionsLength'], positionsLength))
+            if self.manifest['positionsLength'] is None:
+                self.manifest['positionsLength'] = positionsLength
+        else:
+            self.manifest = {'version': exportVersion, 'count': 0, 'width': width, 'height': height, 'positionsLength': positionsLength,
+                             'types': [], 'lastTimestamp': None, 'lastId': None, 'skipped': 0}
+
+        self.typeIndex = {t: i for i, t in enumerate(self.manifest['types'])}
+
+        # Drop anything written after the last manifest, then append
+        self.files = {}
+        for name, filename, dtype in arrayFiles:
+            size = 0
+            if self.manifest['count'] > 0:
+                size = self.manifest['count'] * int(np.prod(rowShapes(self.manifest)[name])) * np.dtype(dtype).itemsize
+            f = open(os.path.join(outDir, filename), 'ab')
+            f.truncate(size)
+            f.seek(0, os.SEEK_END)
+            self.files[name] = f
+
+    def after(self):
+        if self.manifest['lastId'] is None:
+            return None
+        return ExportPosition(self.manifest['lastTimestamp'], self.manifest['lastId'])
+
+    def pendingChunks(self, pool):
+        # Reads the examples after the last export in batches, and hands their images to the pool
+        # in chunks as they are read; yields (examples, future) in order
+        after = self.after()
+        while True:
+            batch = self.examples.page(after=after)
+            if len(batch) == 0:
+                return
+            after = batch[-1]
+            pngs = dict(self.store.getMany([e.img for e in batch]))
+            for i in range(0, len(batch), CHUNK_SIZE):
+                chunk = batch[i:i+CHUNK_SIZE]
+                yield chunk, pool.submit(decodeImages, [pngs.get(e.img) for e in chunk], self.manifest['width'], self.manifest['height'])
+
+    def row(self, e):
+        # An example's positions, targets and ids as arrays, or None if they aren't numbers. Rows
+        # from before timestamps were kept have none; they get -1, where db sorts them.
+        try:
+            positions = np.asarray(e.positions, dtype=np.float32).ravel()
+            targets = np.array([e.x, e.y], dtype=np.float32)
+            ids = np.array([e.id, -1 if e.timestamp is None else e.timestamp], dtype=np.int64)
+        except (TypeError, ValueError, OverflowError):
+            return None
+        if self.manifest['positionsLength'] is None:
+            # The first example written decides the length, so it has to have some
+            if positions.size == 0:
+                return None
+            self.manifest['positionsLength'] = int(positions.size)
+        return positions, targets, ids
+
+    def write(self, chunk, images, ok):
+        m = self.manifest
+        for e, image, good in zip(chunk, images, ok):
+            m['lastTimestamp'], m['lastId'] = e.timestamp, e.id
+            row = self.row(e) if good else None
+            if row is None:
+                m['skipped'] += 1
+                continue
+            positions, targets, ids = row
+            if e.type not in self.typeIndex:
+                self.typeIndex[e.type] = len(m['types'])
+                m['types'].append(e.type)
+            self.files['images'].write(image.tobytes())
+            self.files['positions'].write(flattenPositions(positions, m['positionsLength']).tobytes())
+            self.files['targets'].write(targets.tobytes())
+            self.files['types'].write(np.array([self.typeIndex[e.type]], dtype=np.int32).tobytes())
+            self.files['ids'].write(ids.tobytes())
+            m['count'] += 1
+
+    def saveManifest(self):
+        for f in self.files.values():
+            f.flush()
+            os.fsync(f.fileno())
+        manifestFile = os.path.join(self.outDir, manifestName)
+        with open(manifestFile + '.tmp', 'w') as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(manifestFile + '.tmp', manifestFile)
+
+    def run(self):
+        start = self.manifest['count']
+        checkpoint = start
+        inFlight = collections.deque()
+        with ProcessPoolExecutor(self.workers) as pool:
+            for chunk, future in self.pendingChunks(pool):
+                inFlight.append((chunk, future))
+                # Keep every worker busy, but only a few chunks of images in memory
+                while len(inFlight) > 2 * self.workers:
+                    c, f = inFlight.popleft()
+                    self.write(c, *f.result())
+                if self.manifest['count'] - checkpoint >= CHECKPOINT_ROWS:
+                    self.saveManifest()
+                    checkpoint = self.manifest['count']
+            while len(inFlight) > 0:
+                c, f = inFlight.popleft()
+                self.write(c, *f.result())
+        self.saveManifest()
+        for f in self.files.values():
+            f.close()
+        self.examples.close()
+        return self.manifest['count'] - start
+
+
+def main():
+    if len(sys.argv) < 3:
+        print ('Usage: python export.py <trainingData directory> <output directory> [width] [height] [workers] [positionsLength]')
+        sys.exit(1)
+    width = int(sys.argv[3]) if len(sys.argv) >= 4 else 128
+    height = int(sys.argv[4]) if len(sys.argv) >= 5 else 96
+    workers = int(sys.argv[5]) if len(sys.argv) >= 6 else os.cpu_count()
+    positionsLength = int(sys.argv[6]) if len(sys.argv) >= 7 else None
+    exporter = Exporter(sys.argv[1], sys.argv[2], width, height, workers, positionsLength)
+    added = exporter.run()
+    print ('Exported', added, 'new examples;', exporter.manifest['count'], 'in total,', exporter.manifest['skipped'], 'skipped')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,243 @@
-from http.server import BaseHTTPRequestHandler,HTTPServer
+from http.server import BaseHTTPRequestHandler,ThreadingHTTPServer
 from os import curdir, sep
-import cgi
+from email.parser import BytesParser
+from email.policy import HTTP
+from urllib.parse import parse_qs
+import os
 import base64
+import binascii
+import mimetypes
 import sqlite3
-import random
+import threading
+import queue
+import signal
+import time
 import json
 
+from blobstore import BlobStore, contentRef
+from db import createTables
+
 PORT_NUMBER = 8000
 
-conn = sqlite3.connect('trainingData/training.db')
-c = conn.cursor()
+# At most this many requests are handled at once; further connections wait in the listen backlog
+MAX_CONCURRENT_REQUESTS = 32
+REQUEST_QUEUE_SIZE = 128
+# A 640x480 PNG data URL is well under this
+MAX_REQUEST_BYTES = 16 * 1024 * 1024
+
+DB_FILE = 'trainingData/training.db'
+BLOB_DIR = 'trainingData/blobs'
+# Examples are written behind the requests, in transactions of up to BATCH_ROWS examples,
+# committed at least every BATCH_MS milliseconds
+BATCH_ROWS = 256
+BATCH_MS = 200
+# Reply to a POST only once its example is committed, with a 503 if it can't be; otherwise reply
+# as soon as it is queued (faster, but an example that then fails to write is lost unreported)
+WAIT_FOR_COMMIT = True
+# A batch that fails to commit is tried again this many times, waiting RETRY_MS, then twice that, ...
+COMMIT_RETRIES = 3
+RETRY_MS = 100
+# Print ingest rate and commit latency this often
+STATS_SECONDS = 30
+
+
+class BadRequest(Exception):
+    pass
+
+
+def parseDataURL(url):
+    # 'data:image/png;base64,iVBOR...' -> (b'\x89PNG...', 'image/png')
+    if not url.startswith('data:') or ',' not in url:
+        raise BadRequest('img is not a data URL')
+    header, payload = url[len('data:'):].split(',', 1)
+    params = header.split(';')
+    if 'base64' not in params[1:]:
+        raise BadRequest('img data URL is not base64')
+    try:
+        return base64.b64decode(payload, validate=True), params[0]
+    except binascii.Error:
+        raise BadRequest('img data URL has bad base64')
+
+
+def parseForm(contentType, body):
+    # Fields of a multipart/form-data (what FormData sends) or urlencoded body, as strings
+    if contentType.startswith('multipart/form-data'):
+        msg = BytesParser(policy=HTTP).parsebytes(b'Content-Type: ' + contentType.encode('latin-1') + b'\r\n\r\n' + body)
+        if not msg.is_multipart():
+            raise BadRequest('bad multipart body')
+        fields = {}
+        for part in msg.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            if name is not None:
+                fields[name] = part.get_payload(decode=True).decode('utf-8')
+        return fields
+    if contentType.startswith('application/x-www-form-urlencoded'):
+        return {k: v[0] for k, v in parse_qs(body.decode('utf-8')).items()}
+    raise BadRequest('unsupported Content-Type ' + contentType)
+
+
+class PendingExample:
+    # What a request waits on: done once its example is committed, or has failed to be
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.ok = False
+
+    def finish(self, ok):
+        self.ok = ok
+        self.done.set()
+
+    def wait(self, timeout):
+        # True if the example was committed within timeout
+        return self.done.wait(timeout) and self.ok
+
+
+class ExampleWriter:
+    # Owns the sqlite connection and the blob store, on its own thread. Requests queue their
+    # examples and images here; the thread groups whatever has arrived into one transaction, so a
+    # burst of clicks costs one commit (and one shard fsync) instead of one each. WAL with
+    # synchronous=NORMAL syncs at checkpoints rather than on every commit, and lets readers
+    # (db.py) run alongside.
+
+    def __init__(self, filename, blobDir):
+        self.filename = filename
+        self.blobDir = blobDir
+        self.queue = queue.Queue()
+        self.ready = threading.Event()
+        self.error = None
+        # Set if the thread stops for good; guarded by lock, so nothing is queued after the last drain
+        self.lock = threading.Lock()
+        self.dead = False
+
+        # Stats since the last report
+        self.examples = 0
+        self.commits = 0
+        self.commitSeconds = 0.0
+        self.maxCommitSeconds = 0.0
+        self.statsTime = time.monotonic()
+
+        self.thread = threading.Thread(target=self.run, name='exampleWriter')
+        self.thread.start()
+        self.ready.wait()
+        if self.error is not None:
+            raise self.error
+
+    def put(self, row, ref, img):
+        # Returns a PendingExample for the row and its image
+        pending = PendingExample()
+        with self.lock:
+            if self.dead:
+                pending.finish(False)
+            else:
+                self.queue.put((row, ref, img, pending))
+        return pending
+
+    def close(self):
+        # Write out everything queued so far, then stop
+        self.queue.put(None)
+        self.thread.join()
+        self.report()
+
+    def run(self):
+        try:
+            conn = sqlite3.connect(self.filename)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            createTables(conn)
+            store = BlobStore(self.blobDir, conn)
+        except (sqlite3.Error, OSError) as e:
+            self.error = e
+            self.ready.set()
+            return
+        self.ready.set()
+
+        try:
+            self.writeBatches(conn, store)
+        except Exception as e:
+            print ('Example writer stopped: %r' % (e,))
+        finally:
+            # Fail whatever is still queued, and anything put from now on
+            with self.lock:
+                self.dead = True
+                while True:
+                    try:
+                        item = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is not None:
+                        item[3].finish(False)
+            store.close()
+            conn.close()
+
+    def writeBatches(self, conn, store):
+        stopping = False
+        while not stopping:
+            # Wait for the first example, then take whatever else arrives within BATCH_MS
+            item = self.queue.get()
+            batch = []
+            deadline = time.monotonic() + BATCH_MS / 1000.0
+            while True:
+                if item is None:
+                    stopping = True
+                else:
+                    batch.append(item)
+                if stopping or len(batch) >= BATCH_ROWS:
+                    break
+                try:
+                    item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+            if len(batch) > 0:
+                self.write(conn, store, batch)
+            if time.monotonic() - self.statsTime >= STATS_SECONDS:
+                self.report()
+
+    def write(self, conn, store, batch):
+        # Commit the batch, retrying with backoff; if it still fails, commit its examples one at a
+        # time, so that one bad example doesn't take the others with it
+        delay = RETRY_MS / 1000.0
+        for attempt in range(0, COMMIT_RETRIES + 1):
+            try:
+                self.commit(conn, store, batch)
+                return
+            except (sqlite3.Error, OSError) as e:
+                print ('Could not write %d examples (attempt %d): %s' % (len(batch), attempt + 1, e))
+            if attempt < COMMIT_RETRIES:
+                time.sleep(delay)
+                delay *= 2
+        for item in batch:
+            try:
+                self.commit(conn, store, [item])
+            except (sqlite3.Error, OSError) as e:
+                print ('Dropped example: %s' % (e,))
+                item[3].finish(False)
+
+    def commit(self, conn, store, batch):
+        start = time.perf_counter()
+        with conn:
+            for row, ref, img, pending in batch:
+                store.put(ref, img)
+            store.sync()
+            conn.executemany('INSERT INTO examples VALUES (?,?,?,?,?,?,?,?)', [row for row, ref, img, pending in batch])
+        seconds = time.perf_counter() - start
+        for row, ref, img, pending in batch:
+            pending.finish(True)
+        self.examples += len(batch)
+        self.commits += 1
+        self.commitSeconds += seconds
+        self.maxCommitSeconds = max(self.maxCommitSeconds, seconds)
+
+    def report(self):
+        elapsed = time.monotonic() - self.statsTime
+        if self.commits > 0:
+            print ('ingest: %.1f examples/sec, %d commits of %.1f examples, commit latency mean %.2f ms max %.2f ms' % (
+                self.examples / elapsed, self.commits, self.examples / float(self.commits),
+                self.commitSeconds / self.commits * 1000, self.maxCommitSeconds * 1000))
+        self.examples = 0
+        self.commits = 0
+        self.commitSeconds = 0.0
+        self.maxCommitSeconds = 0.0
+        self.statsTime = time.monotonic()
 
 
 #This class will handles any incoming request from
@@ -17,54 +245,97 @@ c = conn.cursor()
 class myHandler(BaseHTTPRequestHandler):
 
     def do_GET(self):
-        mimetype='text/html'
-        f = open(curdir + sep + self.path)
+        path = os.path.normpath(self.path.split('?', 1)[0].lstrip('/'))
+        if path.startswith('..') or not os.path.isfile(path):
+            self.send_error(404)
+            return
+        mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        with open(curdir + sep + path, 'rb') as f:
+            content = f.read()
         self.send_response(200)
         self.send_header('Content-type',mimetype)
+        self.send_header('Content-Length', str(len(content)))
         self.end_headers()
-        self.wfile.write(f.read())
+        self.wfile.write(content)
         print ('get operation')
-        f.close()
 
     #Handler for the POST requests
     def do_POST(self):
-        form = cgi.FieldStorage(
-            fp=self.rfile,
-            headers=self.headers,
-            environ={
-                'REQUEST_METHOD':'POST',
-                'CONTENT_TYPE':self.headers['Content-Type'],
-            }
-        )
-
-        print ("data: %s" % form["data"].value)
-        values = json.loads(form['data'].value)
-        positions = json.dumps(values['positions'])
-        img_id = random.getrandbits(32)
-        f = open(curdir + sep + 'trainingData' + sep + 'img' + str(img_id) + '.png', 'wb+')
-        img = form["img"].value.strip("data:image/png;base64")
-        f.write(base64.b64decode(img))
-        f.close()
-        c.execute('INSERT INTO examples VALUES (?,?,?,?,?,?,?,?)', (None, positions,values['width'], values['x'], values['y'], values['type'], img_id, values['timestamp']))
-        conn.commit()
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            if length > MAX_REQUEST_BYTES:
+                self.send_error(413)
+                return
+            form = parseForm(self.headers.get('Content-Type', ''), self.rfile.read(length))
+            if 'data' not in form or 'img' not in form:
+                raise BadRequest('data and img are required')
+
+            values = json.loads(form['data'])
+            positions = json.dumps(values['positions'])
+            width, x, y, type, timestamp = values['width'], values['x'], values['y'], values['type'], values['timestamp']
+            # ms since the epoch, as the page sends it; db.py orders and pages examples by it
+            if not isinstance(timestamp, int) or isinstance(timestamp, bool):
+                raise BadRequest('timestamp is not an integer')
+            png, mimetype = parseDataURL(form['img'])
+            if mimetype != 'image/png':
+                raise BadRequest('img is ' + mimetype + ', not image/png')
+        except (BadRequest, ValueError, KeyError, TypeError) as e:
+            self.send_error(400, str(e))
+            return
+
+        # Hashed here, on the request's thread, rather than on the writer's
+        ref = contentRef(png)
+        pending = writer.put((None, positions, width, x, y, type, ref, timestamp), ref, png)
+        if WAIT_FOR_COMMIT and not pending.wait(timeout=30):
+            self.send_error(503, 'example not committed')
+            return
         self.send_response(200)
+        self.send_header('Content-Length', '0')
         self.end_headers()
         return
 
 
+class BoundedThreadingHTTPServer(ThreadingHTTPServer):
+    # A thread per request, but no more than MAX_CONCURRENT_REQUESTS of them
+    request_queue_size = REQUEST_QUEUE_SIZE
+    # Let server_close() wait for requests in progress, so their examples reach the writer
+    daemon_threads = False
+
+    def __init__(self, *args, **kwargs):
+        self.slots = threading.BoundedSemaphore(MAX_CONCURRENT_REQUESTS)
+        ThreadingHTTPServer.__init__(self, *args, **kwargs)
+
+    def process_request(self, request, client_address):
+        # Blocks accepting more connections until a request finishes
+        self.slots.acquire()
+        try:
+            ThreadingHTTPServer.process_request(self, request, client_address)
+        except Exception:
+            self.slots.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            ThreadingHTTPServer.process_request_thread(self, request, client_address)
+        finally:
+            self.slots.release()
+
+
+writer = ExampleWriter(DB_FILE, BLOB_DIR)
+#Create a web server and define the handler to manage the
+#incoming request
+server = BoundedThreadingHTTPServer(('', PORT_NUMBER), myHandler)
+# Stop the same way on SIGTERM as on ^C; shutdown() has to come from another thread
+signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
 try:
-    #Create a web server and define the handler to manage the
-    #incoming request
-    server = HTTPServer(('', PORT_NUMBER), myHandler)
     print ('Started httpserver on port ' , PORT_NUMBER)
-    c.execute('''CREATE TABLE IF NOT EXISTS examples
-                    (exampleid INTEGER PRIMARY KEY, positions TEXT, width INTEGER, x REAL, y REAL, type TEXT, img INTEGER, timestamp INTEGER)''')
-    conn.commit()
     #Wait forever for incoming http requests
     server.serve_forever()
 
 except KeyboardInterrupt:
     print ('^C received, shutting down the web server')
-    conn.close()
-    server.socket.close()
 
+finally:
+    # Finish the requests in progress, then write out every queued example
+    server.server_close()
+    writer.close()